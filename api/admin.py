@@ -1,19 +1,33 @@
 from django.contrib import admin
-from .models import Document, InteractionLog, TTSState
+from .models import CachedAnswer, Document, IngestionJob, InteractionLog, TTSState
 
 @admin.register(Document)
 class DocumentAdmin(admin.ModelAdmin):
-    list_display = ['file_name', 'uploaded_at']
+    list_display = ['file_name', 'uploaded_by', 'uploaded_at']
     search_fields = ['file_name']
 
+@admin.register(IngestionJob)
+class IngestionJobAdmin(admin.ModelAdmin):
+    list_display = ['document', 'status', 'stage', 'progress', 'attempts', 'created_at', 'finished_at']
+    list_filter = ['status', 'stage']
+    search_fields = ['document__file_name']
+
 @admin.register(InteractionLog)
 class InteractionLogAdmin(admin.ModelAdmin):
     list_display = ['user', 'question', 'timestamp']
     search_fields = ['question', 'answer']
     list_filter = ['timestamp']
 
+@admin.register(CachedAnswer)
+class CachedAnswerAdmin(admin.ModelAdmin):
+    list_display = ['question', 'hits', 'created_at', 'last_used_at']
+    search_fields = ['question', 'answer']
+    exclude = ['embedding']
+
 @admin.register(TTSState)
 class TTSStateAdmin(admin.ModelAdmin):
-    list_display = ['user', 'position', 'voice_id', 'updated_at']
+    list_display = ['user', 'interaction', 'position', 'voice_id', 'updated_at']
+    list_select_related = ['user']
+    raw_id_fields = ['interaction']
     search_fields = ['user__username']
     list_filter = ['updated_at']
\ No newline at end of file
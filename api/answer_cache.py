@@ -0,0 +1,141 @@
+import hashlib
+import logging
+import threading
+from datetime import timedelta
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from .models import CachedAnswer
+
+logger = logging.getLogger(__name__)
+
+# Cached answers are shared by all users on purpose. The knowledge base is not partitioned by
+# user: every user's question is answered from the same documents, and an entry is only reused
+# when the retrieved context is the identical set of chunks. A reused answer was therefore
+# generated from exactly the passages the asking user would have been sent anyway, and carries
+# nothing else (no user, no interaction). If retrieval is ever scoped per user or per
+# document permission, that scope has to become part of the fingerprint.
+
+# Counters for sizing the cache; exposed alongside the retrieval cache stats
+_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+_stats_lock = threading.Lock()
+
+def _count(name, amount=1):
+    # Returns the new value, read under the same lock as the increment
+    with _stats_lock:
+        _stats[name] += amount
+        return _stats[name]
+
+def context_fingerprint(results):
+    # Chunk ids embed the document id and content hash, so re-indexed content never matches
+    digest = hashlib.sha256()
+    for result in results:
+        digest.update(result['id'].encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def _candidates(fingerprint):
+    cutoff = timezone.now() - timedelta(seconds=settings.ANSWER_CACHE_TTL)
+    # Only answers generated from exactly the same retrieved context are candidates, which
+    # keeps the similarity scan to a handful of rows
+    return (
+        CachedAnswer.objects
+        .filter(context_fingerprint=fingerprint, created_at__gte=cutoff)
+        .only('id', 'embedding', 'answer', 'sources')[:settings.ANSWER_CACHE_MAX_CANDIDATES]
+    )
+
+def _best_match(candidates, question_embedding):
+    if not candidates:
+        return None
+    matrix = np.vstack([np.frombuffer(bytes(c.embedding), dtype=np.float32) for c in candidates])
+    scores = matrix @ _normalized(question_embedding)
+    best = int(np.argmax(scores))
+    return candidates[best] if scores[best] >= settings.ANSWER_CACHE_SIMILARITY else None
+
+def _normalized(question_embedding):
+    vector = np.asarray(question_embedding, dtype=np.float32)
+    return vector / (np.linalg.norm(vector) or 1.0)
+
+def _record_lookup(cached):
+    _count('misses' if cached is None else 'hits')
+
+def lookup(question_embedding, fingerprint):
+    if not settings.ANSWER_CACHE_ENABLED:
+        return None
+    cached = _best_match(list(_candidates(fingerprint)), question_embedding)
+    if cached is not None:
+        CachedAnswer.objects.filter(id=cached.id).update(hits=F('hits') + 1, last_used_at=timezone.now())
+    _record_lookup(cached)
+    return cached
+
+async def alookup(question_embedding, fingerprint):
+    if not settings.ANSWER_CACHE_ENABLED:
+        return None
+    cached = _best_match([c async for c in _candidates(fingerprint)], question_embedding)
+    if cached is not None:
+        await CachedAnswer.objects.filter(id=cached.id).aupdate(hits=F('hits') + 1, last_used_at=timezone.now())
+    _record_lookup(cached)
+    return cached
+
+def store(question, question_embedding, fingerprint, answer, sources, document_ids):
+    if not settings.ANSWER_CACHE_ENABLED:
+        return None
+    cached = CachedAnswer.objects.create(
+        question=question,
+        embedding=_normalized(question_embedding).tobytes(),
+        context_fingerprint=fingerprint,
+        answer=answer,
+        sources=sources,
+    )
+    cached.documents.set(document_ids)
+    # Exactly one store in every 100 sees a multiple of 100, however many threads are storing
+    if _count('stores') % 100 == 0:
+        evict()
+    return cached
+
+async def astore(question, question_embedding, fingerprint, answer, sources, document_ids):
+    if not settings.ANSWER_CACHE_ENABLED:
+        return None
+    cached = await CachedAnswer.objects.acreate(
+        question=question,
+        embedding=_normalized(question_embedding).tobytes(),
+        context_fingerprint=fingerprint,
+        answer=answer,
+        sources=sources,
+    )
+    await cached.documents.aset(document_ids)
+    if _count('stores') % 100 == 0:
+        await sync_to_async(evict)()
+    return cached
+
+def _deleted(queryset):
+    # delete() totals include the M2M through rows; count cache entries only
+    _, per_model = queryset.delete()
+    return per_model.get(CachedAnswer._meta.label, 0)
+
+def evict():
+    cutoff = timezone.now() - timedelta(seconds=settings.ANSWER_CACHE_TTL)
+    removed = _deleted(CachedAnswer.objects.filter(created_at__lt=cutoff))
+    # Trim least recently used entries beyond the size limit
+    overflow = CachedAnswer.objects.order_by('-last_used_at').values_list('id', flat=True)[settings.ANSWER_CACHE_MAX_ENTRIES:]
+    overflow_ids = list(overflow[:1000])
+    if overflow_ids:
+        removed += _deleted(CachedAnswer.objects.filter(id__in=overflow_ids))
+    if removed:
+        _count('evictions', removed)
+        logger.info("Evicted %s cached answers", removed)
+
+def invalidate_documents(document_ids):
+    removed = _deleted(CachedAnswer.objects.filter(documents__id__in=document_ids))
+    if removed:
+        logger.info("Invalidated %s cached answers for documents %s", removed, list(document_ids))
+
+def answer_cache_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+    stats['entries'] = CachedAnswer.objects.count()
+    return stats
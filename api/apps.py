@@ -1,8 +1,14 @@
+import threading
 from django.apps import AppConfig
+from django.conf import settings
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
 
     def ready(self):
-        import api.signals
\ No newline at end of file
+        import api.signals
+        if settings.RERANK_ENABLED:
+            # Off the startup path; a question arriving before it finishes waits for the load
+            from api.reranking import warm_up_reranker
+            threading.Thread(target=warm_up_reranker, name='reranker-warm-up', daemon=True).start()
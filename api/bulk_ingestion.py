@@ -0,0 +1,28 @@
+import os
+import time
+
+# Worker side of `manage.py ingest`. Runs in spawned pool processes, so this module must not
+# import models at import time; the initializer sets Django up once per process.
+
+def init_worker():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'knowledge_assistant.settings')
+    import django
+    django.setup()
+
+def parse_and_chunk(file_path):
+    # Parses and chunks one PDF; returns (page_count, chunks, seconds). Parsing stays
+    # sequential inside the worker because the pool already spreads files across cores.
+    from api.chunking import get_chunker
+    from api.extraction import iter_pages
+
+    start = time.time()
+    pages = 0
+
+    def page_texts():
+        nonlocal pages
+        for page_number, total, text in iter_pages(file_path, parallel=False):
+            pages = total
+            yield page_number, text
+
+    chunks = list(get_chunker().chunk(page_texts()))
+    return pages, chunks, time.time() - start
@@ -0,0 +1,198 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+
+try:
+    import fcntl
+except ImportError:  # Windows: bumps are not serialised between processes
+    fcntl = None
+
+VERSION_KEY = 'api:knowledge-base-version'
+
+class LRUCache:
+    # Bounded in-process LRU with per-entry TTL. When a Django cache alias is given, misses
+    # fall through to that shared backend (e.g. Redis/Memcached) so workers share entries.
+    def __init__(self, name, maxsize, ttl, shared_alias=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.shared_alias = shared_alias
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _shared(self):
+        return caches[self.shared_alias] if self.shared_alias else None
+
+    def _shared_key(self, key):
+        return f"api:{self.name}:{key}"
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+        shared = self._shared()
+        if shared is not None:
+            value = shared.get(self._shared_key(key))
+            if value is not None:
+                self._store(key, value)
+                with self._lock:
+                    self.shared_hits += 1
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value):
+        self._store(key, value)
+        shared = self._shared()
+        if shared is not None:
+            shared.set(self._shared_key(key), value, timeout=self.ttl)
+
+    def _store(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round((self.hits + self.shared_hits) / lookups, 4) if lookups else 0.0,
+            }
+
+# Level 1: normalised question -> query embedding
+embedding_cache = LRUCache(
+    'query-embedding',
+    settings.EMBEDDING_CACHE_SIZE,
+    settings.EMBEDDING_CACHE_TTL,
+    settings.RETRIEVAL_CACHE_SHARED_ALIAS,
+)
+# Level 2: (embedding, collection version, k) -> retrieval results
+results_cache = LRUCache(
+    'retrieval-results',
+    settings.RESULTS_CACHE_SIZE,
+    settings.RESULTS_CACHE_TTL,
+    settings.RETRIEVAL_CACHE_SHARED_ALIAS,
+)
+
+def normalize_question(question):
+    return re.sub(r'\s+', ' ', question).strip().lower()
+
+def embedding_key(embedding, *parts):
+    digest = hashlib.sha1(embedding.astype('float32').tobytes())
+    for part in parts:
+        digest.update(str(part).encode())
+    return digest.hexdigest()
+
+def _version_cache():
+    return caches[settings.RETRIEVAL_CACHE_SHARED_ALIAS]
+
+class VersionFile:
+    # Collection version shared by every process on the host through a small file. A bump
+    # replaces the file, so readers only re-read it when its inode or mtime changed.
+    def __init__(self, path):
+        self.path = str(path)
+        self._seen = None
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return 0
+        seen = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if seen == self._seen:
+                return self._value
+        value = self._read()
+        with self._lock:
+            self._seen, self._value = seen, value
+        return value
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def bump(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.lock', 'a') as lock:
+            # Serialises bumps from concurrent ingestion processes
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                value = self._read() + 1
+                tmp = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp, 'w') as f:
+                    f.write(str(value))
+                os.replace(tmp, self.path)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        return value
+
+version_file = VersionFile(settings.RETRIEVAL_CACHE_VERSION_FILE)
+
+def get_collection_version():
+    # Without a shared cache alias the version still has to be shared: ingestion runs in
+    # other processes (workers, management commands) than the ones serving questions
+    if not settings.RETRIEVAL_CACHE_SHARED_ALIAS:
+        return version_file.get()
+    return _version_cache().get_or_set(VERSION_KEY, 0, timeout=None)
+
+async def aget_collection_version():
+    if not settings.RETRIEVAL_CACHE_SHARED_ALIAS:
+        return version_file.get()
+    return await _version_cache().aget_or_set(VERSION_KEY, 0, timeout=None)
+
+def bump_collection_version():
+    # Retrieval results are keyed by version, so bumping it invalidates them everywhere that
+    # shares this cache; stale entries then age out of the LRU
+    if not settings.RETRIEVAL_CACHE_SHARED_ALIAS:
+        return version_file.bump()
+    cache = _version_cache()
+    try:
+        return cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, 1, timeout=None)
+        return 1
+
+def retrieval_cache_stats():
+    return {
+        'collection_version': get_collection_version(),
+        'embedding_cache': embedding_cache.stats(),
+        'results_cache': results_cache.stats(),
+    }
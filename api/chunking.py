@@ -0,0 +1,151 @@
+import logging
+import re
+import threading
+from dataclasses import dataclass
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+PARAGRAPH_RE = re.compile(r'\n\s*\n')
+SENTENCE_RE = re.compile(r'(?<=[.!?;:])\s+(?=[A-Z0-9"\'(\[])')
+WORD_RE = re.compile(r'\w+|[^\w\s]')
+
+@dataclass
+class Chunk:
+    text: str
+    page_start: int
+    page_end: int
+    token_count: int
+
+@dataclass
+class _Unit:
+    text: str
+    page: int
+    tokens: int
+
+class TokenCounter:
+    # Counts word-piece tokens with the embedding model's own tokenizer. Loading the
+    # tokenizer alone is cheap compared to the model; if it is unavailable (e.g. offline)
+    # a conservative word/punctuation estimate keeps chunks under the limit.
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self._tokenizer = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            try:
+                from tokenizers import Tokenizer
+                self._tokenizer = Tokenizer.from_pretrained(f"sentence-transformers/{self.model_name}")
+                self._tokenizer.no_truncation()
+                self._tokenizer.no_padding()
+            except Exception as e:
+                logger.warning("Tokenizer for %s unavailable, estimating token counts: %s", self.model_name, str(e))
+            self._loaded = True
+
+    def count_many(self, texts):
+        if not self._loaded:
+            self._load()
+        if self._tokenizer is None:
+            return [int(len(WORD_RE.findall(text)) * 1.3) + 1 for text in texts]
+        return [len(encoding.ids) for encoding in self._tokenizer.encode_batch(texts, add_special_tokens=False)]
+
+_counters = {}
+_counters_lock = threading.Lock()
+
+def get_token_counter(model_name):
+    # A chunker is built per document; share the loaded tokenizer (or the failed lookup)
+    # across them instead of reloading it every time
+    with _counters_lock:
+        counter = _counters.get(model_name)
+        if counter is None:
+            counter = _counters[model_name] = TokenCounter(model_name)
+    return counter
+
+class Chunker:
+    # Base class for pluggable chunkers (selected with settings.CHUNKER).
+    # chunk() consumes (page_number, text) pairs lazily and yields Chunk objects.
+    def chunk(self, pages):
+        raise NotImplementedError
+
+class TokenChunker(Chunker):
+    def __init__(self, max_tokens=None, overlap_tokens=None, model_name=None):
+        self.max_tokens = max_tokens or settings.CHUNK_MAX_TOKENS
+        self.overlap_tokens = settings.CHUNK_OVERLAP_TOKENS if overlap_tokens is None else overlap_tokens
+        self.counter = get_token_counter(model_name or settings.EMBEDDING_MODEL)
+
+    def _units(self, page_number, text):
+        # Paragraphs first, then sentences; oversized sentences are split on word boundaries
+        sentences = []
+        for paragraph in PARAGRAPH_RE.split(text):
+            paragraph = ' '.join(paragraph.split())
+            if paragraph:
+                sentences.extend(s for s in SENTENCE_RE.split(paragraph) if s)
+        if not sentences:
+            return []
+        units = []
+        for sentence, tokens in zip(sentences, self.counter.count_many(sentences)):
+            if tokens <= self.max_tokens:
+                units.append(_Unit(sentence, page_number, tokens))
+            else:
+                units.extend(self._split_long(sentence, page_number))
+        return units
+
+    def _split_long(self, sentence, page_number):
+        words = sentence.split()
+        token_counts = self.counter.count_many(words)
+        units = []
+        current, current_tokens = [], 0
+        for word, tokens in zip(words, token_counts):
+            # Joining words adds no tokens with WordPiece, so per-word counts add up exactly
+            if current and current_tokens + tokens > self.max_tokens:
+                units.append(_Unit(' '.join(current), page_number, current_tokens))
+                current, current_tokens = [], 0
+            current.append(word)
+            current_tokens += tokens
+        if current:
+            units.append(_Unit(' '.join(current), page_number, current_tokens))
+        return units
+
+    def _make_chunk(self, units):
+        return Chunk(
+            text=' '.join(unit.text for unit in units),
+            page_start=units[0].page,
+            page_end=units[-1].page,
+            token_count=sum(unit.tokens for unit in units),
+        )
+
+    def _overlap(self, units):
+        # Carry trailing sentences (up to overlap_tokens) into the next chunk
+        carried, tokens = [], 0
+        for unit in reversed(units):
+            if tokens + unit.tokens > self.overlap_tokens:
+                break
+            carried.insert(0, unit)
+            tokens += unit.tokens
+        return carried, tokens
+
+    def chunk(self, pages):
+        window, window_tokens = [], 0
+        fresh = False
+        for page_number, text in pages:
+            for unit in self._units(page_number, text):
+                if window and window_tokens + unit.tokens > self.max_tokens:
+                    yield self._make_chunk(window)
+                    window, window_tokens = self._overlap(window)
+                    fresh = False
+                    # Overlap must never push the next chunk over the limit
+                    while window and window_tokens + unit.tokens > self.max_tokens:
+                        window_tokens -= window.pop(0).tokens
+                window.append(unit)
+                window_tokens += unit.tokens
+                fresh = True
+        if window and fresh:
+            yield self._make_chunk(window)
+
+def get_chunker():
+    return import_string(settings.CHUNKER)()
@@ -0,0 +1,107 @@
+import re
+from django.conf import settings
+
+WORD_RE = re.compile(r'\w+|[^\w\s]')
+
+def estimate_tokens(text):
+    # Rough LLM token estimate (~1.3 tokens per word/punctuation mark); only used for budgeting
+    return int(len(WORD_RE.findall(text)) * 1.3) + 1
+
+def score(result):
+    # Chroma returns squared L2 distance; on unit-length embeddings that is 2 - 2*cosine.
+    # Keyword-only hits carry a score on the same scale instead (utils.keyword_score)
+    if result.get('score') is not None:
+        return result['score']
+    distance = result.get('distance')
+    return 1.0 - distance / 2.0 if distance is not None else 1.0
+
+def _position(result):
+    # Chunk ids look like doc<id>-<hash>-<index>; adjacent indexes are neighbouring chunks
+    prefix, _, index = result['id'].rpartition('-')
+    return prefix, int(index) if index.isdigit() else None
+
+def _shingles(text, size=3):
+    words = text.lower().split()
+    return {tuple(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+def _similar(a, b, threshold):
+    if not a or not b:
+        return False
+    return len(a & b) / len(a | b) >= threshold
+
+def _join(earlier, later):
+    # Adjacent chunks share their overlap window; drop the repeated words when merging
+    a, b = earlier.split(), later.split()
+    for k in range(min(len(a), len(b), 128), 0, -1):
+        if a[-k:] == b[:k]:
+            return ' '.join(a + b[k:])
+    return ' '.join(a + b)
+
+class Passage:
+    def __init__(self, result):
+        self.prefix, index = _position(result)
+        self.first = self.last = index
+        self.metadata = dict(result['metadata'])
+        self.results = [result]
+        self.text = result['text']
+        self.score = score(result)
+
+    def adjacent(self, result):
+        prefix, index = _position(result)
+        if prefix != self.prefix or index is None or self.first is None:
+            return None
+        if index == self.last + 1:
+            return 'after'
+        if index == self.first - 1:
+            return 'before'
+        return None
+
+    def merge(self, result, side):
+        _, index = _position(result)
+        metadata = result['metadata']
+        if side == 'after':
+            self.text = _join(self.text, result['text'])
+            self.last = index
+            self.metadata['page_end'] = metadata.get('page_end', metadata.get('page'))
+        else:
+            self.text = _join(result['text'], self.text)
+            self.first = index
+            self.metadata['page'] = metadata.get('page')
+        self.results.append(result)
+
+# Builds the LLM context from ranked retrieval results and returns (context, passages).
+# Low-score hits are dropped, near-duplicates removed, neighbouring chunks of the same
+# document merged, and passages added in rank order until the token budget is spent.
+def assemble_context(results, token_budget=None, min_score=None, dedup_threshold=None):
+    token_budget = token_budget or settings.CONTEXT_TOKEN_BUDGET
+    min_score = settings.CONTEXT_MIN_SCORE if min_score is None else min_score
+    dedup_threshold = dedup_threshold or settings.CONTEXT_DEDUP_THRESHOLD
+
+    # Always keep the best hit so a question never goes to the LLM with no context at all
+    ranked = [r for i, r in enumerate(results) if i == 0 or score(r) >= min_score]
+
+    passages = []
+    seen_shingles = []
+    for result in ranked:
+        shingles = _shingles(result['text'])
+        if any(_similar(shingles, seen, dedup_threshold) for seen in seen_shingles):
+            continue
+        seen_shingles.append(shingles)
+        for passage in passages:
+            side = passage.adjacent(result)
+            if side:
+                passage.merge(result, side)
+                break
+        else:
+            passages.append(Passage(result))
+
+    selected = []
+    used_tokens = 0
+    for passage in passages:
+        tokens = estimate_tokens(passage.text)
+        if selected and used_tokens + tokens > token_budget:
+            continue
+        selected.append(passage)
+        used_tokens += tokens
+
+    return "\n\n".join(passage.text for passage in selected), selected
@@ -0,0 +1,281 @@
+import hashlib
+import logging
+import os
+import pickle
+import re
+import threading
+import time
+import uuid
+import numpy as np
+from django.conf import settings
+from api.embeddings import get_embedding_service
+
+logger = logging.getLogger(__name__)
+
+def text_key(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def quantize(embeddings, dtype):
+    # Returns (stored array, per-row scales or None). int8 uses symmetric per-row scaling.
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if dtype == 'int8':
+        scales = np.abs(embeddings).max(axis=1) / 127.0 if len(embeddings) else np.zeros(0, dtype=np.float32)
+        scales[scales == 0] = 1.0
+        return np.round(embeddings / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    if dtype == 'float16':
+        return embeddings.astype(np.float16), None
+    raise ValueError(f"Unsupported embedding store dtype: {dtype}")
+
+def dequantize(vectors, scales):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors * scales[:, None] if scales is not None else vectors
+
+class SegmentWriter:
+    # Streams one document's vectors to disk batch by batch: quantized rows are appended to
+    # a raw scratch file and copied into the final .npy through a memory map on commit, so
+    # the vectors are never all held in memory. Chunk text is kept for the manifest.
+    def __init__(self, store, document_id):
+        self.store = store
+        self.document_id = document_id
+        self.vector_file = f"doc-{document_id}-{uuid.uuid4().hex[:12]}.npy"
+        self.scratch = os.path.join(store.path, f".{self.vector_file}.part")
+        self.rows = 0
+        self.dimensions = 0
+        self.dtype = None
+        self.ids, self.keys, self.texts, self.metadatas, self.scales = [], [], [], [], []
+
+    def add(self, records, embeddings):
+        if not records:
+            return
+        vectors, scales = quantize(embeddings, self.store.dtype)
+        os.makedirs(self.store.path, exist_ok=True)
+        with open(self.scratch, 'ab') as f:
+            f.write(np.ascontiguousarray(vectors).tobytes())
+        self.rows += len(vectors)
+        self.dimensions = vectors.shape[1]
+        self.dtype = vectors.dtype
+        if scales is not None:
+            self.scales.append(scales)
+        self.ids.extend(record['id'] for record in records)
+        self.keys.extend(text_key(record['text']) for record in records)
+        self.texts.extend(record['text'] for record in records)
+        self.metadatas.extend(record['metadata'] for record in records)
+
+    def commit(self, block=65536):
+        os.makedirs(self.store.path, exist_ok=True)
+        target = os.path.join(self.store.path, self.vector_file)
+        if self.rows:
+            source = np.memmap(self.scratch, dtype=self.dtype, mode='r', shape=(self.rows, self.dimensions))
+            vectors = np.lib.format.open_memmap(target, mode='w+', dtype=self.dtype, shape=(self.rows, self.dimensions))
+            for start in range(0, self.rows, block):
+                vectors[start:start + block] = source[start:start + block]
+            vectors.flush()
+            del vectors, source
+            os.remove(self.scratch)
+        else:
+            np.save(target, np.zeros((0, 0), dtype=np.float16 if self.store.dtype == 'float16' else np.int8))
+        scales = np.concatenate(self.scales) if self.scales else (np.zeros(0, dtype=np.float32) if self.store.dtype == 'int8' else None)
+        self.store._commit(self.document_id, {
+            'vector_file': self.vector_file,
+            'ids': self.ids,
+            'keys': self.keys,
+            'texts': self.texts,
+            'metadatas': self.metadatas,
+            'scales': scales,
+        })
+
+    def abort(self):
+        try:
+            os.remove(self.scratch)
+        except FileNotFoundError:
+            pass
+
+class EmbeddingStore:
+    # Chunk embeddings kept outside the vector database, one segment per document and one
+    # directory per embedding model. Vectors are float16 or int8 .npy files opened with
+    # mmap; a pickled manifest holds chunk ids, text hashes, texts and metadata. Encoding a
+    # chunk whose text is already stored (re-processing, re-chunking, rebuilding the vector
+    # store) is a lookup, and the local vector store builds its snapshots from this data.
+    def __init__(self, path, model_name, dtype='float16'):
+        self.path = os.path.join(str(path), re.sub(r'[^\w.-]+', '_', model_name))
+        self.model_name = model_name
+        self.dtype = dtype
+        self._segments = {}
+        self._manifest_mtimes = {}
+        self._dir_mtime = None
+        self._checked_at = 0.0
+        self._keys = None
+        self._lock = threading.RLock()
+
+    def _manifest_path(self, document_id):
+        return os.path.join(self.path, f"doc-{document_id}.pkl")
+
+    def begin_document(self, document_id):
+        # Returns a SegmentWriter; the document's previous segment stays until commit()
+        return SegmentWriter(self, document_id)
+
+    def put_document(self, document_id, records, embeddings):
+        # records: the {"id", "text", "metadata"} dicts written to the vector store
+        writer = self.begin_document(document_id)
+        writer.add(records, embeddings)
+        writer.commit()
+
+    def _commit(self, document_id, manifest):
+        # A fresh vector file per write: readers that still map the old file keep a valid view
+        vector_file = manifest['vector_file']
+        target = self._manifest_path(document_id)
+        previous = self._read_manifest(target)
+        tmp = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            pickle.dump(manifest, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, target)
+        if previous is not None and previous['vector_file'] != vector_file:
+            self._unlink(previous['vector_file'])
+        with self._lock:
+            self._segments[document_id] = self._open(manifest)
+            self._manifest_mtimes[document_id] = os.stat(target).st_mtime_ns
+            self._keys = None
+
+    def remove_document(self, document_id):
+        target = self._manifest_path(document_id)
+        manifest = self._read_manifest(target)
+        try:
+            os.remove(target)
+        except FileNotFoundError:
+            pass
+        if manifest is not None:
+            self._unlink(manifest['vector_file'])
+        with self._lock:
+            if self._segments.pop(document_id, None) is not None:
+                self._keys = None
+            self._manifest_mtimes.pop(document_id, None)
+
+    def _unlink(self, name):
+        try:
+            os.remove(os.path.join(self.path, name))
+        except FileNotFoundError:
+            pass
+
+    def _read_manifest(self, path):
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def _open(self, manifest):
+        segment = dict(manifest)
+        segment['vectors'] = np.load(os.path.join(self.path, manifest['vector_file']), mmap_mode='r')
+        return segment
+
+    def refresh(self, force=False):
+        # Other processes (ingestion workers) write segments; pick up changes at most once a second
+        now = time.monotonic()
+        if not force and now - self._checked_at < 1.0:
+            return
+        self._checked_at = now
+        try:
+            dir_mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if not force and dir_mtime == self._dir_mtime:
+                return
+            self._dir_mtime = dir_mtime
+            on_disk = {}
+            for name in os.listdir(self.path):
+                if name.startswith('doc-') and name.endswith('.pkl'):
+                    document_id = int(name[4:-4])
+                    on_disk[document_id] = os.stat(os.path.join(self.path, name)).st_mtime_ns
+            for document_id in set(self._segments) - set(on_disk):
+                del self._segments[document_id]
+                self._manifest_mtimes.pop(document_id, None)
+                self._keys = None
+            for document_id, mtime in on_disk.items():
+                if self._manifest_mtimes.get(document_id) != mtime:
+                    manifest = self._read_manifest(self._manifest_path(document_id))
+                    try:
+                        segment = self._open(manifest) if manifest is not None else None
+                    except FileNotFoundError:
+                        segment = None
+                    if segment is None:
+                        continue
+                    self._segments[document_id] = segment
+                    self._manifest_mtimes[document_id] = mtime
+                    self._keys = None
+
+    def document_ids(self):
+        self.refresh()
+        with self._lock:
+            return sorted(self._segments)
+
+    def load_document(self, document_id):
+        # Returns (records, float32 embeddings) for a stored document, or None
+        self.refresh()
+        with self._lock:
+            segment = self._segments.get(document_id)
+        if segment is None:
+            return None
+        records = [
+            {"id": chunk_id, "text": text, "metadata": metadata}
+            for chunk_id, text, metadata in zip(segment['ids'], segment['texts'], segment['metadatas'])
+        ]
+        return records, dequantize(segment['vectors'], segment['scales'])
+
+    def lookup(self, texts):
+        # Returns (embeddings with NaN rows for misses, indexes of the misses)
+        self.refresh()
+        with self._lock:
+            if self._keys is None:
+                self._keys = {
+                    key: (document_id, row)
+                    for document_id, segment in self._segments.items()
+                    for row, key in enumerate(segment['keys'])
+                }
+            keys, segments = self._keys, dict(self._segments)
+        found = []
+        missing = []
+        for index, text in enumerate(texts):
+            location = keys.get(text_key(text))
+            if location is None:
+                missing.append(index)
+            else:
+                found.append((index, location))
+        if not found:
+            return None, missing
+        dimensions = segments[found[0][1][0]]['vectors'].shape[1]
+        embeddings = np.full((len(texts), dimensions), np.nan, dtype=np.float32)
+        for index, (document_id, row) in found:
+            segment = segments[document_id]
+            scales = segment['scales'][row:row + 1] if segment['scales'] is not None else None
+            embeddings[index] = dequantize(segment['vectors'][row:row + 1], scales)[0]
+        return embeddings, missing
+
+    def stats(self):
+        self.refresh()
+        with self._lock:
+            segments = list(self._segments.values())
+        return {
+            'model': self.model_name,
+            'dtype': self.dtype,
+            'documents': len(segments),
+            'chunks': sum(len(segment['ids']) for segment in segments),
+            'bytes': sum(segment['vectors'].nbytes for segment in segments),
+        }
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def embedding_store_enabled():
+    # `manage.py reindex` rebuilds the local vector store from the embedding store, so it
+    # stays on with VECTOR_STORE=local
+    return settings.EMBEDDING_STORE_ENABLED or settings.VECTOR_STORE == 'local'
+
+def get_embedding_store(model_name=None):
+    # Keyed by the embedding service's model (or offline backend) so vectors never mix
+    model_name = model_name or get_embedding_service().store_key
+    with _stores_lock:
+        store = _stores.get(model_name)
+        if store is None:
+            store = _stores[model_name] = EmbeddingStore(settings.EMBEDDING_STORE_DIR, model_name, settings.EMBEDDING_STORE_DTYPE)
+    return store
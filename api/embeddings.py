@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import queue
+import re
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+class SentenceTransformerBackend:
+    def __init__(self, model_name):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name)
+
+    def encode(self, texts, batch_size):
+        return np.asarray(self.model.encode(texts, batch_size=batch_size, convert_to_tensor=False), dtype=np.float32)
+
+class OnnxBackend:
+    # ONNX Runtime build of all-MiniLM-L6-v2 shipped with chromadb; same mean pooling and
+    # L2 normalisation as the sentence-transformers model, but noticeably faster on CPU
+    def __init__(self, model_name):
+        if model_name != 'all-MiniLM-L6-v2':
+            raise ValueError(f"ONNX backend only supports all-MiniLM-L6-v2, not {model_name}")
+        from chromadb.utils.embedding_functions import ONNXMiniLM_L6_V2
+        self.model = ONNXMiniLM_L6_V2(preferred_providers=['CPUExecutionProvider'])
+
+    def encode(self, texts, batch_size):
+        vectors = []
+        for start in range(0, len(texts), batch_size):
+            vectors.extend(self.model(texts[start:start + batch_size]))
+        return np.asarray(vectors, dtype=np.float32)
+
+class HashingBackend:
+    # Offline stand-in for benchmarks: signed feature hashing of words into a fixed-size,
+    # L2-normalised vector. Needs no model download, but only captures word overlap.
+    dimensions = 384
+    # Kept apart from real model vectors in the embedding store
+    store_key = 'hashing-384'
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+
+    def encode(self, texts, batch_size):
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in re.findall(r'\w+', text.lower()):
+                digest = zlib.crc32(word.encode())
+                vectors[row, digest % self.dimensions] += 1.0 if digest & 0x80000000 else -1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+BACKENDS = {
+    'sentence-transformers': SentenceTransformerBackend,
+    'onnx': OnnxBackend,
+    'hashing': HashingBackend,
+}
+
+class EmbeddingService:
+    # The model is loaded on first use, so management commands, migrations and the admin
+    # never pay for it. Query encodes from concurrent requests are merged into one forward
+    # pass by a micro-batching thread; ingestion batches go straight to the backend.
+    def __init__(self, model_name, backend='sentence-transformers', max_batch=32, max_wait_ms=5):
+        self.model_name = model_name
+        self.backend_name = backend
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._backend = None
+        self._load_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._batcher = None
+        self._batcher_lock = threading.Lock()
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            with self._load_lock:
+                if self._backend is None:
+                    start = time.time()
+                    self._backend = BACKENDS[self.backend_name](self.model_name)
+                    logger.info("Loaded %s embedding model %s in %.2f seconds", self.backend_name, self.model_name, time.time() - start)
+        return self._backend
+
+    def warm_up(self):
+        # Call before forking workers (e.g. gunicorn --preload) so they share the weights copy-on-write
+        self.backend.encode(["warm up"], 1)
+
+    def encode(self, texts, batch_size=None):
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        return self.backend.encode(list(texts), batch_size or settings.EMBEDDING_BATCH_SIZE)
+
+    @property
+    def store_key(self):
+        return getattr(BACKENDS[self.backend_name], 'store_key', None) or self.model_name
+
+    def encode_documents(self, texts, batch_size=None):
+        # Chunk texts already in the embedding store are loaded instead of re-encoded, so the
+        # model is only loaded (and run) for the misses
+        texts = list(texts)
+        # Imported here: api.embedding_store imports this module
+        from api.embedding_store import embedding_store_enabled, get_embedding_store
+        if not embedding_store_enabled() or not texts:
+            return self.encode(texts, batch_size)
+        embeddings, missing = get_embedding_store(self.store_key).lookup(texts)
+        if embeddings is None:
+            return self.encode(texts, batch_size)
+        if missing:
+            embeddings[missing] = self.encode([texts[i] for i in missing], batch_size)
+        logger.info("Reused %s of %s chunk embeddings from the embedding store", len(texts) - len(missing), len(texts))
+        return embeddings
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def encode_query(self, text, timeout=None):
+        self._ensure_batcher()
+        future = Future()
+        self._queue.put((text, future))
+        return future.result(timeout=timeout)
+
+    async def aencode_query(self, text):
+        # Same micro-batcher, awaited without pinning a thread per in-flight request
+        self._ensure_batcher()
+        future = Future()
+        self._queue.put((text, future))
+        return await asyncio.wrap_future(future)
+
+    def _ensure_batcher(self):
+        if self._batcher is None:
+            with self._batcher_lock:
+                if self._batcher is None:
+                    thread = threading.Thread(target=self._run_batcher, name='embedding-batcher', daemon=True)
+                    thread.start()
+                    self._batcher = thread
+
+    def _run_batcher(self):
+        while True:
+            pending = [self._queue.get()]
+            # Collect whatever else arrives within the wait window, up to max_batch
+            deadline = time.monotonic() + self.max_wait
+            while len(pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            texts = [text for text, _ in pending]
+            try:
+                vectors = self.backend.encode(texts, len(texts))
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            for (_, future), vector in zip(pending, vectors):
+                future.set_result(vector)
+
+_service = None
+_service_lock = threading.Lock()
+
+def get_embedding_service():
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = EmbeddingService(
+                    settings.EMBEDDING_MODEL,
+                    backend=settings.EMBEDDING_BACKEND,
+                    max_batch=settings.EMBEDDING_QUERY_MAX_BATCH,
+                    max_wait_ms=settings.EMBEDDING_QUERY_MAX_WAIT_MS,
+                )
+    return _service
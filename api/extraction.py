@@ -0,0 +1,75 @@
+import logging
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import pdfplumber
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_size = 1
+_pool_lock = threading.Lock()
+
+def _extract_range(file_path, first_page, last_page):
+    # Runs in a pool process; opens only the requested 1-based page range
+    with pdfplumber.open(file_path, pages=list(range(first_page, last_page + 1))) as pdf:
+        pages = []
+        for page in pdf.pages:
+            pages.append((page.page_number, page.extract_text() or ""))
+            page.flush_cache()
+        return pages
+
+def _parse_workers():
+    return settings.PDF_PARSE_WORKERS or os.cpu_count() or 1
+
+def _get_pool():
+    global _pool, _pool_size
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                workers = _parse_workers()
+                _pool_size = workers
+                # spawn, not fork: the web/worker process is multi-threaded and holds DB connections
+                _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+                logger.info("Started PDF parse pool with %s processes", workers)
+    return _pool
+
+def page_count(file_path):
+    with pdfplumber.open(file_path) as pdf:
+        return len(pdf.pages)
+
+# Yields (page_number, page_count, text) in page order without holding the whole document.
+# Large PDFs are split into page ranges parsed across a process pool.
+def iter_pages(file_path, parallel=None):
+    total = page_count(file_path)
+    if parallel is None:
+        parallel = total >= settings.PDF_PARALLEL_MIN_PAGES and _parse_workers() > 1
+
+    if not parallel:
+        with pdfplumber.open(file_path) as pdf:
+            for page in pdf.pages:
+                yield page.page_number, total, page.extract_text() or ""
+                # pdfplumber caches parsed layout objects per page; drop them to keep memory flat
+                page.flush_cache()
+        return
+
+    pool = _get_pool()
+    step = settings.PDF_PAGES_PER_TASK
+    ranges = deque((first, min(first + step - 1, total)) for first in range(1, total + 1, step))
+    # Bounded look-ahead: only a few ranges are parsed ahead of the consumer
+    max_in_flight = _pool_size * 2
+    in_flight = deque()
+    try:
+        while ranges or in_flight:
+            while ranges and len(in_flight) < max_in_flight:
+                first, last = ranges.popleft()
+                in_flight.append(pool.submit(_extract_range, file_path, first, last))
+            for page_number, text in in_flight.popleft().result():
+                yield page_number, total, text
+    finally:
+        # Consumer stopped early or parsing failed; don't leave queued ranges behind
+        for future in in_flight:
+            future.cancel()
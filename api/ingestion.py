@@ -0,0 +1,211 @@
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from .models import IngestionJob
+from .utils import process_document
+
+logger = logging.getLogger(__name__)
+
+# In-process worker pool state (used when INGESTION_WORKERS > 0 in the web process)
+_workers = []
+_workers_lock = threading.Lock()
+_wakeup = threading.Event()
+
+class JobLost(Exception):
+    # The job was reclaimed by another worker (this one looked stale) while it was running
+    pass
+
+def save_owned(job, **fields):
+    # Writes only while this worker still owns the job: a reclaiming worker sets its own
+    # worker id and started_at, so the original worker can no longer overwrite the row
+    return IngestionJob.objects.filter(id=job.id, worker=job.worker, started_at=job.started_at).update(
+        updated_at=timezone.now(), **fields,
+    ) > 0
+
+# Progress callback handed to process_document; records stage, progress and per-stage timings.
+# Every save also refreshes updated_at, the heartbeat claim_next_job uses to spot dead workers.
+class JobReporter:
+    def __init__(self, job, min_step=0.05, heartbeat=None):
+        self.job = job
+        self.min_step = min_step
+        # Well inside INGESTION_JOB_TIMEOUT, so a long embed or store is never taken for stale
+        self.heartbeat = heartbeat if heartbeat is not None else max(settings.INGESTION_JOB_TIMEOUT / 10, 1.0)
+        self._stage = None
+        self._stage_start = None
+        self._saved_progress = job.progress
+        self._saved_at = time.monotonic()
+
+    def __call__(self, stage, progress=None):
+        now = time.monotonic()
+        changed = stage != self._stage
+        first_seen = stage not in self.job.stage_timings
+        if changed:
+            self._close_stage(now)
+            self._stage = stage
+            self._stage_start = now
+            self.job.stage = stage
+            self.job.stage_timings.setdefault(stage, 0.0)
+        if progress is not None:
+            self.job.progress = round(min(max(progress, 0.0), 1.0), 3)
+        # Stages interleave while pages stream through the pipeline, so avoid a DB write per
+        # switch; persist new stages, meaningful progress steps and heartbeats only
+        if first_seen or abs(self.job.progress - self._saved_progress) >= self.min_step or now - self._saved_at >= self.heartbeat:
+            self._saved_progress = self.job.progress
+            self._saved_at = now
+            if not save_owned(self.job, stage=self.job.stage, progress=self.job.progress, stage_timings=self.job.stage_timings):
+                raise JobLost(f"Ingestion job {self.job.id} was reclaimed by another worker")
+
+    def finish(self):
+        self._close_stage(time.monotonic())
+        self._stage = None
+
+    def _close_stage(self, now):
+        # Timings accumulate across every interval spent in a stage
+        if self._stage is not None:
+            elapsed = now - self._stage_start
+            self.job.stage_timings[self._stage] = round(self.job.stage_timings.get(self._stage, 0.0) + elapsed, 3)
+
+def enqueue_document(document, max_attempts=None):
+    # A job that has not started yet will pick up the latest file anyway
+    pending = document.ingestion_jobs.filter(status=IngestionJob.STATUS_QUEUED).order_by('-id').first()
+    if pending is not None:
+        return pending
+    job = IngestionJob.objects.create(
+        document=document,
+        max_attempts=max_attempts or settings.INGESTION_MAX_ATTEMPTS,
+    )
+    logger.info("Queued ingestion job %s for document %s", job.id, document.id)
+    transaction.on_commit(_notify_workers)
+    return job
+
+def retry_delay(attempts):
+    base = settings.INGESTION_RETRY_BACKOFF * (2 ** max(attempts - 1, 0))
+    delay = min(base, settings.INGESTION_RETRY_BACKOFF_MAX)
+    # Jitter so jobs that failed together do not retry in lockstep
+    return delay * random.uniform(0.8, 1.2)
+
+def claim_next_job(worker_id):
+    now = timezone.now()
+    stale_before = now - timedelta(seconds=settings.INGESTION_JOB_TIMEOUT)
+    candidates = (
+        IngestionJob.objects
+        .filter(
+            Q(status=IngestionJob.STATUS_QUEUED, next_run_at__lte=now)
+            | Q(status=IngestionJob.STATUS_RUNNING, updated_at__lt=stale_before)
+        )
+        .order_by('next_run_at', 'id')
+        .values_list('id', 'status', 'updated_at', 'attempts', 'max_attempts')[:5]
+    )
+    for job_id, job_status, updated_at, attempts, max_attempts in candidates:
+        # Conditional updates act as a compare-and-swap, so concurrent workers never claim the same row
+        current = IngestionJob.objects.filter(id=job_id, status=job_status, updated_at=updated_at)
+        if job_status == IngestionJob.STATUS_RUNNING and attempts >= max_attempts:
+            # Its worker died (or hung) on the last attempt: give up instead of running it again
+            if current.update(
+                status=IngestionJob.STATUS_FAILED, finished_at=now, updated_at=now,
+                error=f"Worker stopped responding on attempt {attempts}/{max_attempts}",
+            ):
+                logger.error("Ingestion job %s timed out on its last attempt", job_id)
+            continue
+        claimed = current.update(
+            status=IngestionJob.STATUS_RUNNING,
+            worker=worker_id,
+            started_at=now,
+            updated_at=now,
+            stage='starting',
+            progress=0.0,
+            stage_timings={},
+            attempts=F('attempts') + 1,
+        )
+        if claimed:
+            return IngestionJob.objects.select_related('document').get(id=job_id)
+    return None
+
+def run_job(job):
+    reporter = JobReporter(job)
+    logger.info("Worker %s running ingestion job %s (attempt %s/%s)", job.worker, job.id, job.attempts, job.max_attempts)
+    try:
+        process_document(job.document_id, progress=reporter)
+    except JobLost as e:
+        logger.warning("%s; dropping this run", str(e))
+        return job
+    except Exception as e:
+        reporter.finish()
+        job.error = str(e)
+        if job.attempts >= job.max_attempts:
+            job.status = IngestionJob.STATUS_FAILED
+            job.finished_at = timezone.now()
+            logger.error("Ingestion job %s failed permanently: %s", job.id, str(e))
+        else:
+            delay = retry_delay(job.attempts)
+            job.status = IngestionJob.STATUS_QUEUED
+            job.next_run_at = timezone.now() + timedelta(seconds=delay)
+            logger.warning("Ingestion job %s failed, retrying in %.1f seconds: %s", job.id, delay, str(e))
+        _save_result(job, 'next_run_at')
+        return job
+
+    reporter.finish()
+    job.status = IngestionJob.STATUS_SUCCEEDED
+    job.stage = 'done'
+    job.progress = 1.0
+    job.error = ''
+    job.finished_at = timezone.now()
+    if _save_result(job):
+        logger.info("Ingestion job %s succeeded in %s", job.id, job.stage_timings)
+    return job
+
+def _save_result(job, *extra_fields):
+    fields = ('status', 'stage', 'progress', 'stage_timings', 'error', 'finished_at') + extra_fields
+    if save_owned(job, **{field: getattr(job, field) for field in fields}):
+        return True
+    logger.warning("Ingestion job %s was reclaimed by another worker; not recording this run's result", job.id)
+    return False
+
+def work(worker_id, stop_event, poll_interval=None):
+    poll_interval = poll_interval or settings.INGESTION_POLL_INTERVAL
+    while not stop_event.is_set():
+        job = None
+        try:
+            job = claim_next_job(worker_id)
+            if job is not None:
+                run_job(job)
+        except Exception:
+            logger.exception("Ingestion worker %s crashed while handling a job", worker_id)
+        finally:
+            close_old_connections()
+        if job is None:
+            _wakeup.wait(poll_interval)
+            _wakeup.clear()
+
+def worker_name(index):
+    return f"{socket.gethostname()}:{os.getpid()}:{index}"
+
+def start_background_workers(count=None):
+    count = settings.INGESTION_WORKERS if count is None else count
+    with _workers_lock:
+        if _workers or count <= 0:
+            return _workers
+        stop_event = threading.Event()
+        for index in range(count):
+            thread = threading.Thread(
+                target=work,
+                args=(worker_name(index), stop_event),
+                name=f"ingestion-worker-{index}",
+                daemon=True,
+            )
+            thread.start()
+            _workers.append(thread)
+        logger.info("Started %s in-process ingestion workers", count)
+    return _workers
+
+def _notify_workers():
+    start_background_workers()
+    _wakeup.set()
@@ -0,0 +1,239 @@
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, close_old_connections, connection, transaction
+from api.metrics import INTERACTION_LOG_FLUSH_SECONDS, INTERACTION_LOG_WRITE_FAILURES
+from api.models import InteractionLog
+
+logger = logging.getLogger(__name__)
+
+class IdAllocator:
+    # Hands out primary keys from blocks reserved on the table's own autoincrement sequence
+    # (hi/lo), so a buffered row has its id before it is written and can never collide
+    # with rows inserted directly with create(). Unused ids of a block are simply skipped.
+    VENDORS = ('sqlite', 'postgresql')
+
+    def __init__(self, model, block_size):
+        self.table = model._meta.db_table
+        self.pk_column = model._meta.pk.column
+        self.block_size = block_size
+        self._ids = deque()
+        self._lock = threading.Lock()
+
+    def allocate(self):
+        with self._lock:
+            if not self._ids:
+                self._ids.extend(self._reserve(self.block_size))
+            return self._ids.popleft()
+
+    def high_water(self):
+        # Largest id handed out to any process so far (0 before the first reservation)
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute("SELECT pg_get_serial_sequence(%s, %s)", [self.table, self.pk_column])
+                sequence = cursor.fetchone()[0]
+                cursor.execute(f"SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM {sequence}")
+            else:
+                cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [self.table])
+            row = cursor.fetchone()
+        return row[0] if row else 0
+
+    def _reserve(self, count):
+        quote = connection.ops.quote_name
+        with transaction.atomic(), connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # Values from one statement need not be contiguous under concurrency
+                cursor.execute(
+                    "SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)",
+                    [self.table, self.pk_column, count],
+                )
+                return [row[0] for row in cursor.fetchall()]
+            # SQLite AUTOINCREMENT keeps the high-water mark in sqlite_sequence; the UPDATE
+            # takes the write lock, so concurrent reservations serialise
+            cursor.execute("UPDATE sqlite_sequence SET seq = seq + %s WHERE name = %s", [count, self.table])
+            if cursor.rowcount == 0:
+                cursor.execute(
+                    f"INSERT INTO sqlite_sequence (name, seq) SELECT %s, COALESCE(MAX({quote(self.pk_column)}), 0) + %s FROM {quote(self.table)}",
+                    [self.table, count],
+                )
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [self.table])
+            end = cursor.fetchone()[0]
+        return range(end - count + 1, end + 1)
+
+class InteractionLogWriter:
+    # Buffers InteractionLog rows in memory and writes them with bulk_create from a
+    # background thread, every INTERACTION_LOG_FLUSH_INTERVAL seconds or as soon as
+    # INTERACTION_LOG_BATCH_SIZE rows are waiting. If the buffer reaches
+    # INTERACTION_LOG_MAX_QUEUE (database down or very slow) the logging request flushes
+    # itself. The remaining rows are written at interpreter exit.
+    def __init__(self, batch_size, flush_interval, max_queue, id_block):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.allocator = IdAllocator(InteractionLog, id_block)
+        self._pending = []
+        self._pending_ids = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def log(self, user, question, answer, sources):
+        # Returns the unsaved instance; its id is final and can be handed to the client
+        interaction = InteractionLog(
+            id=self.allocator.allocate(), user_id=user.pk, question=question, answer=answer, sources=sources,
+        )
+        with self._lock:
+            self._pending.append(interaction)
+            self._pending_ids.add(interaction.id)
+            waiting = len(self._pending)
+        self._start()
+        if waiting >= self.max_queue:
+            self.flush()
+        elif waiting >= self.batch_size:
+            self._wakeup.set()
+        return interaction
+
+    def queue_depth(self):
+        return len(self._pending)
+
+    def ensure_written(self, interaction_id):
+        # Readers that need the row (text-to-speech) flush it first if it is still buffered
+        with self._lock:
+            pending = interaction_id in self._pending_ids
+        if pending:
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            start = time.perf_counter()
+            try:
+                written = self._write(batch)
+            finally:
+                INTERACTION_LOG_FLUSH_SECONDS.observe(time.perf_counter() - start)
+            return written
+
+    def _write(self, batch):
+        try:
+            # timestamp (auto_now_add) is set here, at most one flush interval late
+            InteractionLog.objects.bulk_create(batch, batch_size=500)
+        except IntegrityError:
+            # A bad row (e.g. its user was deleted meanwhile) must not sink the whole batch
+            return self._write_rows(batch)
+        except DatabaseError as e:
+            # Database unavailable or locked: keep the rows for the next flush, within bounds
+            INTERACTION_LOG_WRITE_FAILURES.inc(result='retried')
+            logger.error("Interaction log flush of %s rows failed, will retry: %s", len(batch), str(e))
+            with self._lock:
+                keep = max(self.max_queue * 2 - len(self._pending), 0)
+                dropped = batch[keep:]
+                self._pending[:0] = batch[:keep]
+                self._pending_ids.difference_update(row.id for row in dropped)
+            if dropped:
+                INTERACTION_LOG_WRITE_FAILURES.inc(len(dropped), result='dropped')
+                logger.error("Dropped %s interaction log rows after repeated failures", len(dropped))
+            return 0
+        self._done(batch)
+        return len(batch)
+
+    def _write_rows(self, batch):
+        written = 0
+        for row in batch:
+            try:
+                with transaction.atomic():
+                    row.save(force_insert=True)
+                written += 1
+            except DatabaseError as e:
+                INTERACTION_LOG_WRITE_FAILURES.inc(result='dropped')
+                logger.error("Dropped interaction log row %s: %s", row.id, str(e))
+        self._done(batch)
+        return written
+
+    def _done(self, batch):
+        with self._lock:
+            self._pending_ids.difference_update(row.id for row in batch)
+
+    def _start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='interaction-log-writer', daemon=True)
+                    self._thread.start()
+                    atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Interaction log writer error: %s", str(e))
+            finally:
+                close_old_connections()
+        connection.close()
+
+    def stop(self, timeout=10):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_interaction_log_writer():
+    # None when buffering is off or the database cannot reserve ids (writes stay synchronous)
+    global _writer
+    if not settings.INTERACTION_LOG_BUFFERED or connection.vendor not in IdAllocator.VENDORS:
+        return None
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = InteractionLogWriter(
+                    batch_size=settings.INTERACTION_LOG_BATCH_SIZE,
+                    flush_interval=settings.INTERACTION_LOG_FLUSH_INTERVAL,
+                    max_queue=settings.INTERACTION_LOG_MAX_QUEUE,
+                    id_block=settings.INTERACTION_LOG_ID_BLOCK,
+                )
+    return _writer
+
+def log_interaction(user, question, answer, sources):
+    writer = get_interaction_log_writer()
+    if writer is None:
+        return InteractionLog.objects.create(user=user, question=question, answer=answer, sources=sources)
+    return writer.log(user, question, answer, sources)
+
+def ensure_interaction_written(interaction_id):
+    if _writer is not None:
+        _writer.ensure_written(interaction_id)
+
+def get_logged_interaction(interaction_id, user):
+    # For readers that need the row right after the answer (text-to-speech). A row still
+    # buffered here is flushed; one buffered by another worker process is waited for, for up
+    # to two flush intervals, as long as its id has been reserved. Raises DoesNotExist.
+    ensure_interaction_written(interaction_id)
+    writer = get_interaction_log_writer()
+    deadline = time.monotonic() + 2 * settings.INTERACTION_LOG_FLUSH_INTERVAL
+    while True:
+        interaction = InteractionLog.objects.filter(id=interaction_id).first()
+        if interaction is not None:
+            if interaction.user_id != user.pk:
+                raise InteractionLog.DoesNotExist
+            return interaction
+        if writer is None or time.monotonic() >= deadline or interaction_id > writer.allocator.high_water():
+            raise InteractionLog.DoesNotExist
+        time.sleep(0.05)
+
+def flush_interaction_log():
+    if _writer is not None:
+        _writer.flush()
@@ -0,0 +1,242 @@
+import logging
+import math
+import os
+import pickle
+import re
+import threading
+import time
+from collections import Counter
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+TOKEN_RE = re.compile(r'\w+')
+STOPWORDS = frozenset(
+    'a an and are as at be but by for from has have in is it its of on or that the this to was were '
+    'what when where which who why will with how do does can you your i'.split()
+)
+
+def tokenize(text):
+    return [token for token in TOKEN_RE.findall(text.lower()) if token not in STOPWORDS]
+
+class Segment:
+    # One document's chunks with their postings, built once when the document is indexed
+    # and stored as is, so loading a segment written by another process is just unpickling
+    def __init__(self, chunks, lengths, postings):
+        self.chunks = chunks
+        self.lengths = lengths
+        self.postings = postings
+        self.total_length = float(lengths.sum())
+
+    @classmethod
+    def build(cls, chunks):
+        items = []
+        lengths = []
+        postings = {}
+        for row, chunk in enumerate(chunks):
+            terms = Counter(tokenize(chunk['text']))
+            items.append((chunk['id'], chunk['text'], chunk['metadata']))
+            lengths.append(sum(terms.values()))
+            for term, tf in terms.items():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(row)
+                postings[term][1].append(tf)
+        return cls(items, np.asarray(lengths, dtype=np.float32), {
+            term: (np.asarray(rows, dtype=np.int32), np.asarray(tfs, dtype=np.float32))
+            for term, (rows, tfs) in postings.items()
+        })
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        if isinstance(data, list):
+            # Written before postings were stored: (id, terms, length, text, metadata) rows
+            segment = cls.build([{'id': row[0], 'text': row[3], 'metadata': row[4]} for row in data])
+        else:
+            segment = cls(data['chunks'], data['lengths'], data['postings'])
+        return segment
+
+    def dump(self, f):
+        pickle.dump({'chunks': self.chunks, 'lengths': self.lengths, 'postings': self.postings}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+class KeywordIndex:
+    # BM25 over chunk text. Each document's chunks and postings are persisted as one segment
+    # file, so ingestion adds or replaces a single segment and cost is proportional to that
+    # document. Corpus statistics and a term -> segments map are updated incrementally as
+    # segments come and go; a query concatenates the postings of its own terms only (cached
+    # per term until a segment holding that term changes), so no step costs O(corpus).
+    def __init__(self, path, k1=1.2, b=0.75):
+        self.path = str(path)
+        self.k1 = k1
+        self.b = b
+        self._segments = {}
+        self._segment_mtimes = {}
+        self._term_documents = {}
+        self._term_postings = {}
+        self._count = 0
+        self._total_length = 0.0
+        self._dir_mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.RLock()
+
+    def _segment_path(self, document_id):
+        return os.path.join(self.path, f"doc-{document_id}.pkl")
+
+    def add_document(self, document_id, chunks):
+        # chunks: iterable of {"id", "text", "metadata"} dicts
+        segment = Segment.build(chunks)
+        os.makedirs(self.path, exist_ok=True)
+        target = self._segment_path(document_id)
+        tmp = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            segment.dump(f)
+        os.replace(tmp, target)
+        with self._lock:
+            self._put(document_id, segment)
+            self._segment_mtimes[document_id] = os.stat(target).st_mtime_ns
+
+    def remove_document(self, document_id):
+        try:
+            os.remove(self._segment_path(document_id))
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self._drop(document_id)
+            self._segment_mtimes.pop(document_id, None)
+
+    def _put(self, document_id, segment):
+        self._drop(document_id)
+        self._segments[document_id] = segment
+        self._count += len(segment.chunks)
+        self._total_length += segment.total_length
+        for term in segment.postings:
+            self._term_documents.setdefault(term, set()).add(document_id)
+            self._term_postings.pop(term, None)
+
+    def _drop(self, document_id):
+        segment = self._segments.pop(document_id, None)
+        if segment is None:
+            return
+        self._count -= len(segment.chunks)
+        self._total_length -= segment.total_length
+        for term in segment.postings:
+            documents = self._term_documents.get(term)
+            if documents is not None:
+                documents.discard(document_id)
+                if not documents:
+                    del self._term_documents[term]
+            self._term_postings.pop(term, None)
+
+    def refresh(self, force=False):
+        # Other processes (ingestion workers) write segments; pick up changes at most once a second
+        now = time.monotonic()
+        if not force and now - self._checked_at < 1.0:
+            return
+        self._checked_at = now
+        try:
+            dir_mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if not force and dir_mtime == self._dir_mtime:
+                return
+            self._dir_mtime = dir_mtime
+            on_disk = {}
+            for name in os.listdir(self.path):
+                if name.startswith('doc-') and name.endswith('.pkl'):
+                    document_id = int(name[4:-4])
+                    on_disk[document_id] = os.stat(os.path.join(self.path, name)).st_mtime_ns
+            for document_id in set(self._segments) - set(on_disk):
+                self._drop(document_id)
+                self._segment_mtimes.pop(document_id, None)
+            for document_id, mtime in on_disk.items():
+                if self._segment_mtimes.get(document_id) != mtime:
+                    try:
+                        segment = Segment.load(self._segment_path(document_id))
+                    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+                        continue
+                    self._put(document_id, segment)
+                    self._segment_mtimes[document_id] = mtime
+
+    def _postings(self, term):
+        # (document ids, rows, term frequencies, chunk lengths) of every chunk containing term,
+        # plus the segments they point into
+        postings = self._term_postings.get(term)
+        if postings is None:
+            document_ids, rows, tfs, lengths = [], [], [], []
+            owners = {}
+            for document_id in self._term_documents.get(term, ()):
+                segment = owners[document_id] = self._segments[document_id]
+                term_rows, term_tfs = segment.postings[term]
+                document_ids.append(np.full(len(term_rows), document_id, dtype=np.int64))
+                rows.append(term_rows)
+                tfs.append(term_tfs)
+                lengths.append(segment.lengths[term_rows])
+            postings = self._term_postings[term] = tuple(
+                np.concatenate(parts) if parts else np.empty(0, dtype=dtype)
+                for parts, dtype in ((document_ids, np.int64), (rows, np.int32), (tfs, np.float32), (lengths, np.float32))
+            ) + (owners,)
+        return postings
+
+    def search(self, query, k=10, document_ids=None):
+        self.refresh()
+        with self._lock:
+            terms = [term for term in set(tokenize(query)) if term in self._term_documents]
+            if not terms or not self._count:
+                return []
+            count = self._count
+            avg_length = self._total_length / count
+            postings = [self._postings(term) for term in terms]
+        # Scored outside the lock against the segments the postings were built from, so a
+        # document replaced meanwhile cannot shift rows under this query
+        keys, weights = [], []
+        for term_documents, rows, tfs, lengths, _ in postings:
+            idf = math.log(1 + (count - len(rows) + 0.5) / (len(rows) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * lengths / avg_length)
+            weight = idf * tfs * (self.k1 + 1) / (tfs + norm)
+            if document_ids:
+                keep = np.isin(term_documents, list(document_ids))
+                term_documents, rows, weight = term_documents[keep], rows[keep], weight[keep]
+            # One int64 key per (document, row) so scores add up across terms
+            keys.append((term_documents << 32) | rows.astype(np.int64))
+            weights.append(weight)
+        keys = np.concatenate(keys)
+        if not len(keys):
+            return []
+        keys, inverse = np.unique(keys, return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(weights))
+        top = np.arange(len(scores))
+        if len(top) > k:
+            top = np.argpartition(-scores, k)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        results = []
+        for index in top:
+            key = int(keys[index])
+            segment = next(owners[key >> 32] for *_, owners in postings if key >> 32 in owners)
+            chunk_id, text, metadata = segment.chunks[key & 0xFFFFFFFF]
+            results.append({"id": chunk_id, "text": text, "metadata": metadata, "distance": None, "bm25": float(scores[index])})
+        return results
+
+def reciprocal_rank_fusion(result_lists, k=60, limit=None):
+    # Standard RRF: score(d) = sum over lists of 1 / (k + rank); keeps the first copy of each chunk
+    fused = {}
+    scores = Counter()
+    for results in result_lists:
+        for rank, result in enumerate(results, 1):
+            fused.setdefault(result['id'], result)
+            scores[result['id']] += 1.0 / (k + rank)
+    ranked = [fused[chunk_id] for chunk_id, _ in scores.most_common(limit)]
+    return ranked
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_keyword_index():
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = KeywordIndex(settings.KEYWORD_INDEX_DIR)
+    return _index
@@ -1,22 +1,403 @@
+import asyncio
+import logging
 import os
-import google.generativeai as genai
+import random
+import threading
+import time
 from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+class LLMError(Exception):
+    pass
+
+class LLMBusyError(LLMError):
+    # Concurrency limit reached and no slot freed up before the deadline
+    pass
+
+class CircuitOpenError(LLMError):
+    pass
+
+PROMPT_TEMPLATE = (
+    "You are a knowledge assistant. Answer the question using only the context below and do not add "
+    "information beyond it. If the context doesn't contain enough information, say so.\n\n"
+    "Context:\n{context}\n\n"
+    "Question: {question}\n\n"
+    "Answer concisely and accurately."
+)
+
+def build_prompt(question, context):
+    return PROMPT_TEMPLATE.format(context=context, question=question)
+
+class LLMBackend:
+    # A backend turns a prompt into text. Deadlines, concurrency, retries and the circuit
+    # breaker live in LLMClient, so backends only implement the raw calls.
+    def generate(self, prompt, timeout):
+        raise NotImplementedError
+
+    def stream(self, prompt, timeout):
+        yield self.generate(prompt, timeout)
+
+    async def agenerate(self, prompt, timeout):
+        return await asyncio.to_thread(self.generate, prompt, timeout)
+
+    async def astream(self, prompt, timeout):
+        yield await self.agenerate(prompt, timeout)
+
+    def is_retryable(self, exc):
+        return isinstance(exc, (TimeoutError, ConnectionError))
+
+class GeminiBackend(LLMBackend):
+    def __init__(self):
+        import google.generativeai as genai
+        from google.api_core import exceptions as google_exceptions
+        # Configured once per process; the model object and its gRPC channel are reused
+        genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
+        self.model = genai.GenerativeModel(
+            settings.LLM_MODEL,
+            generation_config={
+                'temperature': settings.LLM_TEMPERATURE,
+                'max_output_tokens': settings.LLM_MAX_OUTPUT_TOKENS,
+            },
+        )
+        self.retryable_errors = (
+            TimeoutError,
+            ConnectionError,
+            google_exceptions.DeadlineExceeded,
+            google_exceptions.ServiceUnavailable,
+            google_exceptions.ResourceExhausted,
+            google_exceptions.InternalServerError,
+        )
+
+    def is_retryable(self, exc):
+        return isinstance(exc, self.retryable_errors)
+
+    def _request_options(self, timeout):
+        # Retries are handled by LLMClient; disable the SDK's own so deadlines hold
+        return {'timeout': timeout, 'retry': None}
+
+    def generate(self, prompt, timeout):
+        return self.model.generate_content(prompt, request_options=self._request_options(timeout)).text
+
+    def stream(self, prompt, timeout):
+        for chunk in self.model.generate_content(prompt, stream=True, request_options=self._request_options(timeout)):
+            # Chunks without text (e.g. safety metadata) raise on .text
+            text = chunk.text if chunk.parts else ''
+            if text:
+                yield text
+
+    async def agenerate(self, prompt, timeout):
+        response = await self.model.generate_content_async(prompt, request_options=self._request_options(timeout))
+        return response.text
+
+    async def astream(self, prompt, timeout):
+        response = await self.model.generate_content_async(prompt, stream=True, request_options=self._request_options(timeout))
+        async for chunk in response:
+            text = chunk.text if chunk.parts else ''
+            if text:
+                yield text
+
+class EchoBackend(LLMBackend):
+    # Deterministic offline backend for tests and load tests: echoes the start of the context.
+    # LLM_FAKE_TOKEN_DELAY simulates generation latency per token.
+    def _pieces(self, prompt):
+        context = prompt.split('Context:', 1)[-1].split('Question:', 1)[0]
+        words = f"Based on the provided context: {' '.join(context.split()[:40])}".split()
+        for index, word in enumerate(words):
+            yield word if index == 0 else f" {word}"
+
+    def generate(self, prompt, timeout):
+        return ''.join(self.stream(prompt, timeout))
+
+    def stream(self, prompt, timeout):
+        for piece in self._pieces(prompt):
+            if settings.LLM_FAKE_TOKEN_DELAY:
+                time.sleep(settings.LLM_FAKE_TOKEN_DELAY)
+            yield piece
+
+    async def agenerate(self, prompt, timeout):
+        return ''.join([piece async for piece in self.astream(prompt, timeout)])
+
+    async def astream(self, prompt, timeout):
+        for piece in self._pieces(prompt):
+            if settings.LLM_FAKE_TOKEN_DELAY:
+                await asyncio.sleep(settings.LLM_FAKE_TOKEN_DELAY)
+            yield piece
+
+BACKENDS = {
+    'gemini': GeminiBackend,
+    'echo': EchoBackend,
+    'fake': EchoBackend,
+}
+
+class CircuitBreaker:
+    # Opens after `failure_threshold` consecutive failures and rejects calls for
+    # `reset_timeout` seconds, then lets a single trial call through (half-open).
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def before_call(self):
+        # Returns True when this call is the half-open trial; the caller must pass that to
+        # end_call() on every exit path
+        with self._lock:
+            state = self._state()
+            if state == 'open' or (state == 'half-open' and self._trial_in_flight):
+                raise CircuitOpenError("LLM backend is unavailable (circuit open)")
+            if state == 'half-open':
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def end_call(self, trial):
+        # A trial that ended without a recorded result (e.g. a stream closed by the client)
+        # lets the next call try instead of keeping the circuit half-open forever
+        if trial:
+            with self._lock:
+                self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                logger.warning("LLM circuit opened after %s consecutive failures", self.failures)
+
+class LLMClient:
+    def __init__(self, backend, timeout, max_concurrency, max_retries, retry_backoff, breaker):
+        self.backend = backend
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.breaker = breaker
+        # One semaphore for the sync and async paths so max_concurrency caps every call in
+        # the process, whichever thread or event loop it runs on
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+
+    def _remaining(self, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("LLM deadline exceeded")
+        return remaining
+
+    def _backoff(self, attempt, deadline):
+        # Full jitter keeps simultaneous retries from hitting the upstream in lockstep
+        delay = random.uniform(0, self.retry_backoff * (2 ** attempt))
+        return min(delay, max(deadline - time.monotonic(), 0))
+
+    def _record_error(self, exc):
+        # Only upstream/transport failures count towards opening the circuit. Any other error
+        # (a rejected prompt, a bug in our code) says nothing about the backend's health, so
+        # the breaker is left as it was; end_call() still frees a half-open trial slot.
+        if self.backend.is_retryable(exc):
+            self.breaker.record_failure()
+
+    def _should_retry(self, exc, attempt):
+        return attempt < self.max_retries and self.backend.is_retryable(exc)
+
+    def _track(self, delta):
+        with self._in_flight_lock:
+            self._in_flight += delta
+
+    def in_flight(self):
+        return self._in_flight
+
+    def _acquire(self, deadline):
+        if not self._slots.acquire(timeout=self._remaining(deadline)):
+            raise LLMBusyError("Too many concurrent LLM requests")
+        self._track(1)
+
+    def _start_call(self):
+        # The breaker is consulted only once a slot is held, so a call that never gets one
+        # cannot leave a half-open trial pending
+        try:
+            return self.breaker.before_call()
+        except CircuitOpenError:
+            self._release()
+            raise
+
+    def _end_call(self, trial):
+        self._release()
+        self.breaker.end_call(trial)
+
+    def _release(self):
+        self._track(-1)
+        self._slots.release()
+
+    async def _aacquire(self, deadline):
+        # Waiting for the threading semaphore happens in a worker thread so the event loop
+        # keeps running; the free-slot case is taken without a thread hop
+        acquired = self._slots.acquire(blocking=False)
+        if not acquired:
+            waiter = asyncio.ensure_future(asyncio.to_thread(self._slots.acquire, timeout=self._remaining(deadline)))
+            try:
+                acquired = await asyncio.shield(waiter)
+            except asyncio.CancelledError:
+                # The thread cannot be interrupted; hand back the slot if it still gets one
+                waiter.add_done_callback(self._release_abandoned)
+                raise
+        if not acquired:
+            raise LLMBusyError("Too many concurrent LLM requests")
+        self._track(1)
+
+    def _release_abandoned(self, waiter):
+        if not waiter.cancelled() and waiter.exception() is None and waiter.result():
+            self._slots.release()
+
+    def generate(self, question, context, timeout=None):
+        prompt = build_prompt(question, context)
+        deadline = time.monotonic() + (timeout or self.timeout)
+        attempt = 0
+        while True:
+            self._acquire(deadline)
+            trial = self._start_call()
+            try:
+                text = self.backend.generate(prompt, self._remaining(deadline))
+            except Exception as e:
+                self._record_error(e)
+                if not self._should_retry(e, attempt):
+                    raise
+                logger.warning("LLM call failed (attempt %s), retrying: %s", attempt + 1, str(e))
+            else:
+                self.breaker.record_success()
+                return text
+            finally:
+                self._end_call(trial)
+            time.sleep(self._backoff(attempt, deadline))
+            attempt += 1
+
+    def stream(self, question, context, timeout=None):
+        prompt = build_prompt(question, context)
+        deadline = time.monotonic() + (timeout or self.timeout)
+        attempt = 0
+        while True:
+            self._acquire(deadline)
+            trial = self._start_call()
+            started = False
+            try:
+                for piece in self.backend.stream(prompt, self._remaining(deadline)):
+                    started = True
+                    yield piece
+            except Exception as e:
+                self._record_error(e)
+                # Once tokens reached the client a retry would duplicate them
+                if started or not self._should_retry(e, attempt):
+                    raise
+                logger.warning("LLM stream failed (attempt %s), retrying: %s", attempt + 1, str(e))
+            else:
+                self.breaker.record_success()
+                return
+            finally:
+                self._end_call(trial)
+            time.sleep(self._backoff(attempt, deadline))
+            attempt += 1
+
+    async def agenerate(self, question, context, timeout=None):
+        prompt = build_prompt(question, context)
+        deadline = time.monotonic() + (timeout or self.timeout)
+        attempt = 0
+        while True:
+            await self._aacquire(deadline)
+            trial = self._start_call()
+            try:
+                remaining = self._remaining(deadline)
+                text = await asyncio.wait_for(self.backend.agenerate(prompt, remaining), remaining)
+            except Exception as e:
+                self._record_error(e)
+                if not self._should_retry(e, attempt):
+                    raise
+                logger.warning("LLM call failed (attempt %s), retrying: %s", attempt + 1, str(e))
+            else:
+                self.breaker.record_success()
+                return text
+            finally:
+                self._end_call(trial)
+            await asyncio.sleep(self._backoff(attempt, deadline))
+            attempt += 1
+
+    async def astream(self, question, context, timeout=None):
+        prompt = build_prompt(question, context)
+        deadline = time.monotonic() + (timeout or self.timeout)
+        attempt = 0
+        while True:
+            await self._aacquire(deadline)
+            trial = self._start_call()
+            started = False
+            try:
+                async for piece in self.backend.astream(prompt, self._remaining(deadline)):
+                    started = True
+                    yield piece
+            except Exception as e:
+                self._record_error(e)
+                if started or not self._should_retry(e, attempt):
+                    raise
+                logger.warning("LLM stream failed (attempt %s), retrying: %s", attempt + 1, str(e))
+            else:
+                self.breaker.record_success()
+                return
+            finally:
+                self._end_call(trial)
+            await asyncio.sleep(self._backoff(attempt, deadline))
+            attempt += 1
+
+_client = None
+_client_lock = threading.Lock()
+
+def _create_backend(name):
+    backend_class = BACKENDS.get(name) or import_string(name)
+    return backend_class()
+
+def get_llm_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = LLMClient(
+                    _create_backend(settings.LLM_BACKEND),
+                    timeout=settings.LLM_TIMEOUT,
+                    max_concurrency=settings.LLM_MAX_CONCURRENCY,
+                    max_retries=settings.LLM_MAX_RETRIES,
+                    retry_backoff=settings.LLM_RETRY_BACKOFF,
+                    breaker=CircuitBreaker(settings.LLM_CIRCUIT_FAILURES, settings.LLM_CIRCUIT_RESET),
+                )
+                logger.info("Initialised %s LLM backend", settings.LLM_BACKEND)
+    return _client
 
 def get_llm_response(question, context):
-    genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
-    model = genai.GenerativeModel('gemini-1.5-flash')
-    
-    prompt = f"""
-    You are a knowledge assistant. Answer the following question based solely on the provided context. Do not add information beyond the context. If the context doesn't contain enough information, say so.
-
-    Context:
-    {context}
-
-    Question:
-    {question}
-
-    Answer in a concise and accurate manner.
-    """
-    
-    response = model.generate_content(prompt)
-    return response.text
\ No newline at end of file
+    return get_llm_client().generate(question, context)
+
+def stream_llm_response(question, context):
+    return get_llm_client().stream(question, context)
+
+async def aget_llm_response(question, context):
+    return await get_llm_client().agenerate(question, context)
+
+def astream_llm_response(question, context):
+    return get_llm_client().astream(question, context)
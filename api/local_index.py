@@ -0,0 +1,517 @@
+import json
+import logging
+import math
+import os
+import pickle
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+import numpy as np
+from django.conf import settings
+from api.vectorstore import VectorStore
+
+try:
+    import fcntl
+except ImportError:  # Windows: publishers in separate processes are not serialised
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+POINTER = 'CURRENT'
+# Segments below this many live rows share the lowest merge tier
+TIER_FLOOR = 1024
+# Without process ids to check, unpublished segments older than this are crash leftovers
+ABANDONED_AFTER = 7 * 24 * 3600
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def assign(matrix, centroids, block=65536):
+    # Nearest centroid by cosine for every row, in blocks to bound the temporary score matrix
+    assignments = np.empty(len(matrix), dtype=np.int64)
+    for start in range(0, len(matrix), block):
+        assignments[start:start + block] = np.argmax(np.asarray(matrix[start:start + block]) @ centroids.T, axis=1)
+    return assignments
+
+def train_centroids(matrix, lists, iterations=10, sample_per_list=64, seed=0):
+    # Spherical k-means on a random sample of the rows
+    rng = np.random.default_rng(seed)
+    sample = lists * sample_per_list
+    if len(matrix) > sample:
+        rows = np.asarray(matrix[np.sort(rng.choice(len(matrix), sample, replace=False))], dtype=np.float32)
+    else:
+        rows = np.asarray(matrix, dtype=np.float32)
+    centroids = rows[rng.choice(len(rows), lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = assign(rows, centroids)
+        counts = np.bincount(assignments, minlength=lists)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        filled = counts > 0
+        sums = np.zeros_like(centroids)
+        sums[filled] = np.add.reduceat(rows[np.argsort(assignments, kind='stable')], starts[filled], axis=0)
+        # Empty lists restart from random rows
+        if not filled.all():
+            sums[~filled] = rows[rng.choice(len(rows), int((~filled).sum()))]
+        centroids = normalize(sums)
+    return centroids
+
+class Segment:
+    # One immutable directory of rows: unit-length float32 vectors and their document ids
+    # as memory-mapped .npy files, chunk ids/texts/metadata pickled alongside, and for IVF
+    # the centroids plus the offsets of each list (rows are stored grouped by list).
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.count = self.meta['count']
+        # Rows per document held in this segment
+        self.documents = {int(document_id): rows for document_id, rows in self.meta['documents'].items()}
+        self.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        self.document_ids = np.load(os.path.join(path, 'document_ids.npy'), mmap_mode='r')
+        with open(os.path.join(path, 'rows.pkl'), 'rb') as f:
+            self.ids, self.texts, self.metadatas = pickle.load(f)
+        self.centroids = self.offsets = None
+        if self.meta.get('lists'):
+            self.centroids = np.load(os.path.join(path, 'centroids.npy'))
+            self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        self._live_rows = {}
+
+    def live_rows(self, live):
+        # Row indexes of the given live documents, or None when every row is live.
+        # Cached per live set: it only changes when one of this segment's documents does.
+        if len(live) == len(self.documents):
+            return None
+        key = frozenset(live)
+        rows = self._live_rows.get(key)
+        if rows is None:
+            rows = self._live_rows[key] = np.flatnonzero(np.isin(self.document_ids, sorted(live)))
+        return rows
+
+class Snapshot:
+    # One published manifest: the live segments and which documents each one serves. A
+    # document rewritten or deleted since a segment was built is masked out of it.
+    def __init__(self, name, manifest, segments):
+        self.name = name
+        self.segments = segments
+        self.documents = {int(document_id): segment for document_id, segment in manifest['documents'].items()}
+        live = {}
+        for document_id, segment in self.documents.items():
+            live.setdefault(segment, set()).add(document_id)
+        self.parts = []
+        self.count = 0
+        for segment_name in manifest['segments']:
+            segment = segments[segment_name]
+            rows = segment.live_rows(live.get(segment_name, ()))
+            self.parts.append((segment, rows, live.get(segment_name, set())))
+            self.count += segment.count if rows is None else len(rows)
+
+class LocalVectorStore(VectorStore):
+    # Built-in backend: an append-only set of immutable segments plus a manifest naming the
+    # live ones. Writing a document stages its batches and seals them into a new segment;
+    # publish() writes a new manifest and atomically repoints CURRENT at it, so its cost
+    # follows the documents written, not the corpus. Segments of similar size are merged
+    # (LOCAL_INDEX_MERGE_FACTOR at a time) to keep their number logarithmic in the corpus.
+    # Readers map segments read-only, so every worker process shares the same page cache,
+    # and a reload only opens segments it has not seen: queries already running keep the
+    # snapshot they started with. Segments below LOCAL_INDEX_IVF_MIN_VECTORS rows are
+    # searched exactly; larger ones carry an IVF index probed on LOCAL_INDEX_NPROBE lists.
+    name = 'local'
+
+    def __init__(self, path, embedding_store):
+        # One index per embedding model, named like its embedding store directory
+        self.path = os.path.join(str(path), os.path.basename(embedding_store.path))
+        self.ivf_min_vectors = settings.LOCAL_INDEX_IVF_MIN_VECTORS
+        self.lists = settings.LOCAL_INDEX_LISTS
+        self.nprobe = settings.LOCAL_INDEX_NPROBE
+        self.merge_factor = max(settings.LOCAL_INDEX_MERGE_FACTOR, 2)
+        self._snapshot = None
+        self._segments = {}
+        self._checked_at = 0.0
+        self._staging = {}
+        # document id -> sealed, unpublished segment name (None = delete)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._publish_lock = threading.Lock()
+
+    def write_chunks(self, document_id, records, embeddings, write_batch=None):
+        if not records:
+            return
+        with self._lock:
+            staging = self._staging.get(document_id)
+            if staging is None:
+                staging = self._staging[document_id] = {
+                    'path': os.path.join(self.path, f".staging-{os.getpid()}-{document_id}-{uuid.uuid4().hex[:12]}"),
+                    'parts': [], 'ids': [], 'texts': [], 'metadatas': [],
+                }
+                os.makedirs(staging['path'])
+        part = os.path.join(staging['path'], f"part-{len(staging['parts']):05d}.npy")
+        np.save(part, normalize(embeddings))
+        staging['parts'].append(part)
+        staging['ids'].extend(record['id'] for record in records)
+        staging['texts'].extend(record['text'] for record in records)
+        staging['metadatas'].extend(record['metadata'] for record in records)
+
+    def finish_document(self, document_id, chunk_ids, publish=True):
+        with self._lock:
+            staging = self._staging.pop(document_id, None)
+        name = None
+        if staging is not None:
+            # Parts are copied into the segment through a memory map, one batch at a time
+            blocks = [np.load(part, mmap_mode='r') for part in staging['parts']]
+            name = self._write_segment(
+                f"pending-{os.getpid()}", blocks, np.full(len(staging['ids']), document_id, dtype=np.int64),
+                staging['ids'], staging['texts'], staging['metadatas'],
+            )
+            del blocks
+            shutil.rmtree(staging['path'], ignore_errors=True)
+        with self._lock:
+            replaced = self._pending.get(document_id)
+            self._pending[document_id] = name
+        if replaced:
+            shutil.rmtree(os.path.join(self.path, replaced), ignore_errors=True)
+        if publish:
+            self.publish()
+
+    def abort_document(self, document_id):
+        with self._lock:
+            staging = self._staging.pop(document_id, None)
+        if staging is not None:
+            shutil.rmtree(staging['path'], ignore_errors=True)
+
+    def delete_document(self, document_id, publish=True):
+        self.abort_document(document_id)
+        with self._lock:
+            replaced = self._pending.get(document_id)
+            self._pending[document_id] = None
+        if replaced:
+            shutil.rmtree(os.path.join(self.path, replaced), ignore_errors=True)
+        if publish:
+            self.publish()
+
+    @contextmanager
+    def _file_lock(self):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, '.lock'), 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _write_segment(self, prefix, blocks, document_ids, ids, texts, metadatas, centroids=None, offsets=None, trained_on=0):
+        # blocks: unit-length float32 arrays holding the rows in order
+        name = f"{prefix}-{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+        tmp = os.path.join(self.path, f".{name}.tmp")
+        os.makedirs(tmp)
+        dimensions = blocks[0].shape[1] if blocks else 0
+        vectors = np.lib.format.open_memmap(os.path.join(tmp, 'vectors.npy'), mode='w+', dtype=np.float32, shape=(len(ids), dimensions))
+        offset = 0
+        for block in blocks:
+            vectors[offset:offset + len(block)] = block
+            offset += len(block)
+        vectors.flush()
+        del vectors
+        np.save(os.path.join(tmp, 'document_ids.npy'), document_ids)
+        with open(os.path.join(tmp, 'rows.pkl'), 'wb') as f:
+            pickle.dump((ids, texts, metadatas), f, protocol=pickle.HIGHEST_PROTOCOL)
+        present, counts = np.unique(document_ids, return_counts=True)
+        meta = {
+            'count': len(ids), 'dimensions': int(dimensions), 'lists': 0, 'trained_on': trained_on, 'built_at': time.time(),
+            'documents': {str(document_id): int(rows) for document_id, rows in zip(present, counts)},
+        }
+        if centroids is not None:
+            np.save(os.path.join(tmp, 'centroids.npy'), centroids)
+            np.save(os.path.join(tmp, 'offsets.npy'), offsets)
+            meta['lists'] = len(centroids)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmp, os.path.join(self.path, name))
+        return name
+
+    def _segment(self, name):
+        segment = self._segments.get(name)
+        if segment is None:
+            segment = self._segments[name] = Segment(os.path.join(self.path, name))
+        return segment
+
+    def _read_pointer(self):
+        try:
+            with open(os.path.join(self.path, POINTER)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _read_manifest(self, name):
+        if name is None:
+            return {'segments': [], 'documents': {}}
+        with open(os.path.join(self.path, name)) as f:
+            return json.load(f)
+
+    def publish(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        start = time.time()
+        with self._publish_lock, self._file_lock():
+            # Re-read under the lock: other processes publish their own documents in between
+            previous_name = self._read_pointer()
+            manifest = self._read_manifest(previous_name)
+            segments = list(manifest['segments'])
+            documents = {int(document_id): segment for document_id, segment in manifest['documents'].items()}
+            for document_id, name in pending.items():
+                if name is None:
+                    documents.pop(document_id, None)
+                    continue
+                sealed = 'segment-' + name.split('-', 2)[2]
+                os.rename(os.path.join(self.path, name), os.path.join(self.path, sealed))
+                documents[document_id] = sealed
+                segments.append(sealed)
+            segments, merged = self._merge(segments, documents)
+            name = self._write_manifest(segments, documents)
+            self._prune(keep={name, previous_name, *segments, *manifest['segments']})
+        self._checked_at = 0.0
+        logger.info(
+            "Published local vector manifest %s (%s documents written, %s segments, %s merged) in %.2f seconds",
+            name, len(pending), len(segments), merged, time.time() - start,
+        )
+
+    def compact(self):
+        # Merges every live row into one segment, e.g. after a full re-index
+        with self._publish_lock, self._file_lock():
+            previous_name = self._read_pointer()
+            manifest = self._read_manifest(previous_name)
+            segments = list(manifest['segments'])
+            documents = {int(document_id): segment for document_id, segment in manifest['documents'].items()}
+            if len(segments) < 2 and not any(self._live_count(s, documents) < self._segment(s).count for s in segments):
+                return
+            segments = [self._merge_group(segments, documents)]
+            name = self._write_manifest(segments, documents)
+            self._prune(keep={name, previous_name, *segments, *manifest['segments']})
+        self._checked_at = 0.0
+        logger.info("Compacted local vector index into %s", segments[0])
+
+    def _write_manifest(self, segments, documents):
+        name = f"manifest-{time.time_ns()}-{uuid.uuid4().hex[:8]}.json"
+        tmp = os.path.join(self.path, f".{name}.tmp")
+        with open(tmp, 'w') as f:
+            json.dump({'segments': segments, 'documents': {str(key): value for key, value in documents.items()}, 'built_at': time.time()}, f)
+        os.replace(tmp, os.path.join(self.path, name))
+        pointer_tmp = os.path.join(self.path, f"{POINTER}.{os.getpid()}.tmp")
+        with open(pointer_tmp, 'w') as f:
+            f.write(name)
+        os.replace(pointer_tmp, os.path.join(self.path, POINTER))
+        return name
+
+    def _live_count(self, segment_name, documents):
+        segment = self._segment(segment_name)
+        return sum(rows for document_id, rows in segment.documents.items() if documents.get(document_id) == segment_name)
+
+    def _tier(self, rows):
+        if rows < TIER_FLOOR:
+            return 0
+        return 1 + int(math.log(rows / TIER_FLOOR, self.merge_factor))
+
+    def _merge(self, segments, documents):
+        # Drops segments with no live rows, rewrites mostly-deleted ones and merges any size
+        # tier holding merge_factor segments, so each row is rewritten O(log corpus) times
+        merged = 0
+        segments = [name for name in segments if self._live_count(name, documents)]
+        while True:
+            group = next((
+                [name] for name in segments
+                if 2 * self._live_count(name, documents) < self._segment(name).count
+            ), None)
+            if group is None:
+                tiers = {}
+                for name in segments:
+                    tiers.setdefault(self._tier(self._live_count(name, documents)), []).append(name)
+                full = [tier for tier, members in tiers.items() if len(members) >= self.merge_factor]
+                if not full:
+                    return segments, merged
+                group = tiers[min(full)]
+            result = self._merge_group(group, documents)
+            segments = [name for name in segments if name not in group] + [result]
+            merged += len(group)
+
+    def _merge_group(self, group, documents):
+        # Writes the live rows of `group` into one segment and points their documents at it
+        vectors, document_ids, ids, texts, metadatas = [], [], [], [], []
+        for name in group:
+            segment = self._segment(name)
+            live = [document_id for document_id in segment.documents if documents.get(document_id) == name]
+            rows = segment.live_rows(live)
+            if rows is None:
+                rows = np.arange(segment.count)
+            vectors.append(np.asarray(segment.vectors[rows]))
+            document_ids.append(np.asarray(segment.document_ids[rows]))
+            ids.extend(segment.ids[row] for row in rows)
+            texts.extend(segment.texts[row] for row in rows)
+            metadatas.extend(segment.metadatas[row] for row in rows)
+        matrix = np.vstack(vectors)
+        document_ids = np.concatenate(document_ids)
+
+        centroids = offsets = None
+        trained_on = 0
+        if len(matrix) >= self.ivf_min_vectors:
+            lists = min(self.lists or int(np.sqrt(len(matrix))), len(matrix))
+            largest = max((self._segment(name) for name in group), key=lambda segment: segment.count)
+            # Centroids of the largest input are reused until the rows have doubled since they were fit
+            if (largest.centroids is not None and largest.centroids.shape == (lists, matrix.shape[1])
+                    and len(matrix) < 2 * largest.meta['trained_on']):
+                centroids = np.asarray(largest.centroids)
+                trained_on = largest.meta['trained_on']
+            else:
+                centroids = train_centroids(matrix, lists)
+                trained_on = len(matrix)
+            assignments = assign(matrix, centroids)
+            order = np.argsort(assignments, kind='stable')
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=lists))])
+            matrix, document_ids = matrix[order], document_ids[order]
+            ids, texts, metadatas = [ids[i] for i in order], [texts[i] for i in order], [metadatas[i] for i in order]
+
+        name = self._write_segment('segment', [matrix], document_ids, ids, texts, metadatas, centroids, offsets, trained_on)
+        for document_id in np.unique(document_ids):
+            documents[int(document_id)] = name
+        return name
+
+    def _prune(self, keep):
+        # The previous manifest and its segments stay for readers that have not reloaded yet;
+        # older ones go. Processes still mapping a removed file keep a valid view until they
+        # drop it. Other processes' unpublished segments are left alone unless abandoned.
+        now = time.time()
+        for entry in os.listdir(self.path):
+            path = os.path.join(self.path, entry)
+            if entry.startswith(('segment-', 'manifest-')) and entry not in keep:
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+            elif entry.startswith(('pending-', '.staging-')) and self._abandoned(entry, path, now):
+                shutil.rmtree(path, ignore_errors=True)
+        for name in set(self._segments) - keep:
+            self._segments.pop(name, None)
+
+    def _abandoned(self, entry, path, now):
+        # Unpublished work belongs to the process named in it until that process is gone
+        if fcntl is None:
+            return now - os.stat(path).st_mtime > ABANDONED_AFTER
+        try:
+            os.kill(int(entry.split('-')[1]), 0)
+        except ProcessLookupError:
+            return True
+        except (PermissionError, ValueError):
+            return False
+        return False
+
+    def _current(self):
+        # Checks the pointer at most once a second; other processes publish new manifests.
+        # Nothing is built here: an index that was never published is empty.
+        now = time.monotonic()
+        if self._snapshot is not None and now - self._checked_at < 1.0:
+            return self._snapshot
+        self._checked_at = now
+        name = self._read_pointer()
+        if name is None:
+            return self._snapshot
+        if self._snapshot is None or self._snapshot.name != name:
+            with self._lock:
+                if self._snapshot is None or self._snapshot.name != name:
+                    try:
+                        manifest = self._read_manifest(name)
+                        # Only segments this process has not opened yet are loaded
+                        segments = {segment: self._segment(segment) for segment in manifest['segments']}
+                        self._snapshot = Snapshot(name, manifest, segments)
+                    except FileNotFoundError:
+                        # Pruned by a newer publish in between; the next check picks that one up
+                        logger.warning("Local vector manifest %s disappeared while loading", name)
+                        return self._snapshot
+                    for segment in set(self._segments) - set(segments):
+                        self._segments.pop(segment, None)
+        return self._snapshot
+
+    def query(self, embedding, n_results, document_ids=None):
+        snapshot = self._current()
+        if snapshot is None or not snapshot.count:
+            return []
+        query = normalize(embedding)
+        wanted = set(document_ids) if document_ids else None
+        hits = []
+        for segment, rows, live in snapshot.parts:
+            if wanted is not None:
+                allowed = live & wanted
+                if not allowed:
+                    continue
+                if len(allowed) < len(segment.documents):
+                    rows = segment.live_rows(allowed)
+            hits.extend(self._search(segment, query, rows, n_results))
+        hits.sort(key=lambda hit: -hit[0])
+        return [
+            {
+                "id": segment.ids[row],
+                "text": segment.texts[row],
+                "metadata": segment.metadatas[row],
+                # Squared L2 between unit vectors, as Chroma reports it
+                "distance": float(2.0 - 2.0 * score),
+            }
+            for score, segment, row in hits[:n_results]
+        ]
+
+    def _search(self, segment, query, rows, k):
+        # A selective filter is cheaper to search exactly than through the lists
+        if segment.centroids is not None and (rows is None or len(rows) > self.ivf_min_vectors):
+            candidates = self._probe(segment, query)
+            if rows is not None:
+                candidates = candidates[np.isin(candidates, rows, assume_unique=True)]
+            if len(candidates) >= k:
+                return self._top(segment, query, candidates, k)
+        return self._top(segment, query, rows, k)
+
+    def _probe(self, segment, query):
+        scores = segment.centroids @ query
+        nprobe = min(self.nprobe, len(scores))
+        lists = np.sort(np.argpartition(-scores, nprobe - 1)[:nprobe])
+        return np.concatenate([np.arange(segment.offsets[i], segment.offsets[i + 1]) for i in lists])
+
+    def _top(self, segment, query, candidates, k):
+        if candidates is None:
+            scores = segment.vectors @ query
+            candidates = np.arange(len(scores))
+        else:
+            scores = np.asarray(segment.vectors[candidates]) @ query
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        return [(float(scores[index]), segment, int(candidates[index])) for index in top]
+
+    def count(self, document_id=None):
+        snapshot = self._current()
+        if snapshot is None:
+            return 0
+        if document_id is None:
+            return snapshot.count
+        segment = snapshot.segments.get(snapshot.documents.get(document_id))
+        return segment.documents.get(document_id, 0) if segment is not None else 0
+
+    def stats(self):
+        snapshot = self._current()
+        if snapshot is None:
+            return {'backend': self.name, 'manifest': None, 'chunks': 0}
+        return {
+            'backend': self.name,
+            'manifest': snapshot.name,
+            'chunks': snapshot.count,
+            'documents': len(snapshot.documents),
+            'segments': len(snapshot.parts),
+            'ivf_segments': sum(1 for segment, _, _ in snapshot.parts if segment.centroids is not None),
+            'nprobe': self.nprobe,
+        }
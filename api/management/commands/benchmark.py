@@ -0,0 +1,519 @@
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, close_old_connections, connection
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+from api import embedding_store, embeddings, interaction_log, keyword_index, llm, vectorstore
+from api.cache import embedding_cache, results_cache
+from api.chunking import get_chunker
+from api.embedding_store import EmbeddingStore
+from api.embeddings import get_embedding_service
+from api.extraction import page_count
+from api.interaction_log import flush_interaction_log, get_interaction_log_writer
+from api.local_index import LocalVectorStore, normalize
+from api.models import Document, InteractionLog, TTSState
+from api.utils import process_document
+from api.vectorstore import ChromaVectorStore, get_vector_store
+from api.views import AskQuestionView
+
+VOCABULARY = (
+    'account address analysis application archive backup balance browser budget cable calendar '
+    'camera chart client cluster column contract cursor dashboard database deadline desktop device '
+    'document domain draft email engine export field filter folder font format formula gateway graph '
+    'header invoice keyboard label layout ledger license margin memory menu message module monitor '
+    'network notebook office option outline packet page palette password pivot planner portal '
+    'preview printer profile project query record report ribbon router schedule screen server '
+    'session sheet shortcut slide socket spreadsheet storage style table template ticket toolbar '
+    'update upload user version window workbook workflow'
+).split()
+
+def synthetic_text(rng, words):
+    sentences = []
+    while words > 0:
+        length = min(rng.randint(8, 18), words)
+        sentence = ' '.join(rng.choice(VOCABULARY) for _ in range(length))
+        sentences.append(sentence.capitalize() + '.')
+        words -= length
+    return ' '.join(sentences)
+
+def write_synthetic_pdf(path, pages, seed=0, lines_per_page=45, words_per_line=12):
+    # Minimal single-font PDF writer so the benchmark needs no PDF generation dependency
+    rng = random.Random(seed)
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    kids = []
+    for _ in range(pages):
+        lines = [synthetic_text(rng, words_per_line) for _ in range(lines_per_page)]
+        stream = "BT /F1 10 Tf 12 TL 40 800 Td " + ' '.join(f"({line}) Tj T*" for line in lines) + " ET"
+        stream = stream.encode('latin-1')
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id
+        )
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b' '.join(b"%d 0 R" % kid for kid in kids), pages)
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        output += b"%010d 00000 n \n" % offset
+    output += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    Path(path).write_bytes(bytes(output))
+
+def latency_summary(latencies):
+    values = np.asarray(latencies) * 1000
+    if not len(values):
+        return {}
+    return {
+        'mean': round(float(values.mean()), 2),
+        'p50': round(float(np.percentile(values, 50)), 2),
+        'p95': round(float(np.percentile(values, 95)), 2),
+        'p99': round(float(np.percentile(values, 99)), 2),
+        'max': round(float(values.max()), 2),
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, timeout=5,
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def reset_singletons():
+    # Settings are overridden for the run; drop process-wide clients built from the old values
+    vectorstore.reset()
+    embeddings._service = None
+    keyword_index._index = None
+    embedding_store._stores.clear()
+    llm._client = None
+    embedding_cache.clear()
+    results_cache.clear()
+    # The buffered interaction log holds a connection and reserved ids from the database it
+    # started on
+    if interaction_log._writer is not None:
+        interaction_log._writer.stop()
+        interaction_log._writer = None
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark document ingestion (pages/sec, chunks/sec), question answering (QPS, '
+        'p50/p95/p99 latency) and raw vector search (latency, recall@10 for Chroma and the local '
+        'index) against throwaway stores and the echo LLM, plus concurrent write throughput, '
+        'writing the results as JSON. Runs on a temporary database created with the configured '
+        'engine unless --database names one'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='5,50,200', help='Comma-separated page counts of the synthetic PDFs')
+        parser.add_argument('--sample-dir', default=str(settings.BASE_DIR / 'sample'), help='Directory of real PDFs to ingest as well (skipped if missing)')
+        parser.add_argument('--repeat', type=int, default=1, help='Ingest each PDF this many times and report the median')
+        parser.add_argument('--questions', type=int, default=200, help='Number of questions to ask')
+        parser.add_argument('--concurrency', type=int, default=4, help='Concurrent question threads')
+        parser.add_argument('--warmup', type=int, default=10, help='Unmeasured questions asked first')
+        parser.add_argument('--vector-store', default=settings.VECTOR_STORE, choices=['chroma', 'local'], help='Vector store for the ingestion and question runs')
+        parser.add_argument('--vector-chunks', type=int, default=20000, help='Synthetic vectors for the vector search comparison (0 skips it)')
+        parser.add_argument('--db-writes', type=int, default=2000, help='Rows per database write test (0 skips them)')
+        parser.add_argument('--db-writers', type=int, default=8, help='Concurrent threads for the database write tests')
+        parser.add_argument('--embedding-backend', default='hashing', help="Embedding backend; 'hashing' runs fully offline")
+        parser.add_argument('--llm-token-delay', type=float, default=0.0, help='Seconds per token for the echo LLM')
+        parser.add_argument('--answer-cache', action='store_true', help='Leave the semantic answer cache on')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--database', default=None, help='Database to run against instead of a temporary one: an SQLite file path or a PostgreSQL database name. It is migrated first and the benchmark rows are removed afterwards')
+        parser.add_argument('--output', default=None, help='JSON output path (default: benchmarks/<timestamp>.json, which is gitignored)')
+        parser.add_argument('--compare', default=None, help='Previous JSON result to compare against')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',') if size.strip()]
+        except ValueError:
+            raise CommandError('--sizes must be a comma-separated list of page counts')
+        if options['embedding_backend'] not in embeddings.BACKENDS:
+            raise CommandError(f"Unknown embedding backend: {options['embedding_backend']}")
+
+        workdir = Path(tempfile.mkdtemp(prefix='kb-benchmark-'))
+        overrides = override_settings(
+            MEDIA_ROOT=str(workdir / 'media'),
+            CHROMA_MODE='persistent',
+            CHROMA_PERSIST_DIR=workdir / 'chroma',
+            CHROMA_COLLECTION='benchmark',
+            KEYWORD_INDEX_DIR=workdir / 'keyword_index',
+            EMBEDDING_STORE_DIR=workdir / 'embedding_store',
+            VECTOR_STORE=options['vector_store'],
+            LOCAL_INDEX_DIR=workdir / 'local_index',
+            EMBEDDING_BACKEND=options['embedding_backend'],
+            LLM_BACKEND='echo',
+            LLM_FAKE_TOKEN_DELAY=options['llm_token_delay'],
+            ANSWER_CACHE_ENABLED=options['answer_cache'],
+            RERANK_ENABLED=False,
+        )
+        documents = []
+        user = None
+        close_database = None
+        try:
+            close_database = self.open_database(workdir, options['database'])
+            with overrides:
+                reset_singletons()
+                pdfs = self.prepare_pdfs(workdir, sizes, options)
+                ingestion = self.bench_ingestion(pdfs, options['repeat'], documents)
+                user = User.objects.create_user(username=f"benchmark-{uuid.uuid4().hex[:12]}")
+                qa = self.bench_questions(user, options)
+                vector_search = self.bench_vector_search(workdir, options) if options['vector_chunks'] else None
+                db_writes = self.bench_db_writes(user, options) if options['db_writes'] else None
+                Document.objects.filter(id__in=documents).delete()
+        finally:
+            if user is not None:
+                # Write buffered interaction logs first so the cascade removes them too
+                flush_interaction_log()
+                user.delete()
+            reset_singletons()
+            if close_database is not None:
+                close_database()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        result = {
+            'meta': {
+                'timestamp': timezone.now().isoformat(),
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'embedding_backend': options['embedding_backend'],
+                'embedding_model': settings.EMBEDDING_MODEL,
+                'vector_store': options['vector_store'],
+                'database': connection.vendor,
+                'database_name': options['database'] or 'temporary',
+                'chunker': settings.CHUNKER,
+                'keyword_index': settings.KEYWORD_INDEX_ENABLED,
+                'llm_token_delay': options['llm_token_delay'],
+                'answer_cache': options['answer_cache'],
+                'seed': options['seed'],
+            },
+            'ingestion': ingestion,
+            'questions': qa,
+            'vector_search': vector_search,
+            'db_writes': db_writes,
+        }
+        output = Path(options['output'] or settings.BASE_DIR / 'benchmarks' / f"{timezone.now():%Y%m%d-%H%M%S}.json")
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(result, indent=2))
+        self.stdout.write(self.style.SUCCESS(f"Results written to {output}"))
+
+        if options['compare']:
+            self.compare(json.loads(Path(options['compare']).read_text()), result)
+
+    def open_database(self, workdir, name):
+        # Points the default connection at the benchmark database and returns the function that
+        # points it back. Threads started afterwards open their connections there too.
+        database = connection.settings_dict
+        original_name = database['NAME']
+        if name:
+            connection.close()
+            database['NAME'] = name
+            call_command('migrate', verbosity=0, interactive=False)
+
+            def close():
+                connection.close()
+                database['NAME'] = original_name
+            return close
+
+        # A file rather than SQLite's in-memory test database, so writes pay for the journal
+        # the way they do in production
+        original_test = database['TEST']
+        test_name = str(workdir / 'benchmark.sqlite3') if connection.vendor == 'sqlite' else f"benchmark_{uuid.uuid4().hex[:12]}"
+        database['TEST'] = {**original_test, 'NAME': test_name}
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+
+        def close():
+            connection.creation.destroy_test_db(original_name, verbosity=0)
+            database['TEST'] = original_test
+        return close
+
+    def prepare_pdfs(self, workdir, sizes, options):
+        source_dir = workdir / 'source'
+        source_dir.mkdir(parents=True)
+        pdfs = []
+        for pages in sizes:
+            path = source_dir / f"synthetic-{pages}p.pdf"
+            write_synthetic_pdf(path, pages, seed=options['seed'] + pages)
+            pdfs.append(path)
+        sample_dir = Path(options['sample_dir'])
+        if sample_dir.is_dir():
+            pdfs.extend(sorted(sample_dir.glob('*.pdf')))
+        return pdfs
+
+    def bench_ingestion(self, pdfs, repeat, documents):
+        media_dir = Path(settings.MEDIA_ROOT) / 'documents'
+        media_dir.mkdir(parents=True, exist_ok=True)
+        # Load the tokenizer and embedding model up front so they are not billed to the first PDF
+        list(get_chunker().chunk(iter([(1, "warm up")])))
+        get_embedding_service().warm_up()
+        results = []
+        for pdf in pdfs:
+            pages = page_count(str(pdf))
+            timings = []
+            chunks = 0
+            for run in range(repeat):
+                name = f"{pdf.stem}-{run}{pdf.suffix}"
+                shutil.copyfile(pdf, media_dir / name)
+                # bulk_create bypasses post_save, so no ingestion job is queued alongside
+                document = Document.objects.bulk_create([Document(file_name=pdf.name, file=f"documents/{name}")])[0]
+                documents.append(document.id)
+                start = time.perf_counter()
+                process_document(document.id)
+                timings.append(time.perf_counter() - start)
+                chunks = get_vector_store().count(document.id)
+            seconds = statistics.median(timings)
+            entry = {
+                'name': pdf.name,
+                'synthetic': pdf.name.startswith('synthetic-'),
+                'pages': pages,
+                'bytes': pdf.stat().st_size,
+                'chunks': chunks,
+                'seconds': round(seconds, 4),
+                'pages_per_sec': round(pages / seconds, 2),
+                'chunks_per_sec': round(chunks / seconds, 2),
+            }
+            results.append(entry)
+            self.stdout.write(
+                f"ingest {entry['name']}: {pages} pages, {chunks} chunks in {seconds:.2f}s "
+                f"({entry['pages_per_sec']} pages/s, {entry['chunks_per_sec']} chunks/s)"
+            )
+        return results
+
+    def bench_questions(self, user, options):
+        rng = random.Random(options['seed'])
+        factory = APIRequestFactory()
+        view = AskQuestionView.as_view()
+        questions = [
+            f"What does the document say about the {rng.choice(VOCABULARY)} {rng.choice(VOCABULARY)} and {rng.choice(VOCABULARY)} (#{index})?"
+            for index in range(options['warmup'] + options['questions'])
+        ]
+        errors = []
+        errors_lock = threading.Lock()
+
+        def ask(question):
+            request = factory.post('/api/ask-question/', {'question': question}, format='json')
+            force_authenticate(request, user=user)
+            start = time.perf_counter()
+            try:
+                response = view(request)
+            finally:
+                close_old_connections()
+            elapsed = time.perf_counter() - start
+            if response.status_code != 200:
+                with errors_lock:
+                    errors.append(response.status_code)
+            return elapsed
+
+        for question in questions[:options['warmup']]:
+            ask(question)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            latencies = list(pool.map(ask, questions[options['warmup']:]))
+        seconds = time.perf_counter() - start
+
+        result = {
+            'questions': options['questions'],
+            'concurrency': options['concurrency'],
+            'errors': len(errors),
+            'seconds': round(seconds, 4),
+            'qps': round(options['questions'] / seconds, 2) if seconds else None,
+            'latency_ms': latency_summary(latencies),
+        }
+        self.stdout.write(
+            f"questions: {result['qps']} QPS at concurrency {options['concurrency']}, latency ms {result['latency_ms']}, {len(errors)} errors"
+        )
+        return result
+
+    def bench_vector_search(self, workdir, options, dimensions=384, documents=100, k=10):
+        # Clustered random unit vectors, loaded straight into each backend: isolates search
+        # latency and recall@k against exact results from everything else in the pipeline
+        rng = np.random.default_rng(options['seed'])
+        count = options['vector_chunks']
+        centers = normalize(rng.standard_normal((64, dimensions)))
+
+        def sample(size):
+            noise = rng.standard_normal((size, dimensions)).astype(np.float32) * (0.6 / np.sqrt(dimensions))
+            return normalize(centers[rng.integers(len(centers), size=size)] + noise)
+
+        matrix = sample(count)
+        queries = sample(min(options['questions'], 500))
+        owners = np.arange(count) * documents // count + 1
+        filters = rng.integers(1, documents + 1, size=len(queries))
+        truth = [set(np.argsort(-(matrix @ query))[:k]) for query in queries]
+        filtered_truth = []
+        for query, document_id in zip(queries, filters):
+            rows = np.flatnonzero(owners == document_id)
+            filtered_truth.append(set(rows[np.argsort(-(matrix[rows] @ query))[:k]]))
+
+        store = EmbeddingStore(workdir / 'vector_embeddings', 'synthetic', settings.EMBEDDING_STORE_DTYPE)
+        backends = {
+            'chroma': ChromaVectorStore('benchmark-vectors'),
+            'local_exact': LocalVectorStore(workdir / 'vector_index_exact', store),
+            'local_ivf': LocalVectorStore(workdir / 'vector_index_ivf', store),
+        }
+        backends['local_exact'].ivf_min_vectors = count + 1
+        backends['local_ivf'].ivf_min_vectors = 0
+
+        def records(rows):
+            return [
+                {"id": f"v{row}", "text": f"synthetic chunk {row}", "metadata": {"document_id": int(owners[row]), "file_name": "synthetic", "page": 1}}
+                for row in rows
+            ]
+
+        results = {}
+        for name, backend in backends.items():
+            start = time.perf_counter()
+            for document_id in range(1, documents + 1):
+                rows = np.flatnonzero(owners == document_id)
+                backend.write_document(document_id, records(rows), matrix[rows], publish=False)
+            backend.publish()
+            backend.compact()
+            build_seconds = time.perf_counter() - start
+
+            entry = {'vectors': count, 'build_seconds': round(build_seconds, 3)}
+            for label, document_filter, expected in (('unfiltered', None, truth), ('filtered', filters, filtered_truth)):
+                latencies = []
+                recall = []
+                for index, query in enumerate(queries):
+                    document_ids = [int(document_filter[index])] if document_filter is not None else None
+                    start = time.perf_counter()
+                    found = backend.query(query, k, document_ids)
+                    latencies.append(time.perf_counter() - start)
+                    recall.append(len({int(result['id'][1:]) for result in found} & expected[index]) / k)
+                entry[label] = {'latency_ms': latency_summary(latencies), f'recall@{k}': round(float(np.mean(recall)), 4)}
+            results[name] = entry
+            self.stdout.write(
+                f"vector search {name}: build {build_seconds:.2f}s, p50 {entry['unfiltered']['latency_ms']['p50']} ms "
+                f"(filtered {entry['filtered']['latency_ms']['p50']} ms), recall@{k} {entry['unfiltered'][f'recall@{k}']}"
+            )
+        return results
+
+    def bench_db_writes(self, user, options):
+        # Many threads writing to the configured database at once, the way concurrent ask and
+        # text-to-speech requests do: a plain INSERT per answer, the buffered interaction log
+        # and the TTS progress upsert. Each write ends like a request, releasing its connection.
+        writers, total = options['db_writers'], options['db_writes']
+        targets = InteractionLog.objects.bulk_create([
+            InteractionLog(user=user, question='benchmark', answer='benchmark', sources=[]) for _ in range(writers)
+        ])
+        writer = get_interaction_log_writer()
+
+        def create(index):
+            InteractionLog.objects.create(user=user, question=f"benchmark {index}", answer='benchmark', sources=[])
+
+        def buffered(index):
+            writer.log(user, f"benchmark {index}", 'benchmark', [])
+
+        def progress(index):
+            TTSState.save_position(user, targets[index % writers], 'benchmark', index)
+
+        tests = {'interaction_create': create, 'tts_progress': progress}
+        if writer is not None:
+            tests['interaction_buffered'] = buffered
+        result = {'engine': connection.vendor, 'writers': writers, 'writes': total}
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode')
+                result['journal_mode'] = cursor.fetchone()[0]
+
+        for name, write in tests.items():
+            errors = []
+            errors_lock = threading.Lock()
+
+            def timed_write(index):
+                start = time.perf_counter()
+                try:
+                    write(index)
+                except DatabaseError as e:
+                    with errors_lock:
+                        errors.append(str(e))
+                finally:
+                    close_old_connections()
+                return time.perf_counter() - start
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=writers) as pool:
+                latencies = list(pool.map(timed_write, range(total)))
+            if name == 'interaction_buffered':
+                # Throughput counts the rows reaching the database, not just the enqueue
+                flush_interaction_log()
+            seconds = time.perf_counter() - start
+            result[name] = {
+                'errors': len(errors),
+                'seconds': round(seconds, 4),
+                'writes_per_sec': round(total / seconds, 2) if seconds else None,
+                'latency_ms': latency_summary(latencies),
+            }
+            self.stdout.write(
+                f"db {name}: {result[name]['writes_per_sec']} writes/s with {writers} writers on {connection.vendor}, "
+                f"latency ms {result[name]['latency_ms']}, {len(errors)} errors"
+            )
+            if errors:
+                self.stderr.write(f"  first error: {errors[0]}")
+        return result
+
+    def compare(self, previous, current):
+        # Positive change is better for throughput, negative for latency
+        self.stdout.write(f"Compared with {previous['meta'].get('commit')} ({previous['meta'].get('timestamp')}):")
+        if previous['meta'].get('vector_store', 'chroma') != current['meta']['vector_store']:
+            self.stdout.write(f"  vector store: {previous['meta'].get('vector_store', 'chroma')} -> {current['meta']['vector_store']}")
+        before = {entry['name']: entry for entry in previous.get('ingestion', [])}
+        for entry in current['ingestion']:
+            old = before.get(entry['name'])
+            if old:
+                self.stdout.write(f"  ingest {entry['name']} pages/s: {self._delta(old['pages_per_sec'], entry['pages_per_sec'])}")
+        old_qa, new_qa = previous.get('questions', {}), current['questions']
+        if old_qa.get('qps') and new_qa.get('qps'):
+            self.stdout.write(f"  questions QPS: {self._delta(old_qa['qps'], new_qa['qps'])}")
+        for key in ('p50', 'p95', 'p99'):
+            old_value = old_qa.get('latency_ms', {}).get(key)
+            new_value = new_qa.get('latency_ms', {}).get(key)
+            if old_value and new_value:
+                self.stdout.write(f"  questions {key} ms: {self._delta(old_value, new_value)}")
+        old_search, new_search = previous.get('vector_search') or {}, current.get('vector_search') or {}
+        for name, entry in new_search.items():
+            old_value = old_search.get(name, {}).get('unfiltered', {}).get('latency_ms', {}).get('p50')
+            if old_value:
+                self.stdout.write(f"  vector search {name} p50 ms: {self._delta(old_value, entry['unfiltered']['latency_ms']['p50'])}")
+        old_db, new_db = previous.get('db_writes') or {}, current.get('db_writes') or {}
+        if old_db and new_db and old_db.get('engine') != new_db.get('engine'):
+            self.stdout.write(f"  database: {old_db.get('engine')} -> {new_db.get('engine')}")
+        for name in ('interaction_create', 'interaction_buffered', 'tts_progress'):
+            old_value = old_db.get(name, {}).get('writes_per_sec')
+            new_value = new_db.get(name, {}).get('writes_per_sec')
+            if old_value and new_value:
+                self.stdout.write(f"  db {name} writes/s: {self._delta(old_value, new_value)}")
+
+    def _delta(self, old, new):
+        return f"{old} -> {new} ({(new - old) / old * 100:+.1f}%)"
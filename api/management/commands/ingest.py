@@ -0,0 +1,238 @@
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from pathlib import Path
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from api.bulk_ingestion import init_worker, parse_and_chunk
+from api.cache import bump_collection_version
+from api.embeddings import get_embedding_service
+from api.keyword_index import get_keyword_index
+from api.models import Document
+from api.utils import chunk_records, file_content_hash, save_document_vectors
+from api.vectorstore import get_vector_store
+
+# Stay well under SQLite's bound-parameter limit for IN (...) lookups
+LOOKUP_BATCH = 500
+
+class Command(BaseCommand):
+    help = (
+        'Bulk-index every PDF under a directory: files are parsed and chunked across a process '
+        'pool, embedded in large batches and written to the vector store in bulk. Already indexed files '
+        '(by content hash) are skipped and progress is checkpointed so an interrupted run resumes.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Directory to scan for PDFs (recursively)')
+        parser.add_argument('--pattern', default='*.pdf', help='Glob pattern for files to ingest')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Parse/chunk processes (default: all cores)')
+        parser.add_argument('--embed-batch', type=int, default=1024, help='Chunks to accumulate before each embed and write')
+        parser.add_argument('--write-batch', type=int, default=2000, help='Maximum records per vector store write (ChromaDB upsert)')
+        parser.add_argument('--db-batch', type=int, default=500, help='Document rows per bulk_create')
+        parser.add_argument('--checkpoint', default=None, help='Checkpoint file (default: <directory>/.ingest-checkpoint.json)')
+        parser.add_argument('--restart', action='store_true', help='Ignore an existing checkpoint')
+
+    def handle(self, *args, **options):
+        root = Path(options['directory']).resolve()
+        if not root.is_dir():
+            raise CommandError(f"{root} is not a directory")
+        self.checkpoint_path = Path(options['checkpoint'] or root / '.ingest-checkpoint.json')
+        self.checkpoint = {'files': {}} if options['restart'] else self.load_checkpoint()
+        self.options = options
+        self.totals = {'files': 0, 'pages': 0, 'chunks': 0, 'failed': 0, 'parse': 0.0, 'embed': 0.0, 'write': 0.0}
+        self.started = time.time()
+
+        paths = sorted(path for path in root.rglob(options['pattern']) if path.is_file())
+        self.stdout.write(f"Found {len(paths)} files under {root}")
+        items = self.select(root, paths)
+        if not items:
+            self.stdout.write(self.style.SUCCESS("Nothing to ingest"))
+            return
+        self.create_documents(items)
+        self.stdout.write(f"Ingesting {len(items)} files with {options['workers']} workers")
+        try:
+            self.run(items)
+        finally:
+            self.save_checkpoint()
+            if self.totals['files']:
+                # The local vector store publishes one snapshot for the whole run
+                get_vector_store().publish()
+                bump_collection_version()
+        self.report(final=True)
+
+    def load_checkpoint(self):
+        try:
+            return json.loads(self.checkpoint_path.read_text())
+        except FileNotFoundError:
+            return {'files': {}}
+        except ValueError:
+            raise CommandError(f"Checkpoint {self.checkpoint_path} is corrupt; rerun with --restart")
+
+    def save_checkpoint(self):
+        tmp = self.checkpoint_path.with_suffix('.tmp')
+        tmp.write_text(json.dumps(self.checkpoint))
+        os.replace(tmp, self.checkpoint_path)
+
+    def select(self, root, paths):
+        # Files finished in an earlier run are skipped without re-hashing if unchanged on disk
+        entries = self.checkpoint['files']
+        candidates = []
+        for path in paths:
+            key = str(path.relative_to(root))
+            stat = path.stat()
+            entry = entries.get(key)
+            if entry and entry.get('status') in ('done', 'skipped') and entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime:
+                continue
+            candidates.append({'key': key, 'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime})
+
+        with ThreadPoolExecutor(max_workers=min(8, self.options['workers'] * 2)) as pool:
+            for item, content_hash in zip(candidates, pool.map(lambda item: file_content_hash(item['path']), candidates)):
+                item['hash'] = content_hash
+
+        hashes = list({item['hash'] for item in candidates})
+        indexed = set()
+        for start in range(0, len(hashes), LOOKUP_BATCH):
+            indexed.update(Document.objects.filter(
+                content_hash__in=hashes[start:start + LOOKUP_BATCH], indexed_at__isnull=False
+            ).values_list('content_hash', flat=True))
+
+        items = []
+        seen = set()
+        for item in candidates:
+            if item['hash'] in indexed or item['hash'] in seen:
+                entries[item['key']] = {'size': item['size'], 'mtime': item['mtime'], 'hash': item['hash'], 'status': 'skipped'}
+                continue
+            seen.add(item['hash'])
+            items.append(item)
+        self.stdout.write(f"Skipping {len(candidates) - len(items)} already indexed or duplicate files")
+        self.save_checkpoint()
+        return items
+
+    def create_documents(self, items):
+        # Rows left unindexed by an interrupted run are reused rather than duplicated
+        entries = self.checkpoint['files']
+        reusable = [entries.get(item['key'], {}).get('document_id') for item in items]
+        existing = Document.objects.in_bulk([document_id for document_id in reusable if document_id])
+        new_items = []
+        for item, document_id in zip(items, reusable):
+            document = existing.get(document_id)
+            if document is not None and entries[item['key']].get('hash') == item['hash']:
+                item['document'] = document
+            else:
+                new_items.append(item)
+
+        for start in range(0, len(new_items), self.options['db_batch']):
+            batch = new_items[start:start + self.options['db_batch']]
+            documents = []
+            for item in batch:
+                with open(item['path'], 'rb') as f:
+                    stored_name = default_storage.save(f"documents/{item['path'].name}", File(f))
+                documents.append(Document(file_name=item['path'].name, file=stored_name))
+            # bulk_create skips post_save, so no per-document ingestion jobs are queued
+            for item, document in zip(batch, Document.objects.bulk_create(documents)):
+                item['document'] = document
+                entries[item['key']] = {
+                    'size': item['size'], 'mtime': item['mtime'], 'hash': item['hash'],
+                    'document_id': document.id, 'status': 'pending',
+                }
+            self.save_checkpoint()
+
+    def run(self, items):
+        workers = max(self.options['workers'], 1)
+        pending = list(reversed(items))
+        in_flight = {}
+        buffer = []
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_worker,
+        ) as pool:
+            while pending or in_flight:
+                # A small look-ahead keeps every worker busy while this process embeds
+                while pending and len(in_flight) < workers * 2:
+                    item = pending.pop()
+                    in_flight[pool.submit(parse_and_chunk, str(item['path']))] = item
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = in_flight.pop(future)
+                    try:
+                        item['pages'], item['chunks'], parse_seconds = future.result()
+                    except Exception as e:
+                        self.fail(item, e)
+                        continue
+                    self.totals['parse'] += parse_seconds
+                    buffer.append(item)
+                if sum(len(item['chunks']) for item in buffer) >= self.options['embed_batch']:
+                    self.flush(buffer)
+                    buffer = []
+            if buffer:
+                self.flush(buffer)
+
+    def flush(self, items):
+        records = []
+        for item in items:
+            item['records'] = chunk_records(item['document'], item['hash'], item['chunks'])
+            records.extend(item['records'])
+
+        try:
+            embed_start = time.time()
+            embeddings = get_embedding_service().encode_documents([record['text'] for record in records])
+            self.totals['embed'] += time.time() - embed_start
+
+            write_start = time.time()
+            offset = 0
+            for item in items:
+                count = len(item['records'])
+                save_document_vectors(
+                    item['document'].id, item['records'], embeddings[offset:offset + count],
+                    publish=False, write_batch=self.options['write_batch'],
+                )
+                if settings.KEYWORD_INDEX_ENABLED:
+                    get_keyword_index().add_document(item['document'].id, item['records'])
+                offset += count
+            self.totals['write'] += time.time() - write_start
+        except Exception as e:
+            for item in items:
+                self.fail(item, e)
+            return
+
+        now = timezone.now()
+        documents = []
+        for item in items:
+            item['document'].content_hash = item['hash']
+            item['document'].indexed_at = now
+            documents.append(item['document'])
+            self.checkpoint['files'][item['key']]['status'] = 'done'
+            self.totals['files'] += 1
+            self.totals['pages'] += item['pages']
+            self.totals['chunks'] += len(item['chunks'])
+            # Release the text; only the checkpoint entry is needed from here on
+            item['chunks'] = item['records'] = None
+        Document.objects.bulk_update(documents, ['content_hash', 'indexed_at'])
+        self.save_checkpoint()
+        self.report()
+
+    def fail(self, item, error):
+        self.totals['failed'] += 1
+        entry = self.checkpoint['files'][item['key']]
+        entry['status'] = 'failed'
+        entry['error'] = str(error)
+        self.stderr.write(f"Failed to ingest {item['key']}: {error}")
+
+    def report(self, final=False):
+        elapsed = max(time.time() - self.started, 1e-9)
+        totals = self.totals
+        message = (
+            f"{totals['files']} files, {totals['pages']} pages, {totals['chunks']} chunks in {elapsed:.1f}s "
+            f"({totals['pages'] / elapsed:.1f} pages/s, {totals['chunks'] / elapsed:.1f} chunks/s); "
+            f"parse {totals['parse']:.1f}s across workers, embed {totals['embed']:.1f}s, write {totals['write']:.1f}s"
+        )
+        if final:
+            self.stdout.write(self.style.SUCCESS(f"Done: {message}, {totals['failed']} failed"))
+        else:
+            self.stdout.write(message)
@@ -0,0 +1,37 @@
+import signal
+import threading
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from api.ingestion import work, worker_name
+
+class Command(BaseCommand):
+    help = 'Run background workers that process queued document ingestion jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=2, help='Number of worker threads in this process')
+        parser.add_argument('--poll-interval', type=float, default=settings.INGESTION_POLL_INTERVAL, help='Seconds to wait between polls when the queue is empty')
+
+    def handle(self, *args, **options):
+        stop_event = threading.Event()
+
+        def shutdown(signum, frame):
+            self.stdout.write("Stopping ingestion workers after their current job...")
+            stop_event.set()
+
+        signal.signal(signal.SIGINT, shutdown)
+        signal.signal(signal.SIGTERM, shutdown)
+
+        threads = []
+        for index in range(options['concurrency']):
+            thread = threading.Thread(
+                target=work,
+                args=(worker_name(index), stop_event, options['poll_interval']),
+                name=f"ingestion-worker-{index}",
+            )
+            thread.start()
+            threads.append(thread)
+        self.stdout.write(self.style.SUCCESS(f"Started {len(threads)} ingestion workers"))
+
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(timeout=1)
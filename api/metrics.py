@@ -0,0 +1,253 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Seconds. Query stages are mostly milliseconds; LLM calls and ingestion stages run to minutes.
+QUERY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+INGEST_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Histogram:
+    # Cumulative-bucket histogram in the Prometheus text format, one series per label set
+    def __init__(self, name, documentation, labelnames=(), buckets=QUERY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+        for key, (counts, total, count) in sorted(series.items()):
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', _format_value(float(bound)))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(list(zip(self.labelnames, key)))} {_format_value(value)}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        # Callbacks returning (name, type, help, [(labels, value), ...]) sampled at scrape time
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        self._collectors.append(collector)
+        return collector
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                logger.warning("Metrics collector %s failed: %s", collector.__name__, str(e))
+                continue
+            for name, metric_type, documentation, samples in families:
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'rag_stage_duration_seconds',
+    'Latency of each question-answering stage.',
+    ['stage'],
+))
+INGEST_STAGE_SECONDS = REGISTRY.register(Histogram(
+    'rag_ingest_stage_duration_seconds',
+    'Per-document time spent in each ingestion stage.',
+    ['stage'],
+    INGEST_BUCKETS,
+))
+STAGE_ERRORS = REGISTRY.register(Counter(
+    'rag_stage_errors_total',
+    'Exceptions raised inside an instrumented stage.',
+    ['stage'],
+))
+QUESTIONS = REGISTRY.register(Counter(
+    'rag_questions_total',
+    'Answered questions by answer source.',
+    ['source'],
+))
+RERANK_SKIPPED = REGISTRY.register(Counter(
+    'rag_rerank_skipped_total',
+    'Requests that kept the retrieval order instead of re-ranking.',
+    ['reason'],
+))
+INTERACTION_LOG_FLUSH_SECONDS = REGISTRY.register(Histogram(
+    'rag_interaction_log_flush_seconds',
+    'Latency of each buffered interaction log flush.',
+))
+INTERACTION_LOG_WRITE_FAILURES = REGISTRY.register(Counter(
+    'rag_interaction_log_write_failures_total',
+    'Interaction log rows whose write failed, by whether they were kept for retry or dropped.',
+    ['result'],
+))
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+def get_tracer():
+    # OpenTelemetry is optional; spans are only created when OTEL_ENABLED is set. Exporter
+    # endpoint and headers come from the standard OTEL_EXPORTER_OTLP_* environment variables.
+    global _tracer
+    if not settings.OTEL_ENABLED:
+        return None
+    if _tracer is None:
+        with _tracer_lock:
+            if _tracer is None:
+                from opentelemetry import trace
+                from opentelemetry.sdk.resources import Resource
+                from opentelemetry.sdk.trace import TracerProvider
+                from opentelemetry.sdk.trace.export import BatchSpanProcessor
+                from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+                provider = TracerProvider(resource=Resource.create({'service.name': settings.OTEL_SERVICE_NAME}))
+                provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+                trace.set_tracer_provider(provider)
+                _tracer = trace.get_tracer('api')
+    return _tracer
+
+def observe(stage, seconds, timings=None):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    if timings is not None:
+        timings[stage] = round(seconds * 1000, 2)
+
+def observe_ingest(stage, seconds):
+    INGEST_STAGE_SECONDS.observe(seconds, stage=stage)
+
+@contextmanager
+def timed(stage, timings=None):
+    # Records the block's duration in the stage histogram (and as milliseconds in `timings`,
+    # if given) and wraps it in an OpenTelemetry span when tracing is enabled
+    tracer = get_tracer()
+    start = time.perf_counter()
+    try:
+        with tracer.start_as_current_span(f"rag.{stage}") if tracer is not None else nullcontext():
+            yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        observe(stage, time.perf_counter() - start, timings)
+
+def _cache_metrics():
+    from api.cache import embedding_cache, results_cache
+    from api.answer_cache import answer_cache_stats
+    caches = {cache.name: cache.stats() for cache in (embedding_cache, results_cache)}
+    caches['answer'] = answer_cache_stats()
+    lookups = []
+    hit_rates = []
+    for name, stats in caches.items():
+        lookups.append(({'cache': name, 'result': 'hit'}, stats.get('hits', 0) + stats.get('shared_hits', 0)))
+        lookups.append(({'cache': name, 'result': 'miss'}, stats.get('misses', 0)))
+        hit_rates.append(({'cache': name}, stats.get('hit_rate', 0.0)))
+    return [
+        ('rag_cache_lookups_total', 'counter', 'Cache lookups by cache and result.', lookups),
+        ('rag_cache_hit_ratio', 'gauge', 'Hit ratio since process start.', hit_rates),
+    ]
+
+def _queue_metrics():
+    from django.db.models import Count
+    from api.models import IngestionJob
+    from api.embeddings import get_embedding_service
+    from api import interaction_log, llm, tts
+    counts = dict(IngestionJob.objects.values_list('status').annotate(total=Count('id')).values_list('status', 'total'))
+    families = [
+        ('rag_ingestion_jobs', 'gauge', 'Ingestion jobs by status.', [
+            ({'status': job_status}, counts.get(job_status, 0))
+            for job_status in (IngestionJob.STATUS_QUEUED, IngestionJob.STATUS_RUNNING, IngestionJob.STATUS_FAILED)
+        ]),
+        ('rag_embedding_queue_depth', 'gauge', 'Query encodes waiting for the micro-batcher.', [
+            ({}, get_embedding_service().queue_depth()),
+        ]),
+    ]
+    # Only report on a client that already exists; scraping should not initialise the backend
+    client = llm._client
+    if client is not None:
+        families.append(('rag_llm_in_flight', 'gauge', 'LLM calls currently holding a concurrency slot.', [
+            ({}, client.in_flight()),
+        ]))
+    speech = tts._service
+    if speech is not None:
+        families.append(('rag_tts_queue_depth', 'gauge', 'Speech segments queued or synthesizing.', [
+            ({}, speech.queue_depth()),
+        ]))
+    writer = interaction_log._writer
+    if writer is not None:
+        families.append(('rag_interaction_log_queue_depth', 'gauge', 'Interaction log rows buffered and not yet written.', [
+            ({}, writer.queue_depth()),
+        ]))
+    return families
+
+REGISTRY.register_collector(_cache_metrics)
+REGISTRY.register_collector(_queue_metrics)
+
+def render_metrics():
+    return REGISTRY.render()
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2025-07-23 09:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_ingestionjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='indexed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
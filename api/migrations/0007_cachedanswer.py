@@ -0,0 +1,29 @@
+# Generated by Django 5.2.4 on 2025-07-28 14:17
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_document_content_hash_document_indexed_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedAnswer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('question', models.TextField()),
+                ('embedding', models.BinaryField()),
+                ('context_fingerprint', models.CharField(db_index=True, max_length=64)),
+                ('answer', models.TextField()),
+                ('sources', models.JSONField(default=list)),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('documents', models.ManyToManyField(blank=True, related_name='cached_answers', to='api.document')),
+            ],
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 5.2.4 on 2025-08-04 09:31
+
+import hashlib
+import django.db.models.deletion
+from django.db import migrations, models
+
+BATCH_SIZE = 2000
+
+def _text_key(text):
+    return hashlib.sha256(text.encode('utf-8')).digest()
+
+def link_states_to_interactions(apps, schema_editor):
+    # States used to hold a full copy of the answer. Point each one at the user's latest
+    # interaction with that answer, keep the most recently updated row per
+    # (user, interaction, voice) and drop rows whose answer no longer exists.
+    InteractionLog = apps.get_model('api', 'InteractionLog')
+    TTSState = apps.get_model('api', 'TTSState')
+
+    latest = {}
+    interactions = InteractionLog.objects.filter(user__isnull=False).order_by('id').values_list('id', 'user_id', 'answer')
+    for interaction_id, user_id, answer in interactions.iterator(chunk_size=BATCH_SIZE):
+        latest[(user_id, _text_key(answer))] = interaction_id
+
+    keep = {}
+    drop = []
+    states = TTSState.objects.order_by('id').values_list('id', 'user_id', 'text', 'voice_id', 'updated_at')
+    for state_id, user_id, text, voice_id, updated_at in states.iterator(chunk_size=BATCH_SIZE):
+        interaction_id = latest.get((user_id, _text_key(text)))
+        if interaction_id is None:
+            drop.append(state_id)
+            continue
+        key = (user_id, interaction_id, voice_id)
+        current = keep.get(key)
+        if current is None or updated_at >= current[1]:
+            if current is not None:
+                drop.append(current[0])
+            keep[key] = (state_id, updated_at)
+        else:
+            drop.append(state_id)
+
+    for start in range(0, len(drop), BATCH_SIZE):
+        TTSState.objects.filter(id__in=drop[start:start + BATCH_SIZE]).delete()
+    updates = [TTSState(id=state_id, interaction_id=interaction_id) for (_, interaction_id, _), (state_id, _) in keep.items()]
+    TTSState.objects.bulk_update(updates, ['interaction'], batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_cachedanswer'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ttsstate',
+            name='interaction',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='tts_states', to='api.interactionlog'),
+        ),
+        migrations.RunPython(link_states_to_interactions, reverse_code=migrations.RunPython.noop, elidable=True),
+        migrations.RemoveField(
+            model_name='ttsstate',
+            name='text',
+        ),
+        migrations.AlterField(
+            model_name='ttsstate',
+            name='interaction',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tts_states', to='api.interactionlog'),
+        ),
+        migrations.AddConstraint(
+            model_name='ttsstate',
+            constraint=models.UniqueConstraint(fields=('user', 'interaction', 'voice_id'), name='api_tts_user_interaction_voice_uniq'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.4 on 2025-08-05 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_ttsstate_interaction'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='interactionlog',
+            index=models.Index(fields=['user', '-timestamp'], name='api_interaction_user_ts_idx'),
+        ),
+    ]
@@ -1,14 +1,55 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 class Document(models.Model):
     file_name = models.CharField(max_length=255)
     file = models.FileField(upload_to='documents/')
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    # Set for API uploads; documents added by management commands or the admin have none
+    uploaded_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='documents')
+    # SHA-256 of the file contents last indexed into the knowledge base
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    indexed_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return self.file_name
 
+class IngestionJob(models.Model):
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='ingestion_jobs')
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    stage = models.CharField(max_length=32, default='queued')
+    progress = models.FloatField(default=0.0)
+    stage_timings = models.JSONField(default=dict, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    next_run_at = models.DateTimeField(default=timezone.now)
+    error = models.TextField(blank=True)
+    worker = models.CharField(max_length=64, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_run_at'], name='api_ingest_status_next_idx'),
+        ]
+
+    def __str__(self):
+        return f"Ingestion of {self.document.file_name} ({self.status})"
+
 class InteractionLog(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True)
     question = models.TextField()
@@ -16,13 +57,51 @@ class InteractionLog(models.Model):
     sources = models.JSONField()
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', '-timestamp'], name='api_interaction_user_ts_idx'),
+        ]
+
+class CachedAnswer(models.Model):
+    question = models.TextField()
+    # float32 bytes of the L2-normalised question embedding
+    embedding = models.BinaryField()
+    # Hash of the retrieved chunk ids the answer was generated from
+    context_fingerprint = models.CharField(max_length=64, db_index=True)
+    answer = models.TextField()
+    sources = models.JSONField(default=list)
+    documents = models.ManyToManyField(Document, related_name='cached_answers', blank=True)
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return self.question[:80]
+
 class TTSState(models.Model):
+    # Playback position per user, answer and voice
     user = models.ForeignKey(User, on_delete=models.CASCADE)
-    text = models.TextField()
+    interaction = models.ForeignKey(InteractionLog, on_delete=models.CASCADE, related_name='tts_states')
     position = models.IntegerField(default=0)
     voice_id = models.CharField(max_length=255, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # The constraint's index also serves the text-to-speech lookups by (user, interaction)
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'interaction', 'voice_id'], name='api_tts_user_interaction_voice_uniq'),
+        ]
+
+    @classmethod
+    def save_position(cls, user, interaction, voice_id, position):
+        # One INSERT ... ON CONFLICT DO UPDATE on the unique key, no read first
+        cls.objects.bulk_create(
+            [cls(user=user, interaction=interaction, voice_id=voice_id, position=position)],
+            update_conflicts=True,
+            unique_fields=['user', 'interaction', 'voice_id'],
+            update_fields=['position', 'updated_at'],
+        )
+
     def __str__(self):
         return f"TTS for {self.user.username} at position {self.position}"
\ No newline at end of file
@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import threading
+import time
+import numpy as np
+from django.conf import settings
+from api.metrics import RERANK_SKIPPED, observe
+
+logger = logging.getLogger(__name__)
+
+class CrossEncoderBackend:
+    def __init__(self, model_name):
+        from sentence_transformers import CrossEncoder
+        self.model = CrossEncoder(model_name, device='cpu')
+
+    def score(self, question, texts):
+        pairs = [(question, text) for text in texts]
+        return np.asarray(self.model.predict(pairs, batch_size=len(pairs), show_progress_bar=False), dtype=np.float32)
+
+class OnnxBackend:
+    # Quantized ONNX export published alongside the cross-encoder on the Hugging Face hub,
+    # run with ONNX Runtime and the fast tokenizer; no PyTorch needed
+    def __init__(self, model_name):
+        import onnxruntime
+        from huggingface_hub import hf_hub_download
+        from tokenizers import Tokenizer
+        self.tokenizer = Tokenizer.from_file(hf_hub_download(model_name, 'tokenizer.json'))
+        self.tokenizer.enable_truncation(max_length=settings.RERANK_MAX_LENGTH)
+        self.tokenizer.enable_padding()
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = settings.RERANK_THREADS
+        self.session = onnxruntime.InferenceSession(
+            hf_hub_download(model_name, settings.RERANK_ONNX_FILE),
+            sess_options=options,
+            providers=['CPUExecutionProvider'],
+        )
+        self.input_names = {node.name for node in self.session.get_inputs()}
+
+    def score(self, question, texts):
+        encodings = self.tokenizer.encode_batch([(question, text) for text in texts])
+        inputs = {
+            'input_ids': np.asarray([e.ids for e in encodings], dtype=np.int64),
+            'attention_mask': np.asarray([e.attention_mask for e in encodings], dtype=np.int64),
+            'token_type_ids': np.asarray([e.type_ids for e in encodings], dtype=np.int64),
+        }
+        logits = self.session.run(None, {name: value for name, value in inputs.items() if name in self.input_names})[0]
+        return logits.reshape(len(texts), -1)[:, 0].astype(np.float32)
+
+BACKENDS = {
+    'cross-encoder': CrossEncoderBackend,
+    'onnx': OnnxBackend,
+}
+
+class Reranker:
+    # Scores (question, chunk) pairs with a cross-encoder and keeps the best top_k. Scoring is
+    # done in batches against a deadline: if the expected cost (from a moving average of the
+    # per-pair latency) does not fit, or the next batch would pass the deadline, the incoming
+    # order is kept so a slow re-ranker never holds up the answer. While requests are being
+    # skipped as over budget, one is let through every probe_interval seconds to re-measure.
+    def __init__(self, model_name, backend='onnx', batch_size=16, probe_interval=30.0):
+        self.model_name = model_name
+        self.backend_name = backend
+        self.batch_size = batch_size
+        self.probe_interval = probe_interval
+        self.seconds_per_pair = None
+        self.reranked = 0
+        self.skipped = 0
+        self._measured_at = 0.0
+        self._backend = None
+        self._load_lock = threading.Lock()
+        # ONNX Runtime and torch already use every core for one batch; running batches
+        # from concurrent requests side by side only adds contention
+        self._run_lock = threading.Lock()
+        self._probe_lock = threading.Lock()
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            with self._load_lock:
+                if self._backend is None:
+                    start = time.time()
+                    self._backend = BACKENDS[self.backend_name](self.model_name)
+                    logger.info("Loaded %s re-ranker %s in %.2f seconds", self.backend_name, self.model_name, time.time() - start)
+        return self._backend
+
+    def warm_up(self):
+        self.backend.score("warm up", ["warm up"])
+
+    def _fits(self, count, deadline):
+        if deadline is None or self.seconds_per_pair is None:
+            return deadline is None or time.monotonic() < deadline
+        return time.monotonic() + self.seconds_per_pair * count < deadline
+
+    def _probe_due(self):
+        # Lets one over-budget request through per interval, so a single slow call (or a
+        # busy moment) cannot switch re-ranking off for the life of the process
+        with self._probe_lock:
+            now = time.monotonic()
+            if now - self._measured_at < self.probe_interval:
+                return False
+            self._measured_at = now
+            return True
+
+    def _measure(self, elapsed, pairs, probe=False):
+        # A probe replaces the estimate that was skipping requests instead of nudging it
+        per_pair = elapsed / pairs
+        if self.seconds_per_pair is None or probe:
+            self.seconds_per_pair = per_pair
+        else:
+            self.seconds_per_pair = 0.8 * self.seconds_per_pair + 0.2 * per_pair
+        self._measured_at = time.monotonic()
+
+    def rerank(self, question, results, top_k, deadline=None, timings=None):
+        if len(results) <= 1:
+            return results[:top_k]
+        probe = False
+        if not self._fits(len(results), deadline):
+            probe = self._probe_due()
+            if not probe:
+                return self._skip(results, top_k, timings, 'over budget')
+
+        # Loaded before timing starts (normally already done by warm_up at startup), so the
+        # load is never mistaken for scoring time
+        backend = self.backend
+        scores = []
+        texts = [result['text'] for result in results]
+        with self._run_lock:
+            # Timed once the lock is held: waiting for other requests is not scoring either
+            start = time.monotonic()
+            for offset in range(0, len(texts), self.batch_size):
+                batch = texts[offset:offset + self.batch_size]
+                if deadline is not None:
+                    # This call's own speed so far predicts whether the next batch still fits
+                    now = time.monotonic()
+                    if now >= deadline or (scores and now + (now - start) / len(scores) * len(batch) > deadline):
+                        if scores:
+                            self._measure(now - start, len(scores), probe)
+                        return self._skip(results, top_k, timings, 'deadline passed')
+                scores.extend(backend.score(question, batch).tolist())
+            elapsed = time.monotonic() - start
+
+        self._measure(elapsed, len(texts), probe)
+        self.reranked += 1
+        observe('rerank', elapsed, timings)
+
+        order = np.argsort(-np.asarray(scores), kind='stable')[:top_k]
+        return [dict(results[i], rerank_score=scores[i]) for i in order]
+
+    def _skip(self, results, top_k, timings, reason):
+        self.skipped += 1
+        RERANK_SKIPPED.inc(reason=reason)
+        logger.info("Skipped re-ranking of %s candidates: %s", len(results), reason)
+        if timings is not None:
+            timings['rerank_skipped'] = reason
+        return results[:top_k]
+
+    def stats(self):
+        return {
+            'model': self.model_name,
+            'backend': self.backend_name,
+            'reranked': self.reranked,
+            'skipped': self.skipped,
+            'ms_per_pair': round(self.seconds_per_pair * 1000, 3) if self.seconds_per_pair is not None else None,
+        }
+
+_reranker = None
+_reranker_lock = threading.Lock()
+
+def get_reranker():
+    global _reranker
+    if _reranker is None:
+        with _reranker_lock:
+            if _reranker is None:
+                _reranker = Reranker(
+                    settings.RERANK_MODEL, settings.RERANK_BACKEND, settings.RERANK_BATCH_SIZE, settings.RERANK_PROBE_INTERVAL,
+                )
+    return _reranker
+
+def warm_up_reranker():
+    # Started from ApiConfig.ready: loads the model before the first question needs it
+    try:
+        start = time.time()
+        get_reranker().warm_up()
+        logger.info("Re-ranker warmed up in %.2f seconds", time.time() - start)
+    except Exception as e:
+        logger.error("Re-ranker warm-up failed, it will load on first use: %s", str(e))
+
+def candidate_count():
+    return settings.RERANK_CANDIDATES if settings.RERANK_ENABLED else settings.RETRIEVAL_CANDIDATES
+
+def rerank(question, results, started=None, timings=None):
+    # `started` is when retrieval began; the budget covers embedding, search and re-ranking
+    if not settings.RERANK_ENABLED:
+        return results
+    deadline = None
+    if settings.RERANK_LATENCY_BUDGET_MS:
+        deadline = (started or time.monotonic()) + settings.RERANK_LATENCY_BUDGET_MS / 1000.0
+    try:
+        return get_reranker().rerank(question, results, settings.RERANK_TOP_K, deadline, timings)
+    except Exception as e:
+        logger.error("Re-ranking failed, keeping retrieval order: %s", str(e))
+        RERANK_SKIPPED.inc(reason='error')
+        if timings is not None:
+            timings['rerank_skipped'] = 'error'
+        return results[:settings.RERANK_TOP_K]
+
+async def arerank(question, results, started=None, timings=None):
+    if not settings.RERANK_ENABLED:
+        return results
+    return await asyncio.to_thread(rerank, question, results, started, timings)
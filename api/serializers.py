@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .models import Document, TTSState
+from .models import Document, IngestionJob, TTSState
 from drf_spectacular.utils import extend_schema_field
 
 class DocumentSerializer(serializers.ModelSerializer):
@@ -22,8 +22,24 @@ class DocumentSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("File name is required.")
         return value
 
+class IngestionJobSerializer(serializers.ModelSerializer):
+    document_id = serializers.IntegerField(read_only=True)
+    file_name = serializers.CharField(source='document.file_name', read_only=True)
+
+    class Meta:
+        model = IngestionJob
+        fields = [
+            'id', 'document_id', 'file_name', 'status', 'stage', 'progress', 'stage_timings',
+            'attempts', 'max_attempts', 'next_run_at', 'error', 'created_at', 'started_at', 'finished_at',
+        ]
+        read_only_fields = fields
+
 class AskQuestionSerializer(serializers.Serializer):
     question = serializers.CharField(max_length=1000, help_text="Question to query the knowledge base")
+    document_ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), required=False, allow_empty=True, max_length=100,
+        help_text="Restrict retrieval to these document IDs (optional)"
+    )
 
 class TTSSerializer(serializers.Serializer):
     answer_id = serializers.IntegerField(help_text="ID of the InteractionLog entry to convert to speech")
@@ -1,9 +1,30 @@
-from django.db.models.signals import post_save
+import logging
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
 from .models import Document
-from .utils import process_document
+from .ingestion import enqueue_document
+from .utils import delete_document_vectors
+from .answer_cache import invalidate_documents
 
+logger = logging.getLogger(__name__)
+
+# Single trigger point for ingestion: uploads, admin edits and scripts all go through the job queue.
+# Unchanged files are detected by content hash inside process_document and become no-ops.
 @receiver(post_save, sender=Document)
-def process_uploaded_document(sender, instance, created, **kwargs):
-    if created:
-        process_document(instance.id)
\ No newline at end of file
+def queue_document_ingestion(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    enqueue_document(instance)
+
+# Runs before the cascade removes the cached answer links, so affected answers can still be found
+@receiver(pre_delete, sender=Document)
+def invalidate_cached_answers(sender, instance, **kwargs):
+    invalidate_documents([instance.id])
+
+@receiver(post_delete, sender=Document)
+def remove_document_vectors(sender, instance, **kwargs):
+    try:
+        delete_document_vectors(instance.id)
+    except Exception as e:
+        # Never block the delete itself; orphaned vectors can be cleared with delete_document_vectors
+        logger.error("Failed to remove vectors for document %s: %s", instance.id, str(e))
@@ -1,3 +1,758 @@
-from django.test import TestCase
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+from unittest import mock
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+from api import answer_cache, cache, embedding_store, embeddings, keyword_index, vectorstore
+from api.chunking import TokenChunker
+from api.ingestion import JobReporter, claim_next_job, enqueue_document, run_job
+from api.interaction_log import IdAllocator, InteractionLogWriter, get_logged_interaction
+from api.keyword_index import KeywordIndex, get_keyword_index, reciprocal_rank_fusion
+from api.reranking import Reranker
+from api.tts import SegmentCache, SpeechService, split_sentences
+from api.management.commands import ingest as ingest_command
+from api.management.commands.benchmark import write_synthetic_pdf
+from api.llm import CircuitBreaker, CircuitOpenError, LLMBackend, LLMBusyError, LLMClient
+from api.local_index import LocalVectorStore
+from api.models import Document, IngestionJob, InteractionLog
+from api.context import score
+from api.utils import _fuse, query_knowledge_base
+from api.vectorstore import get_vector_store
 
-# Create your tests here.
+
+class ScriptedBackend(LLMBackend):
+    def __init__(self):
+        self.fail = False
+
+    def generate(self, prompt, timeout):
+        if self.fail:
+            raise ConnectionError("upstream down")
+        return 'answer'
+
+    def stream(self, prompt, timeout):
+        if self.fail:
+            raise ConnectionError("upstream down")
+        yield 'first'
+        yield 'second'
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def make_client(self, reset_timeout=0, max_concurrency=2):
+        self.backend = ScriptedBackend()
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=reset_timeout)
+        return LLMClient(self.backend, timeout=1, max_concurrency=max_concurrency, max_retries=0, retry_backoff=0, breaker=breaker)
+
+    def open_circuit(self, client):
+        self.backend.fail = True
+        with self.assertRaises(ConnectionError):
+            client.generate('question', 'context')
+        self.backend.fail = False
+
+    def test_open_circuit_rejects_then_half_open_trial_closes_it(self):
+        client = self.make_client(reset_timeout=60)
+        self.open_circuit(client)
+        self.assertEqual(client.breaker.state, 'open')
+        with self.assertRaises(CircuitOpenError):
+            client.generate('question', 'context')
+        client.breaker.opened_at -= 60
+        self.assertEqual(client.breaker.state, 'half-open')
+        self.assertEqual(client.generate('question', 'context'), 'answer')
+        self.assertEqual(client.breaker.state, 'closed')
+        self.assertEqual(client.in_flight(), 0)
+
+    def test_failed_trial_reopens_circuit(self):
+        client = self.make_client(reset_timeout=60)
+        self.open_circuit(client)
+        client.breaker.opened_at -= 60
+        self.open_circuit(client)
+        self.assertEqual(client.breaker.state, 'open')
+
+    def test_stream_closed_by_client_releases_trial(self):
+        client = self.make_client()
+        self.open_circuit(client)
+        stream = client.stream('question', 'context')
+        self.assertEqual(next(stream), 'first')
+        stream.close()
+        self.assertEqual(client.in_flight(), 0)
+        self.assertEqual(client.generate('question', 'context'), 'answer')
+        self.assertEqual(client.breaker.state, 'closed')
+
+    def test_async_stream_closed_by_client_releases_trial(self):
+        client = self.make_client()
+        self.open_circuit(client)
+
+        async def read_one_piece():
+            stream = client.astream('question', 'context')
+            piece = await stream.__anext__()
+            await stream.aclose()
+            return piece
+
+        self.assertEqual(asyncio.run(read_one_piece()), 'answer')
+        self.assertEqual(asyncio.run(client.agenerate('question', 'context')), 'answer')
+        self.assertEqual(client.breaker.state, 'closed')
+
+    def test_busy_call_does_not_take_the_trial(self):
+        client = self.make_client(max_concurrency=1)
+        self.open_circuit(client)
+        client._slots.acquire()
+        try:
+            with self.assertRaises(LLMBusyError):
+                client.generate('question', 'context', timeout=0.05)
+        finally:
+            client._slots.release()
+        self.assertEqual(client.generate('question', 'context'), 'answer')
+        self.assertEqual(client.breaker.state, 'closed')
+
+    def test_non_retryable_error_leaves_breaker_unchanged(self):
+        client = self.make_client(reset_timeout=60)
+        client.breaker.failure_threshold = 2
+        client.breaker.record_failure()
+        with mock.patch.object(self.backend, 'generate', side_effect=ValueError("prompt rejected")):
+            with self.assertRaises(ValueError):
+                client.generate('question', 'context')
+        self.assertEqual(client.breaker.failures, 1)
+        self.open_circuit(client)
+        self.assertEqual(client.breaker.state, 'open')
+
+    def test_sync_and_async_calls_share_the_concurrency_limit(self):
+        client = self.make_client(max_concurrency=1)
+        client._slots.acquire()
+        try:
+            with self.assertRaises(LLMBusyError):
+                asyncio.run(client.agenerate('question', 'context', timeout=0.05))
+        finally:
+            client._slots.release()
+        self.assertEqual(asyncio.run(client.agenerate('question', 'context')), 'answer')
+        self.assertEqual(client.in_flight(), 0)
+        self.assertTrue(client._slots.acquire(blocking=False))
+        client._slots.release()
+
+
+class TemporaryDirectoryMixin:
+    def make_dir(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path, ignore_errors=True)
+        return path
+
+
+@override_settings(INGESTION_WORKERS=0, INGESTION_RETRY_BACKOFF=30)
+class IngestionJobTests(TemporaryDirectoryMixin, TestCase):
+    def setUp(self):
+        media = override_settings(MEDIA_ROOT=self.make_dir())
+        media.enable()
+        self.addCleanup(media.disable)
+        self.document = Document.objects.create(
+            file_name='guide.pdf', file=SimpleUploadedFile('guide.pdf', b'%PDF-1.4 test'),
+        )
+
+    def claim(self):
+        job = claim_next_job('test-worker')
+        self.assertIsNotNone(job)
+        return job
+
+    def test_saving_a_document_queues_one_job(self):
+        job = self.document.ingestion_jobs.get()
+        self.assertEqual(job.status, IngestionJob.STATUS_QUEUED)
+        self.assertEqual(enqueue_document(self.document), job)
+
+    def test_job_status_is_only_visible_to_the_uploader_and_staff(self):
+        owner, other = User.objects.create_user('owner'), User.objects.create_user('other')
+        Document.objects.filter(id=self.document.id).update(uploaded_by=owner)
+        url = reverse('ingestion-job', kwargs={'job_id': self.document.ingestion_jobs.get().id})
+        client = APIClient()
+        for user, expected in ((owner, 200), (other, 404), (User.objects.create_user('admin', is_staff=True), 200)):
+            client.force_authenticate(user)
+            self.assertEqual(client.get(url).status_code, expected)
+
+    def test_successful_run_finishes_the_job(self):
+        job = self.claim()
+        self.assertEqual((job.status, job.attempts, job.worker), (IngestionJob.STATUS_RUNNING, 1, 'test-worker'))
+        self.assertIsNone(claim_next_job('other-worker'))
+        with mock.patch('api.ingestion.process_document', return_value=True):
+            run_job(job)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.stage, job.progress), (IngestionJob.STATUS_SUCCEEDED, 'done', 1.0))
+        self.assertIsNotNone(job.finished_at)
+
+    def test_failed_run_is_retried_with_backoff_then_fails(self):
+        IngestionJob.objects.update(max_attempts=2)
+        job = self.claim()
+        with mock.patch('api.ingestion.process_document', side_effect=RuntimeError('parser crashed')):
+            run_job(job)
+            job.refresh_from_db()
+            self.assertEqual(job.status, IngestionJob.STATUS_QUEUED)
+            self.assertEqual(job.error, 'parser crashed')
+            self.assertGreater(job.next_run_at, timezone.now())
+            # Not due yet
+            self.assertIsNone(claim_next_job('test-worker'))
+
+            IngestionJob.objects.update(next_run_at=timezone.now() - timedelta(seconds=1))
+            job = self.claim()
+            self.assertEqual(job.attempts, 2)
+            run_job(job)
+        job.refresh_from_db()
+        self.assertEqual(job.status, IngestionJob.STATUS_FAILED)
+        self.assertIsNone(claim_next_job('test-worker'))
+
+    def make_stale(self, job):
+        IngestionJob.objects.filter(id=job.id).update(updated_at=timezone.now() - timedelta(seconds=120))
+
+    @override_settings(INGESTION_JOB_TIMEOUT=60)
+    def test_stale_running_job_is_reclaimed(self):
+        job = self.claim()
+        self.make_stale(job)
+        job = self.claim()
+        self.assertEqual(job.attempts, 2)
+
+    @override_settings(INGESTION_JOB_TIMEOUT=60)
+    def test_stale_job_on_its_last_attempt_fails_instead_of_rerunning(self):
+        IngestionJob.objects.update(max_attempts=1)
+        job = self.claim()
+        self.make_stale(job)
+        self.assertIsNone(claim_next_job('other-worker'))
+        job.refresh_from_db()
+        self.assertEqual(job.status, IngestionJob.STATUS_FAILED)
+        self.assertIn('stopped responding', job.error)
+
+    def test_reporter_heartbeat_refreshes_updated_at_without_progress(self):
+        job = self.claim()
+        self.make_stale(job)
+        reporter = JobReporter(job, heartbeat=0)
+        reporter('embedding')
+        reporter('embedding')
+        job.refresh_from_db()
+        self.assertGreater(job.updated_at, timezone.now() - timedelta(seconds=60))
+
+    @override_settings(INGESTION_JOB_TIMEOUT=60)
+    def test_original_worker_cannot_overwrite_a_reclaimed_job(self):
+        job = self.claim()
+        self.make_stale(job)
+        reclaimed = claim_next_job('other-worker')
+        with mock.patch('api.ingestion.process_document', return_value=True):
+            run_job(job)
+        reclaimed.refresh_from_db()
+        self.assertEqual((reclaimed.status, reclaimed.worker), (IngestionJob.STATUS_RUNNING, 'other-worker'))
+
+        # Progress reports from the original worker stop its run as soon as it has lost the job
+        def report_progress(document_id, progress):
+            progress('embedding')
+            raise AssertionError('still running after losing the job')
+
+        with mock.patch('api.ingestion.process_document', side_effect=report_progress):
+            run_job(job)
+        reclaimed.refresh_from_db()
+        self.assertEqual((reclaimed.status, reclaimed.error), (IngestionJob.STATUS_RUNNING, ''))
+
+
+@override_settings(INTERACTION_LOG_BUFFERED=True, INTERACTION_LOG_FLUSH_INTERVAL=0.1)
+class InteractionIdTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('reader')
+
+    def test_blocks_from_separate_allocators_never_overlap(self):
+        first, second = IdAllocator(InteractionLog, 3), IdAllocator(InteractionLog, 3)
+        ids = [first.allocate(), second.allocate(), first.allocate(), first.allocate(), first.allocate()]
+        self.assertEqual(ids[2:4], [ids[0] + 1, ids[0] + 2])
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertGreaterEqual(first.high_water(), max(ids))
+        # A direct insert continues after every reserved block
+        row = InteractionLog.objects.create(user=self.user, question='q', answer='a', sources=[])
+        self.assertGreater(row.id, max(ids))
+
+    @mock.patch.object(InteractionLogWriter, '_start')
+    def test_buffered_row_keeps_its_id_when_written(self, _start):
+        writer = InteractionLogWriter(batch_size=100, flush_interval=60, max_queue=1000, id_block=10)
+        interaction = writer.log(self.user, 'question', 'answer', ['doc.pdf - Page 1'])
+        self.assertFalse(InteractionLog.objects.filter(id=interaction.id).exists())
+        writer.ensure_written(interaction.id)
+        self.assertEqual(InteractionLog.objects.get(id=interaction.id).answer, 'answer')
+        self.assertEqual(writer.queue_depth(), 0)
+
+    def test_lookup_waits_only_for_reserved_ids(self):
+        writer = InteractionLogWriter(batch_size=100, flush_interval=60, max_queue=1000, id_block=10)
+        reserved = writer.allocator.allocate()
+        with mock.patch('api.interaction_log.get_interaction_log_writer', return_value=writer):
+            with self.assertRaises(InteractionLog.DoesNotExist):
+                get_logged_interaction(reserved + 1000, self.user)
+            with self.assertRaises(InteractionLog.DoesNotExist):
+                get_logged_interaction(reserved, self.user)
+            row = InteractionLog.objects.create(user=self.user, question='q', answer='a', sources=[])
+            self.assertEqual(get_logged_interaction(row.id, self.user), row)
+            with self.assertRaises(InteractionLog.DoesNotExist):
+                get_logged_interaction(row.id, User.objects.create_user('someone-else'))
+
+
+class WordCounter:
+    def count_many(self, texts):
+        return [len(text.split()) for text in texts]
+
+
+class ChunkerTests(SimpleTestCase):
+    def test_chunks_report_the_pages_they_span(self):
+        chunker = TokenChunker(max_tokens=8, overlap_tokens=3, model_name='test')
+        chunker.counter = WordCounter()
+        pages = [
+            (1, 'Alpha one two three. Beta four five.'),
+            (2, 'Gamma six seven. Delta eight nine ten.'),
+            (3, ''),
+            (4, 'Epsilon eleven.'),
+        ]
+        chunks = list(chunker.chunk(iter(pages)))
+        self.assertEqual([(chunk.page_start, chunk.page_end) for chunk in chunks], [(1, 1), (1, 2), (2, 2), (4, 4)])
+        # The overlap carries the last sentence of page 1 into the next chunk
+        self.assertTrue(chunks[1].text.startswith('Beta four five.'))
+        self.assertTrue(all(chunk.token_count <= 8 for chunk in chunks))
+
+
+class ReciprocalRankFusionTests(SimpleTestCase):
+    def test_results_in_both_lists_rank_first(self):
+        dense = [{'id': 'a', 'source': 'dense'}, {'id': 'b', 'source': 'dense'}, {'id': 'c', 'source': 'dense'}]
+        keyword = [{'id': 'c', 'source': 'keyword'}, {'id': 'd', 'source': 'keyword'}]
+        fused = reciprocal_rank_fusion([dense, keyword], k=60)
+        self.assertEqual([result['id'] for result in fused][:2], ['c', 'a'])
+        self.assertEqual({result['id'] for result in fused[2:]}, {'b', 'd'})
+        # The first copy of a chunk is kept
+        self.assertEqual(fused[0]['source'], 'dense')
+        self.assertEqual(len(reciprocal_rank_fusion([dense, keyword], k=60, limit=2)), 2)
+
+
+def chunk(document_id, index, text):
+    return {'id': f'doc{document_id}-{index}', 'text': text, 'metadata': {'document_id': document_id}}
+
+
+class KeywordIndexTests(TemporaryDirectoryMixin, SimpleTestCase):
+    def setUp(self):
+        self.path = self.make_dir()
+        self.index = KeywordIndex(self.path)
+        self.index.add_document(1, [chunk(1, 0, 'Pivot tables summarise a worksheet'), chunk(1, 1, 'Charts show trends')])
+        self.index.add_document(2, [chunk(2, 0, 'Mail merge in Word'), chunk(2, 1, 'Pivot charts in Excel')])
+
+    def ids(self, query, **kwargs):
+        return [result['id'] for result in self.index.search(query, **kwargs)]
+
+    def test_exact_terms_rank_and_filter(self):
+        self.assertEqual(self.ids('pivot tables'), ['doc1-0', 'doc2-1'])
+        self.assertEqual(self.ids('pivot', document_ids=[2]), ['doc2-1'])
+        # Equal term frequency: the shorter chunk wins
+        self.assertEqual(self.ids('pivot', k=1), ['doc2-1'])
+        self.assertEqual(self.ids('nothing matches'), [])
+
+    def test_replaced_and_removed_documents_update_statistics(self):
+        self.index.add_document(1, [chunk(1, 0, 'Formulas and functions')])
+        self.assertEqual(self.ids('pivot'), ['doc2-1'])
+        self.assertEqual(self.ids('formulas'), ['doc1-0'])
+        self.index.remove_document(2)
+        self.assertEqual(self.ids('pivot'), [])
+        self.assertEqual(self.index._count, 1)
+
+    def test_other_processes_load_segments_with_their_postings(self):
+        reader = KeywordIndex(self.path)
+        self.assertEqual([result['id'] for result in reader.search('pivot tables')], self.ids('pivot tables'))
+        self.index.remove_document(1)
+        reader.refresh(force=True)
+        self.assertEqual([result['id'] for result in reader.search('pivot')], ['doc2-1'])
+
+
+@override_settings(KEYWORD_INDEX_ENABLED=True)
+class HybridScoreTests(SimpleTestCase):
+    def test_keyword_only_hits_get_a_comparable_score(self):
+        dense = [{'id': 'a', 'text': 'a', 'metadata': {}, 'distance': 0.4}]
+        keyword = [
+            {'id': 'b', 'text': 'b', 'metadata': {}, 'distance': None, 'bm25': 8.0},
+            {'id': 'a', 'text': 'a', 'metadata': {}, 'distance': None, 'bm25': 4.0},
+            {'id': 'c', 'text': 'c', 'metadata': {}, 'distance': None, 'bm25': 1.0},
+        ]
+        index = mock.Mock(search=mock.Mock(return_value=keyword))
+        with mock.patch('api.utils.get_keyword_index', return_value=index):
+            fused = {result['id']: result for result in _fuse('question', dense, 5, None)}
+        self.assertAlmostEqual(score(fused['a']), 0.8)
+        # The best keyword hit counts as much as the best dense hit; weak ones fall below
+        # the default CONTEXT_MIN_SCORE
+        self.assertAlmostEqual(score(fused['b']), 0.8)
+        self.assertAlmostEqual(score(fused['c']), 0.1)
+
+
+class CountingStore:
+    def __init__(self):
+        self.queries = 0
+
+    def query(self, embedding, n_results, document_ids=None):
+        self.queries += 1
+        return [{'id': f'chunk-{self.queries}', 'text': 'text', 'metadata': {}, 'distance': 0.1}]
+
+
+@override_settings(RETRIEVAL_CACHE_SHARED_ALIAS=None, KEYWORD_INDEX_ENABLED=False)
+class ResultsCacheTests(TemporaryDirectoryMixin, SimpleTestCase):
+    def test_ingestion_in_another_process_invalidates_cached_results(self):
+        path = f"{self.make_dir()}/collection_version"
+        store = CountingStore()
+        with mock.patch.object(cache, 'version_file', cache.VersionFile(path)), \
+                mock.patch('api.utils.get_vector_store', return_value=store), \
+                mock.patch('api.utils.embed_question', return_value=np.ones(4, dtype=np.float32)):
+            cache.results_cache.clear()
+            first = query_knowledge_base('results cache question', 5)
+            self.assertEqual(query_knowledge_base('results cache question', 5), first)
+            self.assertEqual(store.queries, 1)
+            # Another process finishing an ingest bumps the shared version file
+            cache.VersionFile(path).bump()
+            self.assertNotEqual(query_knowledge_base('results cache question', 5), first)
+            self.assertEqual(store.queries, 2)
+
+
+@override_settings(ANSWER_CACHE_ENABLED=True)
+class AnswerCacheTests(SimpleTestCase):
+    def test_concurrent_stores_evict_once_per_hundred(self):
+        stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        with mock.patch.dict(answer_cache._stats, stats), \
+                mock.patch.object(answer_cache.CachedAnswer.objects, 'create'), \
+                mock.patch.object(answer_cache, 'evict') as evict:
+            def store(index):
+                answer_cache.store(f"question {index}", np.ones(4), 'fingerprint', 'answer', [], [])
+
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                list(pool.map(store, range(400)))
+        self.assertEqual(evict.call_count, 4)
+
+
+class FakeEmbeddingStore:
+    path = '/unused/test-model'
+
+
+@override_settings(LOCAL_INDEX_IVF_MIN_VECTORS=500, LOCAL_INDEX_LISTS=16, LOCAL_INDEX_NPROBE=4, LOCAL_INDEX_MERGE_FACTOR=2)
+class LocalVectorStoreTests(TemporaryDirectoryMixin, SimpleTestCase):
+    def setUp(self):
+        self.path = self.make_dir()
+        self.store = LocalVectorStore(self.path, FakeEmbeddingStore())
+        rng = np.random.default_rng(0)
+        # Clustered vectors, like real embeddings, so probing a few lists finds the neighbours
+        centers = rng.standard_normal((16, 32)).astype(np.float32)
+        self.vectors = {}
+        for document_id in (1, 2, 3):
+            vectors = centers[rng.integers(0, 16, 300)] + 0.3 * rng.standard_normal((300, 32)).astype(np.float32)
+            self.write(document_id, vectors)
+        self.store.publish()
+        self.queries = centers + 0.3 * rng.standard_normal((16, 32)).astype(np.float32)
+
+    def write(self, document_id, vectors, publish=False):
+        records = [
+            {'id': f'{document_id}-{row}', 'text': f'chunk {row}', 'metadata': {'document_id': document_id}}
+            for row in range(len(vectors))
+        ]
+        # In batches, as process_document writes them
+        for start in range(0, len(records), 128):
+            self.store.write_chunks(document_id, records[start:start + 128], vectors[start:start + 128])
+        self.store.finish_document(document_id, [record['id'] for record in records], publish=publish)
+        self.vectors[document_id] = vectors
+
+    def exact(self, query, k, document_ids):
+        ids, rows = [], []
+        for document_id in document_ids:
+            vectors = self.vectors[document_id]
+            rows.append(vectors / np.linalg.norm(vectors, axis=1, keepdims=True))
+            ids.extend(f'{document_id}-{row}' for row in range(len(vectors)))
+        scores = np.vstack(rows) @ (query / np.linalg.norm(query))
+        return {ids[row] for row in np.argsort(-scores)[:k]}
+
+    def test_merged_ivf_segment_has_high_recall(self):
+        stats = self.store.stats()
+        self.assertEqual((stats['chunks'], stats['documents']), (900, 3))
+        self.assertEqual(stats['ivf_segments'], 1)
+        found = sum(
+            len({hit['id'] for hit in self.store.query(query, 10)} & self.exact(query, 10, (1, 2, 3)))
+            for query in self.queries
+        )
+        self.assertGreaterEqual(found / (10 * len(self.queries)), 0.9)
+
+    def test_document_filter_and_delete(self):
+        hits = self.store.query(self.queries[0], 10, document_ids=[2])
+        self.assertEqual({hit['metadata']['document_id'] for hit in hits}, {2})
+        self.store.delete_document(2)
+        self.assertEqual(self.store.count(2), 0)
+        self.assertEqual(self.store.count(), 600)
+        self.assertEqual(self.store.query(self.queries[0], 10, document_ids=[2]), [])
+        for query in self.queries:
+            self.assertNotIn(2, {hit['metadata']['document_id'] for hit in self.store.query(query, 10)})
+        # Another process opening the index sees the same state
+        self.assertEqual(LocalVectorStore(self.path, FakeEmbeddingStore()).count(), 600)
+
+    def test_unpublished_writes_stay_invisible_to_queries(self):
+        self.write(4, np.ones((5, 32), dtype=np.float32))
+        self.assertEqual(self.store.count(4), 0)
+        self.assertNotIn(4, {hit['metadata']['document_id'] for hit in self.store.query(np.ones(32), 10)})
+        self.store.publish()
+        self.assertEqual(self.store.count(4), 5)
+        self.assertEqual({hit['metadata']['document_id'] for hit in self.store.query(np.ones(32), 5)}, {4})
+
+
+class TimedBackend:
+    # Scores by text length; load and per-pair costs are simulated with sleeps
+    load_seconds = 0.0
+    seconds_per_pair = 0.0
+
+    def __init__(self, model_name):
+        time.sleep(self.load_seconds)
+
+    def score(self, question, texts):
+        time.sleep(self.seconds_per_pair * len(texts))
+        return np.asarray([len(text) for text in texts], dtype=np.float32)
+
+
+class RerankerBudgetTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.dict('api.reranking.BACKENDS', {'timed': TimedBackend})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        TimedBackend.load_seconds = TimedBackend.seconds_per_pair = 0.0
+        self.results = [{'id': str(i), 'text': 'x' * i} for i in range(1, 9)]
+
+    def rerank(self, reranker, budget=0.2):
+        timings = {}
+        ranked = reranker.rerank('question', self.results, 3, time.monotonic() + budget, timings)
+        return [result['id'] for result in ranked], timings.get('rerank_skipped')
+
+    def test_model_load_is_not_counted_as_scoring_time(self):
+        TimedBackend.load_seconds = 0.5
+        reranker = Reranker('model', 'timed', batch_size=4)
+        # Loaded by the call itself, after the deadline was set; the scoring still fits
+        self.assertEqual(self.rerank(reranker, budget=0.6), (['8', '7', '6'], None))
+        self.assertLess(reranker.seconds_per_pair, 0.01)
+        self.assertEqual(self.rerank(reranker), (['8', '7', '6'], None))
+
+    def test_slow_batches_stop_at_the_deadline_and_update_the_estimate(self):
+        TimedBackend.seconds_per_pair = 0.02
+        reranker = Reranker('model', 'timed', batch_size=2, probe_interval=3600)
+        reranker.warm_up()
+        self.assertEqual(self.rerank(reranker, budget=0.1), (['1', '2', '3'], 'deadline passed'))
+        self.assertGreater(reranker.seconds_per_pair, 0.01)
+        self.assertEqual(self.rerank(reranker, budget=0.1)[1], 'over budget')
+
+    def test_skipped_requests_probe_the_speed_again(self):
+        reranker = Reranker('model', 'timed', batch_size=4, probe_interval=0.05)
+        reranker.warm_up()
+        reranker.seconds_per_pair = 1.0
+        reranker._measured_at = time.monotonic()
+        self.assertEqual(self.rerank(reranker)[1], 'over budget')
+        time.sleep(0.06)
+        # The probe finds the model fast again, and later requests are re-ranked as usual
+        self.assertEqual(self.rerank(reranker), (['8', '7', '6'], None))
+        self.assertLess(reranker.seconds_per_pair, 0.01)
+        self.assertEqual(self.rerank(reranker), (['8', '7', '6'], None))
+
+
+class InlineProcessPool(ThreadPoolExecutor):
+    # Stands in for the spawned process pool so workers see the test settings and patches
+    def __init__(self, max_workers, mp_context=None, initializer=None):
+        super().__init__(max_workers=max_workers)
+
+
+def reset_index_singletons():
+    vectorstore.reset()
+    embeddings._service = None
+    keyword_index._index = None
+    embedding_store._stores.clear()
+    cache.results_cache.clear()
+
+
+class IsolatedIndexMixin(TemporaryDirectoryMixin):
+    # Local vector index, embedding store, keyword index and media in a temporary directory,
+    # with offline hashing embeddings and word counts in place of the tokenizer
+    def isolate_indexes(self):
+        root = Path(self.make_dir())
+        overrides = override_settings(
+            MEDIA_ROOT=str(root / 'media'),
+            VECTOR_STORE='local',
+            LOCAL_INDEX_DIR=root / 'local_index',
+            EMBEDDING_STORE_DIR=root / 'embedding_store',
+            EMBEDDING_STORE_ENABLED=True,
+            EMBEDDING_BACKEND='hashing',
+            KEYWORD_INDEX_ENABLED=True,
+            KEYWORD_INDEX_DIR=root / 'keyword_index',
+            RETRIEVAL_CACHE_SHARED_ALIAS=None,
+            INGESTION_WORKERS=0,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        for patcher in (
+            mock.patch.object(cache, 'version_file', cache.VersionFile(str(root / 'collection_version'))),
+            mock.patch('api.chunking.get_token_counter', return_value=WordCounter()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        reset_index_singletons()
+        self.addCleanup(reset_index_singletons)
+        return root
+
+
+@mock.patch('api.management.commands.ingest.ProcessPoolExecutor', InlineProcessPool)
+class IngestCommandTests(IsolatedIndexMixin, TestCase):
+    def setUp(self):
+        self.source = self.isolate_indexes() / 'source'
+        (self.source / 'nested').mkdir(parents=True)
+        write_synthetic_pdf(self.source / 'first.pdf', 2, seed=1)
+        write_synthetic_pdf(self.source / 'nested' / 'second.pdf', 3, seed=2)
+        # Same content under another name: indexed once
+        write_synthetic_pdf(self.source / 'copy.pdf', 2, seed=1)
+
+    def ingest(self, *args):
+        output = StringIO()
+        call_command('ingest', str(self.source), '--workers', '2', '--embed-batch', '8', *args, stdout=output, stderr=StringIO())
+        return output.getvalue()
+
+    def test_indexes_each_file_once_and_resumes(self):
+        output = self.ingest()
+        self.assertIn('Skipping 1 already indexed or duplicate files', output)
+        documents = Document.objects.order_by('file_name')
+        # Paths are taken in sorted order, so the copy is the one indexed
+        self.assertEqual([document.file_name for document in documents], ['copy.pdf', 'second.pdf'])
+        store = get_vector_store()
+        for document in documents:
+            self.assertIsNotNone(document.indexed_at)
+            self.assertGreater(store.count(document.id), 0)
+        second = Document.objects.get(file_name='second.pdf')
+        self.assertTrue(get_keyword_index().search('spreadsheet', document_ids=[second.id]))
+
+        # Unchanged files are skipped from the checkpoint without re-parsing
+        self.assertIn('Nothing to ingest', self.ingest())
+        self.assertEqual(Document.objects.count(), 2)
+
+    def test_failed_file_is_retried_on_the_next_run(self):
+        parse_and_chunk = ingest_command.parse_and_chunk
+
+        def flaky(path):
+            if path.endswith('second.pdf'):
+                raise OSError('disk hiccup')
+            return parse_and_chunk(path)
+
+        with mock.patch.object(ingest_command, 'parse_and_chunk', flaky):
+            self.assertIn('1 failed', self.ingest())
+        self.assertEqual(Document.objects.filter(indexed_at__isnull=True).count(), 1)
+        self.ingest()
+        # The row left by the failed run is reused rather than duplicated
+        self.assertEqual(Document.objects.count(), 2)
+        self.assertFalse(Document.objects.filter(indexed_at__isnull=True).exists())
+
+
+class ReindexCommandTests(IsolatedIndexMixin, TestCase):
+    def setUp(self):
+        root = self.isolate_indexes()
+        source = root / 'source'
+        source.mkdir()
+        write_synthetic_pdf(source / 'first.pdf', 2, seed=1)
+        write_synthetic_pdf(source / 'second.pdf', 3, seed=2)
+        with mock.patch.object(ingest_command, 'ProcessPoolExecutor', InlineProcessPool):
+            call_command('ingest', str(source), '--workers', '1', stdout=StringIO())
+        self.documents = list(Document.objects.order_by('id').values_list('id', flat=True))
+        self.counts = [get_vector_store().count(document_id) for document_id in self.documents]
+        # Lose the search indexes; the embedding store is what they are rebuilt from
+        shutil.rmtree(root / 'local_index')
+        shutil.rmtree(root / 'keyword_index')
+        reset_index_singletons()
+
+    def reindex(self, *args):
+        output = StringIO()
+        # Neither mode should need the embedding model for content it has already seen
+        with mock.patch('api.embeddings.EmbeddingService.encode', side_effect=AssertionError('re-embedded')):
+            call_command('reindex', *args, stdout=output, stderr=StringIO())
+        return output.getvalue()
+
+    def test_bulk_loads_from_the_embedding_store(self):
+        output = self.reindex()
+        self.assertIn('Re-indexed 2 documents', output)
+        self.assertIn('2 bulk-loaded', output)
+        self.assertIn('0 failed', output)
+        self.assertEqual([get_vector_store().count(document_id) for document_id in self.documents], self.counts)
+        self.assertTrue(get_keyword_index().search('spreadsheet'))
+
+    def test_rechunk_reuses_stored_vectors_for_unchanged_text(self):
+        output = self.reindex('--rechunk', '--documents', str(self.documents[0]))
+        self.assertIn('1 re-processed', output)
+        self.assertIn('0 failed', output)
+        self.assertEqual(get_vector_store().count(self.documents[0]), self.counts[0])
+        self.assertEqual(get_vector_store().count(self.documents[1]), 0)
+
+
+class FakeSpeechEngine:
+    # Writes one 16-bit sample per character, slowly enough for requests to overlap
+    def __init__(self):
+        self.texts = []
+        self.lock = threading.Lock()
+
+    def synthesize(self, text, voice_id, path):
+        time.sleep(0.05)
+        with self.lock:
+            self.texts.append(text)
+        with wave.open(path, 'wb') as audio:
+            audio.setnchannels(1)
+            audio.setsampwidth(2)
+            audio.setframerate(8000)
+            audio.writeframes(b'\x01\x00' * len(text))
+
+
+@override_settings(TTS_PREFETCH_SEGMENTS=2, TTS_SYNTH_TIMEOUT=5)
+class SpeechSegmentCacheTests(TemporaryDirectoryMixin, SimpleTestCase):
+    def setUp(self):
+        self.engine = FakeSpeechEngine()
+        patcher = mock.patch('api.tts._worker_engine', return_value=self.engine)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = SegmentCache(self.make_dir(), max_bytes=0)
+        self.service = SpeechService(self.cache, workers=0, queue_size=4)
+
+    def test_segments_are_synthesized_once_and_then_served_from_disk(self):
+        text = 'First sentence here. Second one follows. And a third.'
+        segments = split_sentences(text, max_chars=25)
+        audio = b''.join(self.service.stream(segments, ''))
+        self.assertTrue(audio.startswith(b'RIFF'))
+        self.assertEqual(len(audio), 44 + 2 * sum(len(segment.text) for segment in segments))
+        self.assertEqual(sorted(self.engine.texts), sorted(segment.text for segment in segments))
+
+        # Any user replaying the answer streams the cached files without the engine
+        self.assertEqual(b''.join(self.service.stream(segments, '')), audio)
+        self.assertEqual(len(self.engine.texts), len(segments))
+        # Another voice is another cache entry
+        self.service.request(segments[0].text, 'other-voice').result(timeout=5)
+        self.assertEqual(len(self.engine.texts), len(segments) + 1)
+
+    def test_concurrent_requests_share_one_synthesis(self):
+        futures = [self.service.request('Shared sentence.', '') for _ in range(3)]
+        self.assertEqual(len({future.result(timeout=5) for future in futures}), 1)
+        self.assertEqual(self.engine.texts, ['Shared sentence.'])
+        self.assertEqual(self.service.queue_depth(), 0)
+
+    def test_empty_output_is_not_cached(self):
+        with mock.patch.object(self.engine, 'synthesize'):
+            with self.assertRaises(RuntimeError):
+                self.service.request('Silent sentence.', '').result(timeout=5)
+        self.assertEqual([name for _, _, names in os.walk(self.cache.path) for name in names], [])
+        self.assertEqual(self.service.queue_depth(), 0)
+        self.service.request('Silent sentence.', '').result(timeout=5)
+        self.assertEqual(self.engine.texts, ['Silent sentence.'])
+
+    def test_prune_removes_least_recently_used_files(self):
+        cache = SegmentCache(self.make_dir(), max_bytes=2500)
+        for index, key in enumerate(['aa01', 'bb02', 'cc03']):
+            tmp = cache.temp_path(key)
+            Path(tmp).write_bytes(b'\0' * 1000)
+            os.utime(tmp, (1000 + index, 1000 + index))
+            os.replace(tmp, cache.path_for(key))
+        # Reading a segment marks it as used
+        self.assertIsNotNone(cache.get('aa01'))
+        cache.prune()
+        self.assertIsNone(cache.get('bb02'))
+        self.assertIsNotNone(cache.get('aa01'))
+        self.assertIsNotNone(cache.get('cc03'))
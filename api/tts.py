@@ -0,0 +1,376 @@
+import hashlib
+import logging
+import math
+import multiprocessing
+import os
+import re
+import struct
+import tempfile
+import threading
+import time
+import wave
+from collections import namedtuple
+from concurrent.futures import BrokenExecutor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Character span [start, end) of one synthesized unit within the answer text
+Segment = namedtuple('Segment', ['start', 'end', 'text'])
+
+_SENTENCE_END = re.compile(r'(?<=[.!?;:])\s+|\n\s*\n')
+
+def split_sentences(text, max_chars=None):
+    # Sentence-level segments with their offsets in `text`. Short sentences are merged up
+    # to max_chars and over-long ones are cut at whitespace, so every segment is a
+    # reasonably sized synthesis unit and a character position maps onto a segment.
+    max_chars = max_chars or settings.TTS_SEGMENT_MAX_CHARS
+    pieces = []
+    cursor = 0
+    for match in _SENTENCE_END.finditer(text):
+        pieces.append((cursor, match.start()))
+        cursor = match.end()
+    pieces.append((cursor, len(text)))
+
+    spans = []
+    for start, end in pieces:
+        while end - start > max_chars:
+            cut = text.rfind(' ', start, start + max_chars)
+            if cut <= start:
+                cut = start + max_chars
+            spans.append((start, cut))
+            start = cut
+            while start < end and text[start].isspace():
+                start += 1
+        if text[start:end].strip():
+            spans.append((start, end))
+
+    segments = []
+    for start, end in spans:
+        if segments and end - segments[-1].start <= max_chars:
+            previous = segments.pop()
+            start = previous.start
+        segments.append(Segment(start, end, text[start:end].strip()))
+    return segments
+
+def segment_at(segments, position):
+    # Index of the segment containing character `position` (resume restarts at its start)
+    for index, segment in enumerate(segments):
+        if position < segment.end:
+            return index
+    return len(segments)
+
+def segment_key(text, voice_id, rate):
+    return hashlib.sha256(f"{voice_id}\0{rate}\0{text}".encode('utf-8')).hexdigest()
+
+def wav_stream_header(channels, sample_width, frame_rate):
+    # PCM WAV header with "unknown" RIFF/data sizes, as used for live streams: the total
+    # length is not known until the last segment has been synthesized
+    return (
+        b'RIFF' + struct.pack('<I', 0xFFFFFFFF) + b'WAVE'
+        + b'fmt ' + struct.pack('<IHHIIHH', 16, 1, channels, frame_rate, frame_rate * channels * sample_width, channels * sample_width, sample_width * 8)
+        + b'data' + struct.pack('<I', 0xFFFFFFFF)
+    )
+
+class TTSBusyError(Exception):
+    # The synthesis queue is full; retry_after estimates seconds until a slot frees up
+    def __init__(self, retry_after):
+        super().__init__("Text-to-speech queue is full")
+        self.retry_after = retry_after
+
+class SpeechEngine:
+    # A pyttsx3 engine and its voice list, created once. pyttsx3 hands out one engine per
+    # driver and its runAndWait loop is not re-entrant, so each synthesis worker (a pool
+    # process, or the single in-process thread) owns exactly one of these.
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._engine = None
+        self._voices = None
+
+    def _load(self):
+        if self._engine is None:
+            import pyttsx3
+            engine = pyttsx3.init()
+            if self.rate:
+                engine.setProperty('rate', self.rate)
+            self._voices = [voice.id for voice in engine.getProperty('voices')]
+            self._engine = engine
+        return self._engine
+
+    def voices(self):
+        self._load()
+        return list(self._voices)
+
+    def synthesize(self, text, voice_id, path):
+        # Writes one segment as WAV to `path`
+        engine = self._load()
+        if voice_id:
+            engine.setProperty('voice', voice_id)
+        engine.save_to_file(text, path)
+        engine.runAndWait()
+
+# Worker side: these run in the synthesis pool and must not touch Django
+_engine = None
+
+def _worker_engine(rate):
+    global _engine
+    if _engine is None:
+        _engine = SpeechEngine(rate)
+    return _engine
+
+def list_voices(rate):
+    return _worker_engine(rate).voices()
+
+def synthesize_segment(text, voice_id, rate, path):
+    start = time.monotonic()
+    _worker_engine(rate).synthesize(text, voice_id, path)
+    return time.monotonic() - start
+
+class SegmentCache:
+    # Synthesized segments on disk, keyed by text hash, voice and rate, so the same answer
+    # is synthesized once for every user. Oldest-used files go once TTS_CACHE_MAX_MB is hit.
+    def __init__(self, path, max_bytes):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self._pruned_at = 0.0
+
+    def path_for(self, key):
+        return os.path.join(self.path, key[:2], f"{key}.wav")
+
+    def get(self, key):
+        path = self.path_for(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def temp_path(self, key):
+        directory = os.path.dirname(self.path_for(key))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(suffix='.wav', dir=directory)
+        os.close(fd)
+        return tmp
+
+    def commit(self, key, tmp):
+        path = self.path_for(key)
+        os.replace(tmp, path)
+        self.prune()
+        return path
+
+    def prune(self):
+        now = time.monotonic()
+        if not self.max_bytes or now - self._pruned_at < 60:
+            return
+        self._pruned_at = now
+        files = []
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                if name.endswith('.wav'):
+                    full = os.path.join(root, name)
+                    try:
+                        stat = os.stat(full)
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, full))
+        total = sum(size for _, size, _ in files)
+        for _, size, full in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(full)
+                total -= size
+            except OSError:
+                pass
+
+class SpeechService:
+    # Front end of the synthesis pool. With TTS_WORKERS > 0 segments are synthesized in
+    # spawned processes, each with its own engine, so a crashing driver cannot take the web
+    # worker down; TTS_WORKERS=0 uses one thread in this process instead. At
+    # most TTS_QUEUE_SIZE segments are queued or running; beyond that callers get
+    # TTSBusyError. Concurrent requests for the same segment share one synthesis.
+    def __init__(self, cache, workers, queue_size, rate=None):
+        self.cache = cache
+        self.workers = workers
+        self.queue_size = queue_size
+        self.rate = rate
+        self._executor = None
+        self._pending = 0
+        self._inflight = {}
+        self._voices = None
+        # Seconds per segment, smoothed; used for Retry-After
+        self._seconds_per_segment = 2.0
+        self._lock = threading.Lock()
+        self._slots = threading.Condition(self._lock)
+
+    def _create_executor(self):
+        if self.workers > 0:
+            logger.info("Starting TTS pool with %s processes", self.workers)
+            # spawn, not fork: the web process is multi-threaded and holds DB connections
+            return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return ThreadPoolExecutor(max_workers=1, thread_name_prefix='tts')
+
+    def _submit(self, fn, *args):
+        for attempt in range(2):
+            with self._lock:
+                if self._executor is None:
+                    self._executor = self._create_executor()
+                executor = self._executor
+            try:
+                return executor.submit(fn, *args)
+            except BrokenExecutor:
+                # A worker died; replace the pool once and resubmit
+                with self._lock:
+                    if self._executor is executor:
+                        self._executor = None
+                if attempt:
+                    raise
+
+    def voices(self):
+        if self._voices is None:
+            self._voices = self._submit(list_voices, self.rate).result(timeout=settings.TTS_SYNTH_TIMEOUT)
+        return list(self._voices)
+
+    def queue_depth(self):
+        return self._pending
+
+    def retry_after(self):
+        backlog = self._pending * self._seconds_per_segment / max(self.workers, 1)
+        return int(min(max(math.ceil(backlog), 1), 60))
+
+    def request(self, text, voice_id, limit=None, timeout=0):
+        # Future resolving to the cached WAV path of one segment. `limit` caps how many
+        # slots may be in use for this request to proceed (pre-generation leaves headroom
+        # for listeners); `timeout` is how long to wait for a slot before TTSBusyError.
+        key = segment_key(text, voice_id, self.rate)
+        path = self.cache.get(key)
+        if path is not None:
+            future = Future()
+            future.set_result(path)
+            return future
+        limit = min(limit or self.queue_size, self.queue_size)
+        with self._slots:
+            future = self._inflight.get(key)
+            if future is not None:
+                return future
+            if not self._slots.wait_for(lambda: self._pending < limit, timeout=timeout):
+                raise TTSBusyError(self.retry_after())
+            future = self._inflight.get(key)
+            if future is not None:
+                return future
+            future = Future()
+            self._inflight[key] = future
+            self._pending += 1
+
+        tmp = None
+        try:
+            tmp = self.cache.temp_path(key)
+            work = self._submit(synthesize_segment, text, voice_id, self.rate, tmp)
+        except Exception as e:
+            self._finish(key, tmp, future, error=e)
+            raise
+        work.add_done_callback(lambda work: self._finish(key, tmp, future, work=work))
+        return future
+
+    def _finish(self, key, tmp, future, work=None, error=None):
+        path = None
+        if error is None:
+            try:
+                seconds = work.result()
+                if not os.path.getsize(tmp):
+                    raise RuntimeError("TTS engine produced no audio")
+                path = self.cache.commit(key, tmp)
+                self._seconds_per_segment = 0.8 * self._seconds_per_segment + 0.2 * seconds
+            except BrokenExecutor as e:
+                error = e
+                with self._lock:
+                    self._executor = None
+            except Exception as e:
+                error = e
+        if error is not None and tmp is not None:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+        with self._slots:
+            self._pending -= 1
+            self._inflight.pop(key, None)
+            self._slots.notify_all()
+        if error is not None:
+            logger.error("Speech synthesis failed: %s", str(error))
+            future.set_exception(error)
+        else:
+            future.set_result(path)
+
+    def stream(self, segments, voice_id, on_segment=None):
+        # Returns an iterator of WAV bytes: one streaming header, then each segment's PCM
+        # frames as soon as that segment is ready, with the next TTS_PREFETCH_SEGMENTS
+        # synthesizing meanwhile. The first segment is prepared before returning, so a full
+        # queue (TTSBusyError) or an engine error reaches the caller rather than mid-stream.
+        timeout = settings.TTS_SYNTH_TIMEOUT
+        futures = {0: self.request(segments[0].text, voice_id)}
+
+        def prefetch(index):
+            for ahead in range(index + 1, min(index + 1 + settings.TTS_PREFETCH_SEGMENTS, len(segments))):
+                if ahead not in futures:
+                    try:
+                        futures[ahead] = self.request(segments[ahead].text, voice_id)
+                    except TTSBusyError:
+                        break
+
+        prefetch(0)
+        first = futures[0].result(timeout=timeout)
+        with wave.open(first, 'rb') as audio:
+            header = wav_stream_header(audio.getnchannels(), audio.getsampwidth(), audio.getframerate())
+
+        def generate():
+            yield header
+            for index, segment in enumerate(segments):
+                prefetch(index)
+                future = futures.pop(index, None) or self.request(segment.text, voice_id, timeout=timeout)
+                with wave.open(future.result(timeout=timeout), 'rb') as audio:
+                    while True:
+                        frames = audio.readframes(16384)
+                        if not frames:
+                            break
+                        yield frames
+                if on_segment is not None:
+                    on_segment(segment)
+        return generate()
+
+    def pregenerate(self, text, voice_id=''):
+        # Queues every segment of an answer without waiting, using at most half the queue
+        queued = 0
+        for segment in split_sentences(text):
+            try:
+                self.request(segment.text, voice_id, limit=max(self.queue_size // 2, 1))
+            except TTSBusyError:
+                break
+            queued += 1
+        return queued
+
+_service = None
+_service_lock = threading.Lock()
+
+def get_speech_service():
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = SpeechService(
+                    SegmentCache(settings.TTS_CACHE_DIR, settings.TTS_CACHE_MAX_MB * 1024 * 1024),
+                    workers=settings.TTS_WORKERS,
+                    queue_size=settings.TTS_QUEUE_SIZE,
+                    rate=settings.TTS_RATE,
+                )
+    return _service
+
+def pregenerate_answer(answer):
+    # Called right after an answer is logged: warms the segment cache so a later `play`
+    # streams straight from disk. Never blocks or fails the question request.
+    if not settings.TTS_PREGENERATE or not answer:
+        return
+    try:
+        get_speech_service().pregenerate(answer, settings.TTS_PREGENERATE_VOICE)
+    except Exception as e:
+        logger.warning("TTS pre-generation failed: %s", str(e))
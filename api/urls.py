@@ -1,8 +1,12 @@
 from django.urls import path
-from .views import DocumentUploadView, AskQuestionView, TextToSpeechView
+from .views import DocumentUploadView, IngestionJobView, AskQuestionView, AskQuestionStreamView, AsyncAskQuestionView, CacheStatsView, TextToSpeechView
 
 urlpatterns = [
     path('upload-document/', DocumentUploadView.as_view(), name='upload-document'),
+    path('ingestion-jobs/<int:job_id>/', IngestionJobView.as_view(), name='ingestion-job'),
     path('ask-question/', AskQuestionView.as_view(), name='ask-question'),
+    path('ask-question/async/', AsyncAskQuestionView.as_view(), name='ask-question-async'),
+    path('ask-question/stream/', AskQuestionStreamView.as_view(), name='ask-question-stream'),
+    path('cache-stats/', CacheStatsView.as_view(), name='cache-stats'),
     path('text-to-speech/', TextToSpeechView.as_view(), name='text-to-speech'),
 ]
\ No newline at end of file
@@ -1,86 +1,275 @@
 import os
-import pdfplumber
-import chromadb
+import hashlib
 import logging
-from sentence_transformers import SentenceTransformer
+from django.conf import settings
 from django.core.files.storage import default_storage
+from django.utils import timezone
 from api.models import Document
+from api.vectorstore import get_vector_store
+from api.extraction import iter_pages
+from api.chunking import get_chunker
+from api.embeddings import get_embedding_service
+from api.answer_cache import invalidate_documents
+from api.keyword_index import get_keyword_index, reciprocal_rank_fusion
+from api.context import score
+from api.embedding_store import embedding_store_enabled, get_embedding_store
+from api.metrics import observe_ingest, timed
+from api.cache import (
+    aget_collection_version, bump_collection_version, embedding_cache, embedding_key, get_collection_version, normalize_question, results_cache,
+)
 import time
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Cache the SentenceTransformer model
-MODEL = SentenceTransformer('all-MiniLM-L6-v2')
+# Metric stage names for the per-document timings collected in process_document
+INGEST_STAGES = {'parse': 'pdf_parse', 'embed': 'embed_documents', 'store': 'vector_write'}
 
-def process_document(document_id):
+def file_content_hash(file):
+    # Accepts an uploaded file, a FieldFile or a filesystem path
+    digest = hashlib.sha256()
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+    else:
+        for block in file.chunks():
+            digest.update(block)
+    return digest.hexdigest()
+
+def chunk_id(document_id, content_hash, index):
+    return f"doc{document_id}-{content_hash[:16]}-{index}"
+
+def save_document_vectors(document_id, records, embeddings, publish=True, write_batch=None):
+    # Whole-document write for callers that already hold every vector (bulk ingest)
+    if embedding_store_enabled():
+        get_embedding_store().put_document(document_id, records, embeddings)
+    get_vector_store().write_document(document_id, records, embeddings, publish=publish, write_batch=write_batch)
+
+def delete_document_vectors(document_id):
+    get_keyword_index().remove_document(document_id)
+    if embedding_store_enabled():
+        get_embedding_store().remove_document(document_id)
+    get_vector_store().delete_document(document_id)
+    bump_collection_version()
+    invalidate_documents([document_id])
+    logger.info("Removed vectors and keyword index for document %s", document_id)
+
+def _report(progress, stage, fraction=None):
+    if progress is not None:
+        progress(stage, fraction)
+
+def format_source(metadata):
+    page_start = metadata.get('page')
+    page_end = metadata.get('page_end', page_start)
+    if page_end and page_end != page_start:
+        return f"{metadata['file_name']} - Pages {page_start}-{page_end}"
+    return f"{metadata['file_name']} - Page {page_start}"
+
+def chunk_records(document, content_hash, chunks, first_index=0):
+    return [
+        {
+            "id": chunk_id(document.id, content_hash, first_index + i),
+            "text": chunk.text,
+            "metadata": {
+                "file_name": document.file_name,
+                "page": chunk.page_start,
+                "page_end": chunk.page_end,
+                "tokens": chunk.token_count,
+                "document_id": document.id,
+                "content_hash": content_hash,
+            },
+        }
+        for i, chunk in enumerate(chunks)
+    ]
+
+def _embed_batch(document, content_hash, chunks, first_index):
+    records = chunk_records(document, content_hash, chunks, first_index)
+    embedding_start = time.time()
+    embeddings = get_embedding_service().encode_documents([record['text'] for record in records], batch_size=len(records))
+    return records, embeddings, time.time() - embedding_start
+
+def process_document(document_id, progress=None, force=False, publish=True):
     start_time = time.time()
     logger.info("Starting document processing for ID: %s", document_id)
 
     document = Document.objects.get(id=document_id)
     file_path = default_storage.path(document.file.name)
-    
-    # Extract text from PDF using pdfplumber
-    text = ""
+    content_hash = file_content_hash(file_path)
+
+    # Re-saves, admin edits and job retries of an already indexed file are no-ops
+    if not force and document.indexed_at and document.content_hash == content_hash:
+        logger.info("Document %s already indexed with hash %s, skipping", document_id, content_hash[:12])
+        _report(progress, 'skipped', 1.0)
+        return False
+
+    chunker = get_chunker()
+    batch_size = settings.EMBEDDING_BATCH_SIZE
+    timings = {'parse': 0.0, 'chunk': 0.0, 'embed': 0.0, 'store': 0.0}
+
+    def parsed_pages():
+        pages = iter_pages(file_path)
+        try:
+            while True:
+                parse_start = time.time()
+                try:
+                    page_num, page_count, page_text = next(pages)
+                except StopIteration:
+                    return
+                except Exception as e:
+                    logger.error("PDF parsing failed: %s", str(e))
+                    raise
+                finally:
+                    timings['parse'] += time.time() - parse_start
+                _report(progress, 'parsing', 0.95 * page_num / page_count)
+                yield page_num, page_text
+        finally:
+            pages.close()
+
+    # Pages stream from the parser through the chunker and are embedded and written in
+    # bounded batches, so vectors never accumulate; the vector store drops the document's
+    # stale chunks and publishes once the last batch is in
+    vector_store = get_vector_store()
+    segment = get_embedding_store().begin_document(document.id) if embedding_store_enabled() else None
+    _report(progress, 'parsing', 0.0)
+    chunk_count = 0
+    batch = []
+    chunk_ids = []
+    # Only text and metadata are kept, for the keyword segment written at the end
+    keyword_records = []
+    chunks = chunker.chunk(parsed_pages())
     try:
-        with pdfplumber.open(file_path) as pdf:
-            for page_num, page in enumerate(pdf.pages, 1):
-                page_text = page.extract_text() or ""
-                text += f"\n[Page {page_num}] {page_text}"
-        logger.info("PDF parsing completed in %.2f seconds", time.time() - start_time)
-    except Exception as e:
-        logger.error("PDF parsing failed: %s", str(e))
+        while True:
+            chunk_start = time.time()
+            chunk = next(chunks, None)
+            timings['chunk'] += time.time() - chunk_start
+            if chunk is not None:
+                batch.append(chunk)
+            if batch and (chunk is None or len(batch) >= batch_size):
+                _report(progress, 'embedding')
+                records, embeddings, batch_embed = _embed_batch(document, content_hash, batch, chunk_count)
+                timings['embed'] += batch_embed
+                # Also the job's heartbeat while a large document is embedded and stored
+                _report(progress, 'storing')
+                store_start = time.time()
+                if segment is not None:
+                    segment.add(records, embeddings)
+                vector_store.write_chunks(document.id, records, embeddings)
+                timings['store'] += time.time() - store_start
+                chunk_ids.extend(record['id'] for record in records)
+                if settings.KEYWORD_INDEX_ENABLED:
+                    keyword_records.extend(records)
+                chunk_count += len(batch)
+                batch = []
+            if chunk is None:
+                break
+
+        _report(progress, 'storing', 0.95)
+        store_start = time.time()
+        if segment is not None:
+            segment.commit()
+        vector_store.finish_document(document.id, chunk_ids, publish=publish)
+        timings['store'] += time.time() - store_start
+    except BaseException:
+        if segment is not None:
+            segment.abort()
+        vector_store.abort_document(document.id)
         raise
 
-    # Chunk the text (smaller chunks for faster processing)
-    chunk_size = 500
-    max_chunks = 50  # Limit to 50 chunks to cap processing time
-    chunks = [text[i:i+chunk_size] for i in range(0, len(text), chunk_size)][:max_chunks]
-    chunk_metadata = [{"file_name": document.file_name, "page": i + 1} for i in range(len(chunks))]
-    
-    # Generate embeddings
-    embedding_start = time.time()
-    embeddings = MODEL.encode(chunks, convert_to_tensor=False)
-    logger.info("Embedding generation completed in %.2f seconds", time.time() - embedding_start)
-    
-    # Store in ChromaDB
-    client = chromadb.HttpClient(host='localhost', port=8000)
-    collection = client.get_or_create_collection(name="knowledge_base")
-    
-    # Check if collection has documents and delete if not empty
-    chromadb_start = time.time()
-    if collection.count() > 0:
-        existing_ids = collection.get()['ids']
-        collection.delete(ids=existing_ids)
-        logger.info("Cleared existing ChromaDB data")
-    
-    # Add new embeddings
-    collection.add(
-        documents=chunks,
-        embeddings=embeddings.tolist(),
-        metadatas=chunk_metadata,
-        ids=[f"{document.file_name}_page_{i+1}" for i in range(len(chunks))]
-    )
-    logger.info("ChromaDB storage completed in %.2f seconds", time.time() - chromadb_start)
+    # Chunking time above includes the parse time of the pages it pulled
+    timings['chunk'] -= timings['parse']
+    logger.info("PDF parsing completed in %.2f seconds", timings['parse'])
+    logger.info("Chunking completed in %.2f seconds (%s chunks)", timings['chunk'], chunk_count)
+    logger.info("Embedding generation completed in %.2f seconds", timings['embed'])
+    logger.info("Vector storage completed in %.2f seconds", timings['store'])
+
+    # The keyword segment for this document replaces the previous one in a single write
+    if settings.KEYWORD_INDEX_ENABLED:
+        keyword_start = time.time()
+        get_keyword_index().add_document(document.id, keyword_records)
+        timings['keyword_index'] = time.time() - keyword_start
+        logger.info("Keyword indexing completed in %.2f seconds", timings['keyword_index'])
+    bump_collection_version()
+    invalidate_documents([document.id])
+    _report(progress, 'storing', 1.0)
+
+    # Update without save() so the post_save ingestion trigger does not fire again
+    Document.objects.filter(id=document.id).update(content_hash=content_hash, indexed_at=timezone.now())
     
     total_time = time.time() - start_time
-    logger.info("Document processing completed in %.2f seconds", total_time)
+    timings['total'] = total_time
+    for stage, seconds in timings.items():
+        observe_ingest(INGEST_STAGES.get(stage, stage), seconds)
+    logger.info("Document processing completed in %.2f seconds (%s chunks)", total_time, chunk_count)
     if total_time > 30:
         logger.warning("Processing took longer than 30 seconds")
+    return True
 
-def query_knowledge_base(question):
-    question_embedding = MODEL.encode([question], convert_to_tensor=False).tolist()
-    
-    client = chromadb.HttpClient(host='localhost', port=8000)
-    collection = client.get_collection(name="knowledge_base")
-    
-    results = collection.query(
-        query_embeddings=question_embedding,
-        n_results=3
-    )
-    
-    return [
-        {"text": doc, "metadata": meta}
-        for doc, meta in zip(results['documents'][0], results['metadatas'][0])
-    ]
\ No newline at end of file
+def embed_question(question):
+    cache_key = normalize_question(question)
+    question_embedding = embedding_cache.get(cache_key)
+    if question_embedding is None:
+        question_embedding = get_embedding_service().encode_query(question)
+        embedding_cache.set(cache_key, question_embedding)
+    return question_embedding
+
+def _fuse(question, dense_results, n_results, document_ids, timings=None):
+    # Exact-term matches (product names, menu items) come from BM25; reciprocal rank fusion
+    # merges them with the dense ranking without needing comparable scores
+    if not settings.KEYWORD_INDEX_ENABLED:
+        return dense_results
+    with timed('keyword_search', timings):
+        keyword_results = get_keyword_index().search(question, k=n_results, document_ids=document_ids)
+    fused = reciprocal_rank_fusion([dense_results, keyword_results], k=settings.RRF_K, limit=n_results)
+    return [result if result['distance'] is not None else dict(result, score=keyword_score(result, dense_results, keyword_results)) for result in fused]
+
+def keyword_score(result, dense_results, keyword_results):
+    # Hits found only by BM25 have no vector distance. They get a cosine-scale score so the
+    # CONTEXT_MIN_SCORE filter applies to them too: the best BM25 hit counts as much as the
+    # best dense hit, the others in proportion to their BM25 score
+    best_dense = max((score(hit) for hit in dense_results if hit['distance'] is not None), default=1.0)
+    best_bm25 = max(hit['bm25'] for hit in keyword_results)
+    return best_dense * result['bm25'] / best_bm25 if best_bm25 > 0 else 0.0
+
+def query_knowledge_base(question, n_results=None, document_ids=None, timings=None, with_embedding=False):
+    # with_embedding=True also returns the query embedding, for callers that reuse it
+    n_results = n_results or settings.RETRIEVAL_CANDIDATES
+    with timed('embed', timings):
+        question_embedding = embed_question(question)
+
+    results_key = embedding_key(question_embedding, get_collection_version(), n_results, sorted(document_ids or []))
+    cached = results_cache.get(results_key)
+    if cached is not None:
+        return (cached, question_embedding) if with_embedding else cached
+
+    with timed('vector_query', timings):
+        results = get_vector_store().query(question_embedding, n_results, document_ids)
+
+    results = _fuse(question, results, n_results, document_ids, timings)
+    results_cache.set(results_key, results)
+    return (results, question_embedding) if with_embedding else results
+
+async def aembed_question(question):
+    cache_key = normalize_question(question)
+    question_embedding = embedding_cache.get(cache_key)
+    if question_embedding is None:
+        question_embedding = await get_embedding_service().aencode_query(question)
+        embedding_cache.set(cache_key, question_embedding)
+    return question_embedding
+
+async def aquery_knowledge_base(question, n_results=None, document_ids=None, timings=None, with_embedding=False):
+    n_results = n_results or settings.RETRIEVAL_CANDIDATES
+    with timed('embed', timings):
+        question_embedding = await aembed_question(question)
+
+    results_key = embedding_key(question_embedding, await aget_collection_version(), n_results, sorted(document_ids or []))
+    cached = results_cache.get(results_key)
+    if cached is not None:
+        return (cached, question_embedding) if with_embedding else cached
+
+    with timed('vector_query', timings):
+        results = await get_vector_store().aquery(question_embedding, n_results, document_ids)
+    results = _fuse(question, results, n_results, document_ids, timings)
+    results_cache.set(results_key, results)
+    return (results, question_embedding) if with_embedding else results
@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import threading
+import weakref
+import chromadb
+from chromadb.config import Settings as ChromaSettings
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# One client per process, shared by every request thread. The HTTP client keeps its
+# connections alive between calls, so queries skip TCP setup after the first request.
+_client = None
+_collections = {}
+_lock = threading.Lock()
+# Async HTTP clients are bound to the event loop that created them
+_async_state = weakref.WeakKeyDictionary()
+
+def _create_client():
+    chroma_settings = ChromaSettings(anonymized_telemetry=False)
+    if settings.CHROMA_MODE == 'persistent':
+        # Embedded mode: reads/writes the on-disk store directly, no HTTP hop
+        logger.info("Opening embedded ChromaDB store at %s", settings.CHROMA_PERSIST_DIR)
+        return chromadb.PersistentClient(path=str(settings.CHROMA_PERSIST_DIR), settings=chroma_settings)
+
+    logger.info("Connecting to ChromaDB server at %s:%s", settings.CHROMA_HOST, settings.CHROMA_PORT)
+    client = chromadb.HttpClient(host=settings.CHROMA_HOST, port=settings.CHROMA_PORT, settings=chroma_settings)
+    _apply_timeouts(client)
+    return client
+
+def _apply_timeouts(client):
+    # chromadb does not expose request timeouts, so set them on its pooled httpx session
+    try:
+        import httpx
+        session = getattr(getattr(client, '_server', None), '_session', None)
+        if isinstance(session, httpx.Client):
+            session.timeout = httpx.Timeout(settings.CHROMA_TIMEOUT, connect=settings.CHROMA_CONNECT_TIMEOUT)
+    except Exception as e:
+        logger.warning("Could not apply ChromaDB timeouts: %s", str(e))
+
+def get_client():
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = _create_client()
+    return _client
+
+def get_collection(name=None):
+    name = name or settings.CHROMA_COLLECTION
+    collection = _collections.get(name)
+    if collection is None:
+        client = get_client()
+        with _lock:
+            collection = _collections.get(name)
+            if collection is None:
+                collection = client.get_or_create_collection(name=name)
+                _collections[name] = collection
+    return collection
+
+def reset():
+    # Drop cached handles, e.g. after a collection was deleted and recreated out of band
+    global _client
+    with _lock:
+        _client = None
+        _collections.clear()
+        _vector_stores.clear()
+
+async def _aget_http_collection(name):
+    loop = asyncio.get_running_loop()
+    state = _async_state.get(loop)
+    if state is None:
+        client = await chromadb.AsyncHttpClient(
+            host=settings.CHROMA_HOST,
+            port=settings.CHROMA_PORT,
+            settings=ChromaSettings(anonymized_telemetry=False),
+        )
+        state = {'client': client, 'collections': {}}
+        _async_state[loop] = state
+    collection = state['collections'].get(name)
+    if collection is None:
+        collection = await state['client'].get_or_create_collection(name=name)
+        state['collections'][name] = collection
+    return collection
+
+async def aquery(query_embeddings, n_results, name=None, **kwargs):
+    name = name or settings.CHROMA_COLLECTION
+    if settings.CHROMA_MODE == 'persistent':
+        # The embedded client has no async API; run it off the event loop
+        return await asyncio.to_thread(get_collection(name).query, query_embeddings=query_embeddings, n_results=n_results, **kwargs)
+    collection = await _aget_http_collection(name)
+    return await collection.query(query_embeddings=query_embeddings, n_results=n_results, **kwargs)
+
+def document_filter(document_ids):
+    return {"document_id": {"$in": sorted(document_ids)}} if document_ids else None
+
+def shape_results(results):
+    distances = (results.get('distances') or [[None] * len(results['ids'][0])])[0]
+    return [
+        {"id": chunk, "text": doc, "metadata": meta, "distance": distance}
+        for chunk, doc, meta, distance in zip(results['ids'][0], results['documents'][0], results['metadatas'][0], distances)
+    ]
+
+class VectorStore:
+    # What ingestion and retrieval need from a vector backend. Records are the
+    # {"id", "text", "metadata"} dicts built by utils.chunk_records; query results are
+    # {"id", "text", "metadata", "distance"} dicts, best first, with distance = squared L2
+    # between unit vectors. A document is (re)written batch by batch with write_chunks and
+    # then finish_document, which drops its chunks the new pass did not write.
+    name = None
+
+    def write_chunks(self, document_id, records, embeddings, write_batch=None):
+        raise NotImplementedError
+
+    def finish_document(self, document_id, chunk_ids, publish=True):
+        raise NotImplementedError
+
+    def abort_document(self, document_id):
+        # Discards batches of an unfinished write where the backend can
+        pass
+
+    def write_document(self, document_id, records, embeddings, publish=True, write_batch=None):
+        # Replaces every chunk of the document in one call
+        self.write_chunks(document_id, records, embeddings, write_batch=write_batch)
+        self.finish_document(document_id, [record['id'] for record in records], publish=publish)
+
+    def delete_document(self, document_id, publish=True):
+        raise NotImplementedError
+
+    def publish(self):
+        # Makes writes done with publish=False visible to readers
+        pass
+
+    def compact(self):
+        # Optional maintenance after bulk writes
+        pass
+
+    def query(self, embedding, n_results, document_ids=None):
+        raise NotImplementedError
+
+    async def aquery(self, embedding, n_results, document_ids=None):
+        return await asyncio.to_thread(self.query, embedding, n_results, document_ids)
+
+    def count(self, document_id=None):
+        raise NotImplementedError
+
+    def stats(self):
+        return {'backend': self.name}
+
+class ChromaVectorStore(VectorStore):
+    name = 'chroma'
+
+    def __init__(self, collection_name=None):
+        self.collection_name = collection_name
+
+    def write_chunks(self, document_id, records, embeddings, write_batch=None):
+        # Upserted right away: readers see new chunks as each batch lands
+        collection = get_collection(self.collection_name)
+        write_batch = min(write_batch or 2000, get_client().get_max_batch_size())
+        for start in range(0, len(records), write_batch):
+            batch = records[start:start + write_batch]
+            collection.upsert(
+                documents=[record['text'] for record in batch],
+                embeddings=embeddings[start:start + write_batch].tolist(),
+                metadatas=[record['metadata'] for record in batch],
+                ids=[record['id'] for record in batch]
+            )
+
+    def finish_document(self, document_id, chunk_ids, publish=True):
+        # Drop chunks the latest pass did not write: an older file version, or surplus
+        # chunks after re-chunking the same file
+        collection = get_collection(self.collection_name)
+        existing = collection.get(where={"document_id": document_id}, include=[])['ids']
+        current_ids = set(chunk_ids)
+        stale = [existing_id for existing_id in existing if existing_id not in current_ids]
+        if stale:
+            collection.delete(ids=stale)
+
+    def delete_document(self, document_id, publish=True):
+        get_collection(self.collection_name).delete(where={"document_id": document_id})
+
+    def query(self, embedding, n_results, document_ids=None):
+        return shape_results(get_collection(self.collection_name).query(
+            query_embeddings=[embedding.tolist()],
+            n_results=n_results,
+            where=document_filter(document_ids)
+        ))
+
+    async def aquery(self, embedding, n_results, document_ids=None):
+        return shape_results(await aquery([embedding.tolist()], n_results, name=self.collection_name, where=document_filter(document_ids)))
+
+    def count(self, document_id=None):
+        collection = get_collection(self.collection_name)
+        if document_id is None:
+            return collection.count()
+        return len(collection.get(where={"document_id": document_id}, include=[])['ids'])
+
+    def stats(self):
+        return {'backend': self.name, 'collection': self.collection_name or settings.CHROMA_COLLECTION, 'chunks': self.count()}
+
+_vector_stores = {}
+
+def get_vector_store():
+    # VECTOR_STORE picks the backend; the local one keeps a snapshot per embedding model
+    backend = settings.VECTOR_STORE
+    if backend == 'chroma':
+        key = backend
+    elif backend == 'local':
+        from api.embedding_store import get_embedding_store
+        key = (backend, get_embedding_store().model_name)
+    else:
+        raise ValueError(f"Unknown VECTOR_STORE backend: {backend}")
+    store = _vector_stores.get(key)
+    if store is None:
+        with _lock:
+            store = _vector_stores.get(key)
+            if store is None:
+                if backend == 'chroma':
+                    store = ChromaVectorStore()
+                else:
+                    from api.embedding_store import get_embedding_store
+                    from api.local_index import LocalVectorStore
+                    store = LocalVectorStore(settings.LOCAL_INDEX_DIR, get_embedding_store())
+                _vector_stores[key] = store
+    return store
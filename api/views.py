@@ -1,20 +1,120 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.throttling import AnonRateThrottle
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from drf_spectacular.utils import extend_schema, OpenApiResponse
-from .utils import query_knowledge_base, process_document
-from .llm import get_llm_response
-from .models import Document, InteractionLog, TTSState
-from .serializers import DocumentSerializer, AskQuestionSerializer, TTSSerializer
-import pyttsx3
-from django.http import StreamingHttpResponse
-import io
+from .utils import query_knowledge_base, aquery_knowledge_base, file_content_hash, format_source
+from .cache import retrieval_cache_stats
+from . import answer_cache
+from .context import assemble_context
+from .metrics import QUESTIONS, STAGE_ERRORS, observe, render_metrics, timed
+from .reranking import arerank, candidate_count, get_reranker, rerank
+from .vectorstore import get_vector_store
+from .interaction_log import get_logged_interaction, log_interaction
+from .ingestion import enqueue_document
+from .tts import TTSBusyError, get_speech_service, pregenerate_answer, segment_at, split_sentences
+from .llm import LLMBusyError, CircuitOpenError, get_llm_response, stream_llm_response, aget_llm_response, astream_llm_response
+from .models import Document, IngestionJob, InteractionLog, TTSState
+from .serializers import DocumentSerializer, IngestionJobSerializer, AskQuestionSerializer, TTSSerializer
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views import View
+from django.urls import reverse
+from django.conf import settings
+from asgiref.sync import sync_to_async
+import json
+import logging
 import time
 
+logger = logging.getLogger(__name__)
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def build_retrieval(candidates, question_embedding, timings=None):
+    # Retrieval pulls RETRIEVAL_CANDIDATES hits (RERANK_CANDIDATES, cut to RERANK_TOP_K, when
+    # re-ranking); only what survives context assembly is sent to the LLM, cited as a source
+    # and used for the answer cache fingerprint
+    timings = {} if timings is None else timings
+    with timed('context', timings):
+        context, passages = assemble_context(candidates)
+    results = [result for passage in passages for result in passage.results]
+    logger.info("Retrieval timings (ms): %s", timings)
+    return {
+        "results": results,
+        "context": context,
+        "sources": list(dict.fromkeys(format_source(passage.metadata) for passage in passages)),
+        "embedding": question_embedding,
+        "fingerprint": answer_cache.context_fingerprint(results),
+        "timings": timings,
+    }
+
+def cached_document_ids(retrieval):
+    return {result['metadata']['document_id'] for result in retrieval['results'] if 'document_id' in result['metadata']}
+
+def llm_failure(e):
+    # (payload, status, headers) for an LLM call that raised
+    if isinstance(e, (LLMBusyError, CircuitOpenError)):
+        return {"error": str(e)}, status.HTTP_503_SERVICE_UNAVAILABLE, {'Retry-After': str(settings.LLM_RETRY_AFTER)}
+    return {"error": f"LLM processing failed: {str(e)}"}, status.HTTP_500_INTERNAL_SERVER_ERROR, {}
+
+def answer_payload(answer, retrieval, cached, interaction):
+    QUESTIONS.inc(source='cache' if cached else 'llm')
+    return {
+        "answer": answer,
+        "sources": retrieval['sources'],
+        "cached": cached,
+        "interaction_id": interaction.id if interaction else None
+    }
+
+def record_interaction(user, question, answer, sources):
+    try:
+        with timed('db_log'):
+            # Buffered and written in batches (INTERACTION_LOG_BUFFERED); the id is final
+            interaction = log_interaction(user, question, answer, sources)
+    except Exception as e:
+        logger.exception("Failed to log interaction: %s", str(e))
+        return None
+    # Queue speech synthesis so a later `play` streams from the cache (TTS_PREGENERATE)
+    pregenerate_answer(answer)
+    return interaction
+
+def event_stream_response(events):
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx and similar proxies from buffering the event stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+class AnswerStream:
+    # Per-token bookkeeping of a streamed LLM answer, shared by the sync and async streams
+    def __init__(self):
+        self.pieces = []
+        self.started = time.perf_counter()
+
+    def token(self, piece):
+        if not self.pieces:
+            observe('llm_first_token', time.perf_counter() - self.started)
+        self.pieces.append(piece)
+        return sse_event('token', {"text": piece})
+
+    def finish(self):
+        observe('llm', time.perf_counter() - self.started)
+        return ''.join(self.pieces)
+
+    @staticmethod
+    def failed(e):
+        STAGE_ERRORS.inc(stage='llm')
+        return sse_event('error', {"error": f"LLM processing failed: {str(e)}"})
+
+def done_event(answer, retrieval, cached, interaction):
+    payload = answer_payload(answer, retrieval, cached, interaction)
+    return sse_event('done', {"cached": payload['cached'], "interaction_id": payload['interaction_id']})
+
 class UploadThrottle(AnonRateThrottle):
     rate = '5/minute'
 
@@ -31,7 +131,9 @@ class UploadThrottle(AnonRateThrottle):
                         'type': 'array',
                         'items': {'type': 'string'},
                         'description': 'List of source documents and pages'
-                    }
+                    },
+                    'cached': {'type': 'boolean', 'description': 'Whether the answer was served from the semantic answer cache'},
+                    'interaction_id': {'type': 'integer', 'description': 'ID of the logged interaction'}
                 }
             },
             description='Successful response with answer and sources'
@@ -51,9 +153,13 @@ class UploadThrottle(AnonRateThrottle):
         500: OpenApiResponse(
             response={'type': 'object', 'properties': {'error': {'type': 'string'}}},
             description='Server error during context retrieval or LLM processing'
+        ),
+        503: OpenApiResponse(
+            response={'type': 'object', 'properties': {'error': {'type': 'string'}}},
+            description='LLM backend saturated or temporarily unavailable; retry after the Retry-After delay'
         )
     },
-    description='Query the knowledge base with a natural language question (rate-limited to 10 requests/minute, requires token authentication)'
+    description='Query the knowledge base with a natural language question. Add ?stream=1 to receive Server-Sent Events instead (rate-limited to 10 requests/minute, requires token authentication)'
 )
 class AskQuestionView(APIView):
     permission_classes = [IsAuthenticated]
@@ -68,48 +174,263 @@ class AskQuestionView(APIView):
         
         # Retrieve relevant chunks
         try:
-            results = query_knowledge_base(question)
-            context = "\n".join([result['text'] for result in results])
-            sources = [f"{result['metadata']['file_name']} - Page {result['metadata']['page']}" for result in results]
+            retrieval = self.retrieve(question, serializer.validated_data.get('document_ids'))
         except Exception as e:
             return Response({"error": f"Failed to retrieve context: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        if request.query_params.get('stream') in ('1', 'true'):
+            return self.stream(request, question, retrieval)
         
-        # Get LLM response
+        # Reuse an answer to a near-identical question over the same context
+        cached = self.cached_answer(retrieval)
+        if cached is not None:
+            answer = cached.answer
+        else:
+            try:
+                with timed('llm'):
+                    answer = get_llm_response(question, retrieval['context'])
+            except Exception as e:
+                payload, status_code, headers = llm_failure(e)
+                return Response(payload, status=status_code, headers=headers)
+            self.cache_answer(question, retrieval, answer)
+
+        interaction = record_interaction(request.user, question, answer, retrieval['sources'])
+        return Response(answer_payload(answer, retrieval, cached is not None, interaction), status=status.HTTP_200_OK)
+
+    def retrieve(self, question, document_ids=None):
+        started = time.monotonic()
+        timings = {}
+        candidates, question_embedding = query_knowledge_base(question, candidate_count(), document_ids, timings, with_embedding=True)
+        candidates = rerank(question, candidates, started, timings)
+        return build_retrieval(candidates, question_embedding, timings)
+
+    def cached_answer(self, retrieval):
         try:
-            answer = get_llm_response(question, context)
+            with timed('answer_cache'):
+                return answer_cache.lookup(retrieval['embedding'], retrieval['fingerprint'])
         except Exception as e:
-            return Response({"error": f"LLM processing failed: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        
-        # Log interaction
+            logger.warning("Answer cache lookup failed: %s", str(e))
+            return None
+
+    def cache_answer(self, question, retrieval, answer):
         try:
-            interaction = InteractionLog.objects.create(
-                user=request.user,
-                question=question,
-                answer=answer,
-                sources=sources
+            answer_cache.store(
+                question, retrieval['embedding'], retrieval['fingerprint'], answer, retrieval['sources'], cached_document_ids(retrieval)
             )
         except Exception as e:
-            print(f"Failed to log interaction: {str(e)}")
-        
-        return Response({
-            "answer": answer,
-            "sources": sources,
-            "interaction_id": interaction.id
-        }, status=status.HTTP_200_OK)
+            logger.warning("Failed to cache answer: %s", str(e))
+
+    def stream(self, request, question, retrieval):
+        return event_stream_response(self.stream_events(request, question, retrieval))
+
+    def stream_events(self, request, question, retrieval):
+        # Sources go out as soon as retrieval is done, then answer tokens as they are generated
+        yield sse_event('sources', {"sources": retrieval['sources']})
+
+        cached = self.cached_answer(retrieval)
+        if cached is not None:
+            answer = cached.answer
+            yield sse_event('token', {"text": answer})
+        else:
+            stream = AnswerStream()
+            try:
+                for piece in stream_llm_response(question, retrieval['context']):
+                    yield stream.token(piece)
+            except Exception as e:
+                yield stream.failed(e)
+                return
+            answer = stream.finish()
+            self.cache_answer(question, retrieval, answer)
+
+        # The interaction is only logged once the full answer is known
+        interaction = record_interaction(request.user, question, answer, retrieval['sources'])
+        yield done_event(answer, retrieval, cached is not None, interaction)
+
+@method_decorator(csrf_exempt, name='dispatch')
+@extend_schema(
+    request=AskQuestionSerializer,
+    responses={
+        200: OpenApiResponse(
+            response={'type': 'string'},
+            description='text/event-stream of `sources`, `token` (repeated), then `done` or `error` events, each with a JSON payload'
+        ),
+        400: OpenApiResponse(
+            response={'type': 'object', 'properties': {'error': {'type': 'string'}}},
+            description='Bad request due to missing or invalid question'
+        ),
+        401: OpenApiResponse(
+            response={'type': 'object', 'properties': {'detail': {'type': 'string'}}},
+            description='Unauthorized due to missing or invalid token'
+        ),
+        429: OpenApiResponse(
+            response={'type': 'object', 'properties': {'detail': {'type': 'string'}}},
+            description='Too many requests (rate limit exceeded)'
+        ),
+        500: OpenApiResponse(
+            response={'type': 'object', 'properties': {'error': {'type': 'string'}}},
+            description='Server error during context retrieval'
+        )
+    },
+    description='Ask a question and receive sources immediately followed by answer tokens as Server-Sent Events (rate-limited to 10 requests/minute, requires token authentication)'
+)
+class AskQuestionStreamView(AskQuestionView):
+
+    def post(self, request):
+        serializer = AskQuestionSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        question = serializer.validated_data['question']
+        try:
+            retrieval = self.retrieve(question, serializer.validated_data.get('document_ids'))
+        except Exception as e:
+            return Response({"error": f"Failed to retrieve context: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return self.stream(request, question, retrieval)
+
+async def authenticate_token(request):
+    # The sync views' TokenAuthentication, run off the event loop for views that bypass APIView
+    try:
+        authenticated = await sync_to_async(TokenAuthentication().authenticate)(request)
+    except AuthenticationFailed:
+        return None
+    return authenticated[0] if authenticated else None
+
+def throttle_wait(request, view):
+    # APIView.check_throttles for views that bypass APIView: None when allowed, else the
+    # seconds to wait (0 when unknown)
+    waits = [
+        throttle.wait() for throttle in (throttle_class() for throttle_class in view.throttle_classes)
+        if not throttle.allow_request(request, view)
+    ]
+    if not waits:
+        return None
+    return max((wait for wait in waits if wait is not None), default=0)
+
+# Native async variant of AskQuestionView for ASGI servers (uvicorn). Chroma, Gemini and the
+# ORM are awaited and query embedding runs on the shared micro-batching thread, so an
+# in-flight question holds no worker thread while it waits on I/O.
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncAskQuestionView(View):
+    throttle_classes = AskQuestionView.throttle_classes
+
+    async def post(self, request):
+        user = await authenticate_token(request)
+        if user is None:
+            return JsonResponse({"detail": "Invalid or missing token."}, status=status.HTTP_401_UNAUTHORIZED)
+        request.user = user
+        wait = throttle_wait(request, self)
+        if wait is not None:
+            response = JsonResponse({"detail": "Request was throttled."}, status=status.HTTP_429_TOO_MANY_REQUESTS)
+            if wait:
+                response['Retry-After'] = str(int(wait) + 1)
+            return response
+
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return JsonResponse({"error": "Request body must be JSON"}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = AskQuestionSerializer(data=data)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        question = serializer.validated_data['question']
+
+        # Retrieve relevant chunks
+        try:
+            retrieval = await self.retrieve(question, serializer.validated_data.get('document_ids'))
+        except Exception as e:
+            return JsonResponse({"error": f"Failed to retrieve context: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        if request.GET.get('stream') in ('1', 'true'):
+            return event_stream_response(self.stream_events(request, question, retrieval))
+
+        cached = await self.cached_answer(retrieval)
+        if cached is not None:
+            answer = cached.answer
+        else:
+            try:
+                with timed('llm'):
+                    answer = await aget_llm_response(question, retrieval['context'])
+            except Exception as e:
+                payload, status_code, headers = llm_failure(e)
+                response = JsonResponse(payload, status=status_code)
+                for header, value in headers.items():
+                    response[header] = value
+                return response
+            await self.cache_answer(question, retrieval, answer)
+
+        interaction = await sync_to_async(record_interaction)(request.user, question, answer, retrieval['sources'])
+        return JsonResponse(answer_payload(answer, retrieval, cached is not None, interaction), status=status.HTTP_200_OK)
+
+    async def retrieve(self, question, document_ids=None):
+        started = time.monotonic()
+        timings = {}
+        candidates, question_embedding = await aquery_knowledge_base(question, candidate_count(), document_ids, timings, with_embedding=True)
+        candidates = await arerank(question, candidates, started, timings)
+        return build_retrieval(candidates, question_embedding, timings)
+
+    async def cached_answer(self, retrieval):
+        try:
+            with timed('answer_cache'):
+                return await answer_cache.alookup(retrieval['embedding'], retrieval['fingerprint'])
+        except Exception as e:
+            logger.warning("Answer cache lookup failed: %s", str(e))
+            return None
+
+    async def cache_answer(self, question, retrieval, answer):
+        try:
+            await answer_cache.astore(
+                question, retrieval['embedding'], retrieval['fingerprint'], answer, retrieval['sources'], cached_document_ids(retrieval)
+            )
+        except Exception as e:
+            logger.warning("Failed to cache answer: %s", str(e))
+
+    async def stream_events(self, request, question, retrieval):
+        yield sse_event('sources', {"sources": retrieval['sources']})
+
+        cached = await self.cached_answer(retrieval)
+        if cached is not None:
+            answer = cached.answer
+            yield sse_event('token', {"text": answer})
+        else:
+            stream = AnswerStream()
+            try:
+                async for piece in astream_llm_response(question, retrieval['context']):
+                    yield stream.token(piece)
+            except Exception as e:
+                yield stream.failed(e)
+                return
+            answer = stream.finish()
+            await self.cache_answer(question, retrieval, answer)
+
+        interaction = await sync_to_async(record_interaction)(request.user, question, answer, retrieval['sources'])
+        yield done_event(answer, retrieval, cached is not None, interaction)
 
 @method_decorator(csrf_exempt, name='dispatch')
 @extend_schema(
     request=DocumentSerializer,
     responses={
-        201: OpenApiResponse(
+        202: OpenApiResponse(
+            response={
+                'type': 'object',
+                'properties': {
+                    'message': {'type': 'string', 'description': 'Success message'},
+                    'file_name': {'type': 'string', 'description': 'Name of the uploaded file'},
+                    'job_id': {'type': 'integer', 'description': 'ID of the queued ingestion job'},
+                    'status_url': {'type': 'string', 'description': 'URL to poll for ingestion progress'}
+                }
+            },
+            description='Document accepted and queued for background processing'
+        ),
+        200: OpenApiResponse(
             response={
                 'type': 'object',
                 'properties': {
                     'message': {'type': 'string', 'description': 'Success message'},
-                    'file_name': {'type': 'string', 'description': 'Name of the uploaded file'}
+                    'file_name': {'type': 'string', 'description': 'Name of the already indexed file'}
                 }
             },
-            description='Successful document upload and processing'
+            description='An identical file is already indexed; no processing was queued'
         ),
         400: OpenApiResponse(
             response={'type': 'object', 'properties': {'error': {'type': 'string'}}},
@@ -125,10 +446,10 @@ class AskQuestionView(APIView):
         ),
         500: OpenApiResponse(
             response={'type': 'object', 'properties': {'error': {'type': 'string'}}},
-            description='Server error during document processing'
+            description='Server error while queuing the document'
         )
     },
-    description='Upload a PDF file to create a searchable knowledge base (rate-limited to 5 requests/minute, requires token authentication)'
+    description='Upload a PDF file to create a searchable knowledge base. Processing runs in the background; poll the returned status_url for progress (rate-limited to 5 requests/minute, requires token authentication)'
 )
 class DocumentUploadView(APIView):
     permission_classes = [IsAuthenticated]
@@ -137,18 +458,92 @@ class DocumentUploadView(APIView):
     def post(self, request):
         serializer = DocumentSerializer(data=request.data)
         if serializer.is_valid():
-            document = serializer.save()
-            try:
-                process_document(document.id)
+            content_hash = file_content_hash(serializer.validated_data['file'])
+            existing = Document.objects.filter(content_hash=content_hash, indexed_at__isnull=False).first()
+            if existing is not None:
+                # Same file was already indexed; nothing to parse or embed again
                 return Response({
-                    "message": "Document uploaded and processed successfully",
-                    "file_name": document.file_name
-                }, status=status.HTTP_201_CREATED)
+                    "message": "Document already indexed",
+                    "file_name": existing.file_name,
+                    "job_id": None,
+                    "status_url": None
+                }, status=status.HTTP_200_OK)
+            try:
+                # Ingestion is queued by the Document post_save signal; queued here if the
+                # signal did not run (disconnected, or saved with raw=True)
+                document = serializer.save(uploaded_by=request.user)
+                job = document.ingestion_jobs.order_by('-id').first() or enqueue_document(document)
             except Exception as e:
-                document.delete()
-                return Response({"error": f"Processing failed: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+                return Response({"error": f"Failed to queue document: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            return Response({
+                "message": "Document uploaded and queued for processing",
+                "file_name": document.file_name,
+                "job_id": job.id,
+                "status_url": reverse('ingestion-job', kwargs={'job_id': job.id})
+            }, status=status.HTTP_202_ACCEPTED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+@extend_schema(
+    responses={
+        200: IngestionJobSerializer,
+        401: OpenApiResponse(
+            response={'type': 'object', 'properties': {'detail': {'type': 'string'}}},
+            description='Unauthorized due to missing or invalid token'
+        ),
+        404: OpenApiResponse(
+            response={'type': 'object', 'properties': {'error': {'type': 'string'}}},
+            description='Ingestion job not found, or not one of your uploads'
+        )
+    },
+    description='Report the stage, progress, per-stage timings and retry state of a document ingestion job (requires token authentication)'
+)
+class IngestionJobView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, job_id):
+        try:
+            jobs = IngestionJob.objects.select_related('document')
+            # Uploaders see their own documents' jobs; staff see every job
+            if not request.user.is_staff:
+                jobs = jobs.filter(document__uploaded_by=request.user)
+            job = jobs.get(id=job_id)
+        except IngestionJob.DoesNotExist:
+            return Response({"error": "Ingestion job not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(IngestionJobSerializer(job).data, status=status.HTTP_200_OK)
+
+@extend_schema(
+    responses={
+        200: OpenApiResponse(
+            response={'type': 'object'},
+            description='Hit/miss/eviction counters and sizes for the retrieval and answer caches, plus re-ranker counters when enabled'
+        ),
+        403: OpenApiResponse(
+            response={'type': 'object', 'properties': {'detail': {'type': 'string'}}},
+            description='Only staff users may read cache statistics'
+        )
+    },
+    description='Report retrieval cache statistics for sizing (staff only)'
+)
+class CacheStatsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        stats = retrieval_cache_stats()
+        stats['answer_cache'] = answer_cache.answer_cache_stats()
+        stats['vector_store'] = get_vector_store().stats()
+        if settings.RERANK_ENABLED:
+            stats['reranker'] = get_reranker().stats()
+        return Response(stats, status=status.HTTP_200_OK)
+
+# Prometheus scrape endpoint. Metrics are per process: with several workers, scrape each one
+# (or run a single worker per container). Set METRICS_TOKEN to require a bearer token.
+class MetricsView(View):
+
+    def get(self, request):
+        if settings.METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {settings.METRICS_TOKEN}":
+            return JsonResponse({"detail": "Invalid or missing metrics token."}, status=status.HTTP_401_UNAUTHORIZED)
+        return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 class TTSThrottle(AnonRateThrottle):
     rate = '10/minute'
 
@@ -160,7 +555,7 @@ class TTSThrottle(AnonRateThrottle):
             response={
                 'type': 'string', 'format': 'binary'
             },
-            description='Audio file (MP3) streamed for playback'
+            description='WAV audio streamed segment by segment; X-TTS-Position gives the character offset playback starts at'
         ),
         400: OpenApiResponse(
             response={'type': 'object', 'properties': {'error': {'type': 'string'}}},
@@ -172,7 +567,7 @@ class TTSThrottle(AnonRateThrottle):
         ),
         429: OpenApiResponse(
             response={'type': 'object', 'properties': {'detail': {'type': 'string'}}},
-            description='Too many requests (rate limit exceeded)'
+            description='Rate limit exceeded, or the speech synthesis queue is full (retry after the Retry-After delay)'
         ),
         500: OpenApiResponse(
             response={'type': 'object', 'properties': {'error': {'type': 'string'}}},
@@ -196,50 +591,65 @@ class TextToSpeechView(APIView):
         position = serializer.validated_data.get('position', 0)
 
         try:
-            interaction = InteractionLog.objects.get(id=answer_id, user=request.user)
+            # The answer may still be sitting in an interaction log buffer, of this process or another
+            interaction = get_logged_interaction(answer_id, request.user)
         except InteractionLog.DoesNotExist:
             return Response({"error": "Interaction not found or not authorized"}, status=status.HTTP_400_BAD_REQUEST)
 
         text = interaction.answer
 
-        # Initialize pyttsx3
-        engine = pyttsx3.init()
-        voices = engine.getProperty('voices')
-        available_voices = [v.id for v in voices]
-
-        # Set voice if provided and valid
-        if voice_id and voice_id in available_voices:
-            engine.setProperty('voice', voice_id)
-        elif voice_id:
-            return Response({"error": f"Voice ID {voice_id} not found. Available voices: {available_voices}"}, status=status.HTTP_400_BAD_REQUEST)
-
-        # Handle TTS state
-        tts_state, _ = TTSState.objects.get_or_create(user=request.user, text=text, defaults={'voice_id': voice_id})
+        # State is keyed by (user, interaction, voice); pause/resume without a voice continue
+        # with the voice last used for this answer
+        states = TTSState.objects.filter(user=request.user, interaction=interaction)
+        if action != 'play' and not voice_id:
+            voice_id = states.order_by('-updated_at').values_list('voice_id', flat=True).first() or ''
 
         if action == 'pause':
-            tts_state.position = position
-            tts_state.save()
+            TTSState.save_position(request.user, interaction, voice_id, position)
             return Response({"message": "Playback paused", "position": position}, status=status.HTTP_200_OK)
-        
+
+        # The engine and its voice list live for the whole process
+        speech = get_speech_service()
+        try:
+            available_voices = speech.voices()
+        except Exception as e:
+            logger.error("TTS engine unavailable: %s", str(e))
+            return Response({"error": "Text-to-speech engine unavailable"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        if voice_id and voice_id not in available_voices:
+            return Response({"error": f"Voice ID {voice_id} not found. Available voices: {available_voices}"}, status=status.HTTP_400_BAD_REQUEST)
+
         if action == 'resume':
-            start_pos = tts_state.position if tts_state.position > 0 else position
+            saved = states.filter(voice_id=voice_id).values_list('position', flat=True).first()
+            start_pos = saved if saved else position
         else:  # play
             start_pos = 0
-            tts_state.position = 0
-            tts_state.voice_id = voice_id
-            tts_state.save()
-
-        # Convert text to speech and stream as MP3
-        audio_buffer = io.BytesIO()
-        engine.save_to_file(text[start_pos:], audio_buffer)
-        engine.runAndWait()
-
-        audio_buffer.seek(0)
-        response = StreamingHttpResponse(audio_buffer, content_type='audio/mpeg')
-        response['Content-Disposition'] = 'attachment; filename="speech.mp3"'
-        
-        # Update position on completion (approximate)
-        tts_state.position = len(text)
-        tts_state.save()
+            TTSState.save_position(request.user, interaction, voice_id, 0)
+
+        # Resume restarts at the beginning of the sentence segment holding the position;
+        # playing past the end starts over
+        segments = split_sentences(text)
+        if not segments:
+            return Response({"error": "Answer has no text to read"}, status=status.HTTP_400_BAD_REQUEST)
+        first_segment = segment_at(segments, start_pos)
+        if first_segment >= len(segments):
+            first_segment = 0
+
+        # Progress is saved as each segment finishes streaming
+        def save_progress(segment):
+            TTSState.save_position(request.user, interaction, voice_id, segment.end)
+
+        try:
+            audio = speech.stream(segments[first_segment:], voice_id, on_segment=save_progress)
+        except TTSBusyError as e:
+            return Response({"error": str(e)}, status=status.HTTP_429_TOO_MANY_REQUESTS, headers={'Retry-After': str(e.retry_after)})
+        except Exception as e:
+            logger.exception("Error during TTS synthesis: %s", str(e))
+            return Response({"error": "Failed to synthesize speech"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        return response
\ No newline at end of file
+        response = StreamingHttpResponse(audio, content_type='audio/wav')
+        response['Content-Disposition'] = 'attachment; filename="speech.wav"'
+        response['X-TTS-Position'] = str(segments[first_segment].start)
+        response['X-TTS-Segment'] = str(first_segment)
+        response['X-TTS-Segments'] = str(len(segments))
+        return response
@@ -76,12 +76,53 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'knowledge_assistant.wsgi.application'
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# Database. DATABASE_ENGINE=sqlite (default) keeps the file database, tuned for concurrent
+# writers: WAL journaling lets readers run during a write, synchronous=NORMAL fsyncs at
+# checkpoints rather than every commit, writers wait up to SQLITE_BUSY_TIMEOUT seconds for
+# the lock, and transactions take the write lock when they begin (IMMEDIATE) so a read
+# followed by a write never fails with "database is locked" on the upgrade.
+# DATABASE_ENGINE=postgresql connects with POSTGRES_* and keeps each connection open for
+# DB_CONN_MAX_AGE seconds; POSTGRES_POOL=true uses a psycopg connection pool of
+# POSTGRES_POOL_MIN_SIZE..POSTGRES_POOL_MAX_SIZE connections per process instead
+# (pip install "psycopg[binary,pool]").
+DATABASE_ENGINE = os.getenv('DATABASE_ENGINE', 'sqlite').lower()
+DB_CONN_MAX_AGE = int(os.getenv('DB_CONN_MAX_AGE', '60'))
+SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', '20'))
+POSTGRES_POOL = os.getenv('POSTGRES_POOL', 'false').lower() == 'true'
+POSTGRES_POOL_MIN_SIZE = int(os.getenv('POSTGRES_POOL_MIN_SIZE', '2'))
+POSTGRES_POOL_MAX_SIZE = int(os.getenv('POSTGRES_POOL_MAX_SIZE', '10'))
+
+if DATABASE_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('POSTGRES_DB', 'knowledge_assistant'),
+            'USER': os.getenv('POSTGRES_USER', 'postgres'),
+            'PASSWORD': os.getenv('POSTGRES_PASSWORD', ''),
+            'HOST': os.getenv('POSTGRES_HOST', 'localhost'),
+            'PORT': os.getenv('POSTGRES_PORT', '5432'),
+            # Pooled connections go back to the pool after each request and cannot also persist
+            'CONN_MAX_AGE': 0 if POSTGRES_POOL else DB_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'pool': {'min_size': POSTGRES_POOL_MIN_SIZE, 'max_size': POSTGRES_POOL_MAX_SIZE},
+            } if POSTGRES_POOL else {},
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'timeout': SQLITE_BUSY_TIMEOUT,
+                'transaction_mode': 'IMMEDIATE',
+                'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;',
+            },
+        }
     }
-}
 
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -136,6 +177,179 @@ SPECTACULAR_SETTINGS = {
     'SERVE_INCLUDE_SCHEMA': True,
 }
 
+# ChromaDB vector store. CHROMA_MODE=http talks to a `chroma run` server through one pooled,
+# keep-alive client per process; CHROMA_MODE=persistent embeds Chroma and uses CHROMA_PERSIST_DIR directly.
+CHROMA_MODE = os.getenv('CHROMA_MODE', 'http')
+CHROMA_HOST = os.getenv('CHROMA_HOST', 'localhost')
+CHROMA_PORT = int(os.getenv('CHROMA_PORT', '8000'))
+CHROMA_TIMEOUT = float(os.getenv('CHROMA_TIMEOUT', '30'))
+CHROMA_CONNECT_TIMEOUT = float(os.getenv('CHROMA_CONNECT_TIMEOUT', '5'))
+CHROMA_PERSIST_DIR = Path(os.getenv('CHROMA_PERSIST_DIR', BASE_DIR / 'chroma'))
+CHROMA_COLLECTION = os.getenv('CHROMA_COLLECTION', 'knowledge_base')
+
+# Retrieval caches: normalised question -> embedding, and (embedding, collection version) ->
+# top-k results. Ingestion bumps the collection version, which invalidates cached results.
+# Set RETRIEVAL_CACHE_SHARED_ALIAS to a CACHES alias (e.g. Redis) to share entries and the
+# version counter between processes. Otherwise entries stay in each process's memory and the
+# version is kept in RETRIEVAL_CACHE_VERSION_FILE, which every process on the host reads.
+EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE', '10000'))
+EMBEDDING_CACHE_TTL = int(os.getenv('EMBEDDING_CACHE_TTL', '86400'))
+RESULTS_CACHE_SIZE = int(os.getenv('RESULTS_CACHE_SIZE', '2000'))
+RESULTS_CACHE_TTL = int(os.getenv('RESULTS_CACHE_TTL', '600'))
+RETRIEVAL_CACHE_SHARED_ALIAS = os.getenv('RETRIEVAL_CACHE_SHARED_ALIAS') or None
+RETRIEVAL_CACHE_VERSION_FILE = Path(os.getenv('RETRIEVAL_CACHE_VERSION_FILE', BASE_DIR / 'collection_version'))
+
+# Retrieval and context assembly. RETRIEVAL_CANDIDATES hits are fetched; hits scoring below
+# CONTEXT_MIN_SCORE (cosine) are dropped, near-duplicates (word-shingle Jaccard >=
+# CONTEXT_DEDUP_THRESHOLD) removed, neighbouring chunks merged, and the rest packed into
+# roughly CONTEXT_TOKEN_BUDGET LLM tokens.
+RETRIEVAL_CANDIDATES = int(os.getenv('RETRIEVAL_CANDIDATES', '8'))
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '700'))
+CONTEXT_MIN_SCORE = float(os.getenv('CONTEXT_MIN_SCORE', '0.25'))
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv('CONTEXT_DEDUP_THRESHOLD', '0.8'))
+
+# Observability: per-stage latency histograms, cache and queue gauges at /metrics
+# (Prometheus text format). OTEL_ENABLED additionally exports OpenTelemetry spans over OTLP;
+# configure the collector with the standard OTEL_EXPORTER_OTLP_* variables.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+OTEL_ENABLED = os.getenv('OTEL_ENABLED', 'false').lower() == 'true'
+OTEL_SERVICE_NAME = os.getenv('OTEL_SERVICE_NAME', 'knowledge-assistant')
+
+# Optional cross-encoder re-ranking: RERANK_CANDIDATES hits are fetched instead of
+# RETRIEVAL_CANDIDATES, scored on CPU in batches of RERANK_BATCH_SIZE and cut to RERANK_TOP_K.
+# RERANK_BACKEND is 'onnx' (quantized export via ONNX Runtime, RERANK_ONNX_FILE) or
+# 'cross-encoder' (sentence-transformers). If embedding, search and re-ranking would exceed
+# RERANK_LATENCY_BUDGET_MS (0 disables the budget), re-ranking is skipped for that request;
+# while requests are skipped, one per RERANK_PROBE_INTERVAL seconds re-measures the speed.
+# The model is loaded in the background when the app starts.
+RERANK_ENABLED = os.getenv('RERANK_ENABLED', 'false').lower() == 'true'
+RERANK_MODEL = os.getenv('RERANK_MODEL', 'cross-encoder/ms-marco-MiniLM-L-6-v2')
+RERANK_BACKEND = os.getenv('RERANK_BACKEND', 'onnx')
+RERANK_ONNX_FILE = os.getenv('RERANK_ONNX_FILE', 'onnx/model_quint8_avx2.onnx')
+RERANK_CANDIDATES = int(os.getenv('RERANK_CANDIDATES', '24'))
+RERANK_TOP_K = int(os.getenv('RERANK_TOP_K', '6'))
+RERANK_BATCH_SIZE = int(os.getenv('RERANK_BATCH_SIZE', '8'))
+RERANK_MAX_LENGTH = int(os.getenv('RERANK_MAX_LENGTH', '320'))
+RERANK_THREADS = int(os.getenv('RERANK_THREADS', '2'))
+RERANK_LATENCY_BUDGET_MS = float(os.getenv('RERANK_LATENCY_BUDGET_MS', '400'))
+RERANK_PROBE_INTERVAL = float(os.getenv('RERANK_PROBE_INTERVAL', '30'))
+
+# Hybrid retrieval: a BM25 keyword index (one segment file per document under
+# KEYWORD_INDEX_DIR, updated at ingestion) is fused with vector search by reciprocal rank fusion.
+KEYWORD_INDEX_ENABLED = os.getenv('KEYWORD_INDEX_ENABLED', 'true').lower() == 'true'
+KEYWORD_INDEX_DIR = Path(os.getenv('KEYWORD_INDEX_DIR', BASE_DIR / 'keyword_index'))
+RRF_K = int(os.getenv('RRF_K', '60'))
+
+# LLM backend: 'gemini' (Google Gemini API), 'echo'/'fake' (deterministic local echo for
+# offline tests and load tests) or a dotted path to an api.llm.LLMBackend subclass.
+# LLM_TIMEOUT is the total deadline per answer including retries; at most
+# LLM_MAX_CONCURRENCY calls (sync and async together) run at once per process, and
+# LLM_CIRCUIT_FAILURES consecutive upstream failures stop calls for LLM_CIRCUIT_RESET seconds.
+LLM_BACKEND = os.getenv('LLM_BACKEND', 'gemini')
+LLM_MODEL = os.getenv('LLM_MODEL', 'gemini-1.5-flash')
+LLM_TEMPERATURE = float(os.getenv('LLM_TEMPERATURE', '0.2'))
+LLM_MAX_OUTPUT_TOKENS = int(os.getenv('LLM_MAX_OUTPUT_TOKENS', '1024'))
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', '30'))
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '8'))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '2'))
+LLM_RETRY_BACKOFF = float(os.getenv('LLM_RETRY_BACKOFF', '0.5'))
+LLM_CIRCUIT_FAILURES = int(os.getenv('LLM_CIRCUIT_FAILURES', '5'))
+LLM_CIRCUIT_RESET = float(os.getenv('LLM_CIRCUIT_RESET', '30'))
+LLM_RETRY_AFTER = int(os.getenv('LLM_RETRY_AFTER', '5'))
+LLM_FAKE_TOKEN_DELAY = float(os.getenv('LLM_FAKE_TOKEN_DELAY', '0'))
+
+# Semantic answer cache in front of the LLM. An answer is reused when the retrieved context is
+# identical and the question embeddings' cosine similarity is at least ANSWER_CACHE_SIMILARITY.
+# Entries are shared across users, since every user retrieves from the same knowledge base.
+ANSWER_CACHE_ENABLED = os.getenv('ANSWER_CACHE_ENABLED', 'true').lower() == 'true'
+ANSWER_CACHE_SIMILARITY = float(os.getenv('ANSWER_CACHE_SIMILARITY', '0.95'))
+ANSWER_CACHE_TTL = int(os.getenv('ANSWER_CACHE_TTL', str(7 * 24 * 3600)))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', '10000'))
+ANSWER_CACHE_MAX_CANDIDATES = int(os.getenv('ANSWER_CACHE_MAX_CANDIDATES', '200'))
+
+# Background ingestion queue (DB-backed, no external broker required).
+# INGESTION_WORKERS threads are started lazily inside the web process; set it to 0
+# and run `python manage.py ingestion_worker` to process jobs in dedicated processes instead.
+INGESTION_WORKERS = int(os.getenv('INGESTION_WORKERS', '2'))
+INGESTION_MAX_ATTEMPTS = int(os.getenv('INGESTION_MAX_ATTEMPTS', '3'))
+INGESTION_RETRY_BACKOFF = float(os.getenv('INGESTION_RETRY_BACKOFF', '5'))
+INGESTION_RETRY_BACKOFF_MAX = float(os.getenv('INGESTION_RETRY_BACKOFF_MAX', '300'))
+INGESTION_POLL_INTERVAL = float(os.getenv('INGESTION_POLL_INTERVAL', '2'))
+INGESTION_JOB_TIMEOUT = int(os.getenv('INGESTION_JOB_TIMEOUT', '1800'))
+
+# Ingestion pipeline. PDFs with at least PDF_PARALLEL_MIN_PAGES pages are parsed in
+# PDF_PAGES_PER_TASK page ranges across PDF_PARSE_WORKERS processes (0 = one per CPU).
+PDF_PARSE_WORKERS = int(os.getenv('PDF_PARSE_WORKERS', '0'))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv('PDF_PARALLEL_MIN_PAGES', '40'))
+PDF_PAGES_PER_TASK = int(os.getenv('PDF_PAGES_PER_TASK', '10'))
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', '64'))
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'all-MiniLM-L6-v2')
+# 'sentence-transformers' (PyTorch), 'onnx' (ONNX Runtime, all-MiniLM-L6-v2 only) or 'hashing'
+# (offline word hashing, for benchmarks only).
+# The model loads lazily on first use; query encodes arriving within
+# EMBEDDING_QUERY_MAX_WAIT_MS of each other share one forward pass.
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'sentence-transformers')
+EMBEDDING_QUERY_MAX_BATCH = int(os.getenv('EMBEDDING_QUERY_MAX_BATCH', '32'))
+EMBEDDING_QUERY_MAX_WAIT_MS = float(os.getenv('EMBEDDING_QUERY_MAX_WAIT_MS', '5'))
+
+# Embedding store: chunk vectors are also kept on disk (EMBEDDING_STORE_DIR, one directory
+# per model, float16 or int8, memory-mapped) keyed by chunk text, so re-processing and
+# `manage.py reindex` reuse them instead of re-encoding.
+EMBEDDING_STORE_ENABLED = os.getenv('EMBEDDING_STORE_ENABLED', 'true').lower() == 'true'
+EMBEDDING_STORE_DIR = Path(os.getenv('EMBEDDING_STORE_DIR', BASE_DIR / 'embedding_store'))
+EMBEDDING_STORE_DTYPE = os.getenv('EMBEDDING_STORE_DTYPE', 'float16')
+
+# Vector store backend: 'chroma', or 'local' for the built-in index. The local index keeps
+# immutable memory-mapped segments under LOCAL_INDEX_DIR that every worker maps read-only,
+# one per written document until LOCAL_INDEX_MERGE_FACTOR segments of similar size are
+# merged. Segments below LOCAL_INDEX_IVF_MIN_VECTORS chunks are searched exactly, larger ones
+# through an IVF index (LOCAL_INDEX_LISTS lists, 0 = sqrt(chunks); LOCAL_INDEX_NPROBE probed).
+VECTOR_STORE = os.getenv('VECTOR_STORE', 'chroma')
+LOCAL_INDEX_DIR = Path(os.getenv('LOCAL_INDEX_DIR', BASE_DIR / 'local_index'))
+LOCAL_INDEX_IVF_MIN_VECTORS = int(os.getenv('LOCAL_INDEX_IVF_MIN_VECTORS', '50000'))
+LOCAL_INDEX_LISTS = int(os.getenv('LOCAL_INDEX_LISTS', '0'))
+LOCAL_INDEX_NPROBE = int(os.getenv('LOCAL_INDEX_NPROBE', '8'))
+LOCAL_INDEX_MERGE_FACTOR = int(os.getenv('LOCAL_INDEX_MERGE_FACTOR', '8'))
+
+# Text-to-speech. Answers are split into sentence segments of up to TTS_SEGMENT_MAX_CHARS;
+# each segment is synthesized once per voice and cached as WAV under TTS_CACHE_DIR (oldest
+# files evicted beyond TTS_CACHE_MAX_MB). TTS_RATE sets words per minute (empty = engine default).
+TTS_SEGMENT_MAX_CHARS = int(os.getenv('TTS_SEGMENT_MAX_CHARS', '400'))
+TTS_CACHE_DIR = Path(os.getenv('TTS_CACHE_DIR', BASE_DIR / 'tts_cache'))
+TTS_CACHE_MAX_MB = int(os.getenv('TTS_CACHE_MAX_MB', '1024'))
+TTS_RATE = int(os.getenv('TTS_RATE')) if os.getenv('TTS_RATE') else None
+
+# Speech synthesis runs in TTS_WORKERS spawned processes (0 = one thread in the web process).
+# At most TTS_QUEUE_SIZE segments may be queued or synthesizing; past that the endpoint
+# answers 429 with Retry-After. Streams keep TTS_PREFETCH_SEGMENTS segments synthesizing
+# ahead. TTS_PREGENERATE queues every new answer for synthesis in TTS_PREGENERATE_VOICE
+# ('' = engine default), using at most half the queue.
+TTS_WORKERS = int(os.getenv('TTS_WORKERS', '2'))
+TTS_QUEUE_SIZE = int(os.getenv('TTS_QUEUE_SIZE', '32'))
+TTS_PREFETCH_SEGMENTS = int(os.getenv('TTS_PREFETCH_SEGMENTS', '2'))
+TTS_SYNTH_TIMEOUT = float(os.getenv('TTS_SYNTH_TIMEOUT', '60'))
+TTS_PREGENERATE = os.getenv('TTS_PREGENERATE', 'false').lower() == 'true'
+TTS_PREGENERATE_VOICE = os.getenv('TTS_PREGENERATE_VOICE', '')
+
+# Interaction logging. With INTERACTION_LOG_BUFFERED, answered questions are buffered in
+# memory and written by a background thread with bulk_create every
+# INTERACTION_LOG_FLUSH_INTERVAL seconds or once INTERACTION_LOG_BATCH_SIZE rows wait.
+# Ids are reserved from the table's sequence INTERACTION_LOG_ID_BLOCK at a time so the
+# answer id is returned before the row is written (SQLite and PostgreSQL; other databases
+# write synchronously). A request that finds INTERACTION_LOG_MAX_QUEUE rows waiting
+# flushes them itself. Pending rows are written when the process exits cleanly.
+INTERACTION_LOG_BUFFERED = os.getenv('INTERACTION_LOG_BUFFERED', 'true').lower() == 'true'
+INTERACTION_LOG_BATCH_SIZE = int(os.getenv('INTERACTION_LOG_BATCH_SIZE', '100'))
+INTERACTION_LOG_FLUSH_INTERVAL = float(os.getenv('INTERACTION_LOG_FLUSH_INTERVAL', '1.0'))
+INTERACTION_LOG_MAX_QUEUE = int(os.getenv('INTERACTION_LOG_MAX_QUEUE', '5000'))
+INTERACTION_LOG_ID_BLOCK = int(os.getenv('INTERACTION_LOG_ID_BLOCK', '100'))
+
+# Chunking. Sizes are in model tokens; all-MiniLM-L6-v2 reads 256 tokens including
+# [CLS]/[SEP], so chunks up to 254 tokens are embedded without truncation.
+CHUNKER = os.getenv('CHUNKER', 'api.chunking.TokenChunker')
+CHUNK_MAX_TOKENS = int(os.getenv('CHUNK_MAX_TOKENS', '254'))
+CHUNK_OVERLAP_TOKENS = int(os.getenv('CHUNK_OVERLAP_TOKENS', '32'))
+
 # Logging configuration
 LOGGING = {
     'version': 1,